@@ -6,6 +6,10 @@ class Action(object):
     def __init__(self, deployment_id, service):
         self.deployment_id = deployment_id
         self.service = service
+        # Optional ordering from the server role: lower priorities start first, dependents wait for the services they depend on
+        self.service_name = None
+        self.priority = 0
+        self.depends_on = []
     def __str__(self):
         return json.dumps({'deployment_id': self.deployment_id, 'type': type(self).__name__, 'service': str(self.service)})
 
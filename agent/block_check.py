@@ -56,8 +56,9 @@ WINDOWS_SCRIPT = "powershell -EncodedCommand {0}".format(encoded)
 
 
 class BlockCheckService(object):
-    def __init__(self, platform=PLATFORM):
+    def __init__(self, platform=PLATFORM, consul_api=None):
         self.platform = platform
+        self.consul_api = consul_api
 
     def get_platform_script(self):
         if self.platform == 'linux':
@@ -69,6 +70,9 @@ class BlockCheckService(object):
             raise Exception("Invalid Platform")
 
     def register_block(self):
+        if self.consul_api is not None:
+            # Use the agent's own Consul transport, which may be a unix socket
+            return self.consul_api.register_script_check(None, id="block-check", name="block-check", script_path=self.get_platform_script(), interval="3s")
         r = RequestService()
         d = {}
         d["Name"] = "block-check"
@@ -0,0 +1,117 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import logging, os, Queue, shutil, sys, threading
+
+QUEUED, DOWNLOADING, READY, FAILED, SKIPPED = 'queued', 'downloading', 'ready', 'failed', 'skipped'
+
+class BundlePrefetcher(object):
+    # Downloads the bundles of the next pending install actions in a background thread, one at a time,
+    # while keeping the bundles on disk under max_disk_usage_in_mb. A deployment takes its bundle instead of downloading it.
+    # Downloads hold a slot of the download semaphore of the server role, like those of the deployments.
+    def __init__(self, s3_file_manager, directory, max_bundles=2, max_disk_usage_in_mb=1024, create_download_semaphore=None):
+        self._s3_file_manager = s3_file_manager
+        self._create_download_semaphore = create_download_semaphore
+        self._directory = directory
+        self._max_bundles = max_bundles
+        self._max_disk_usage = max_disk_usage_in_mb * 1024 * 1024
+        self._condition = threading.Condition()
+        self._bundles = {}
+        self._queue = Queue.Queue()
+        self.number_of_hits = self.number_of_misses = 0
+        self._thread = threading.Thread(target=self._run, name='bundle-prefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def disk_usage(self):
+        with self._condition:
+            return sum(bundle['size'] for bundle in self._bundles.values() if bundle['state'] in (DOWNLOADING, READY))
+
+    def _remove(self, deployment_id):
+        bundle = self._bundles.pop(deployment_id)
+        try:
+            if bundle['state'] in (READY, FAILED) and os.path.isfile(bundle['filepath']):
+                os.remove(bundle['filepath'])
+        except OSError as e:
+            logging.warning('Failed to delete prefetched bundle {0}: {1}'.format(bundle['filepath'], e))
+
+    def prefetch(self, actions, running_actions=()):
+        # actions are the waiting install actions in plan order, bundles of actions neither running nor among the next ones are discarded
+        actions = actions[:self._max_bundles]
+        deployment_ids = set(action.deployment_id for action in list(actions) + list(running_actions))
+        with self._condition:
+            for deployment_id in [d for d, bundle in self._bundles.items() if d not in deployment_ids and bundle['state'] != DOWNLOADING]:
+                self._remove(deployment_id)
+            for action in actions:
+                if action.deployment_id in self._bundles:
+                    continue
+                self._bundles[action.deployment_id] = {'state': QUEUED, 'size': 0,
+                                                       'bucket': action.service.installation['package_bucket'],
+                                                       'key': action.service.installation['package_key'],
+                                                       'filepath': os.path.join(self._directory, '{0}.zip'.format(action.deployment_id))}
+                self._queue.put(action.deployment_id)
+
+    def _run(self):
+        while True:
+            deployment_id = self._queue.get()
+            try:
+                self._prefetch(deployment_id)
+            except:
+                logging.error('Failed to prefetch bundle of deployment {0}.'.format(deployment_id))
+                logging.exception(sys.exc_info()[1])
+                with self._condition:
+                    bundle = self._bundles.get(deployment_id)
+                    if bundle is not None and bundle['state'] != READY:
+                        bundle['state'] = FAILED
+                    self._condition.notify_all()
+
+    def _prefetch(self, deployment_id):
+        with self._condition:
+            bundle = self._bundles.get(deployment_id)
+            if bundle is None or bundle['state'] != QUEUED:
+                return
+        size = self._s3_file_manager.get_file_size(bundle['bucket'], bundle['key'])
+        with self._condition:
+            if self._bundles.get(deployment_id) is not bundle:
+                return
+            if size is None or sum(b['size'] for b in self._bundles.values() if b['state'] in (DOWNLOADING, READY)) + size > self._max_disk_usage:
+                logging.debug('Not prefetching bundle of deployment {0}, it would exceed the disk usage limit.'.format(deployment_id))
+                bundle['state'] = SKIPPED
+                return
+        # The bundle stays queued while waiting for a slot, a deployment starting meanwhile downloads it on its own
+        semaphore = self._create_download_semaphore() if self._create_download_semaphore is not None else None
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            with self._condition:
+                if self._bundles.get(deployment_id) is not bundle:
+                    return
+                bundle['size'] = size
+                bundle['state'] = DOWNLOADING
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            logging.debug('Prefetching bundle from S3 bucket \'{0}\' with key \'{1}\' to {2}.'.format(bundle['bucket'], bundle['key'], bundle['filepath']))
+            is_success = self._s3_file_manager.download_file(bundle['bucket'], bundle['key'], bundle['filepath'])
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+        with self._condition:
+            bundle['state'] = READY if is_success else FAILED
+            self._condition.notify_all()
+
+    def take(self, deployment_id, filepath):
+        # Moves the prefetched bundle to filepath, waiting for it if it is being downloaded. Returns False if there is none.
+        with self._condition:
+            bundle = self._bundles.get(deployment_id)
+            while bundle is not None and bundle['state'] == DOWNLOADING:
+                # Waiting with a timeout keeps the thread responsive to interrupts
+                self._condition.wait(1)
+            if bundle is None or bundle['state'] != READY:
+                if bundle is not None:
+                    self._remove(deployment_id)
+                self.number_of_misses += 1
+                return False
+            del self._bundles[deployment_id]
+            self.number_of_hits += 1
+        shutil.move(bundle['filepath'], filepath)
+        return True
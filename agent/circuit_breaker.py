@@ -0,0 +1,69 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import logging, threading, time
+from collections import deque
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+DEFAULT_SETTINGS = {'window_size': 20, 'minimum_calls': 10, 'error_rate_threshold': 0.5, 'slow_call_in_ms': 5000, 'open_duration_in_ms': 30000}
+
+class CircuitBreaker(object):
+    # Opens when too many of the recent calls failed or were slow, then lets a single trial call through once the open period is over
+    def __init__(self, config=None):
+        self._settings = dict(DEFAULT_SETTINGS)
+        self._settings.update(config or {})
+        self._outcomes = deque(maxlen=self._settings['window_size'])
+        self._lock = threading.Lock()
+        self._opened_at = None
+        self._is_trial_in_progress = False
+        self.state = CLOSED
+        self.number_of_rejected_calls = 0
+
+    @property
+    def is_open(self):
+        return self.state != CLOSED
+
+    @property
+    def error_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return float(self._outcomes.count(False)) / len(self._outcomes)
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == OPEN and time.time() - self._opened_at >= self._settings['open_duration_in_ms'] / 1000.0:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._is_trial_in_progress:
+                self._is_trial_in_progress = True
+                return True
+            if self.state == CLOSED:
+                return True
+            self.number_of_rejected_calls += 1
+            return False
+
+    def record_success(self, duration_in_ms):
+        if duration_in_ms > self._settings['slow_call_in_ms']:
+            logging.debug('Slow Consul HTTP API call: {0:.0f} ms'.format(duration_in_ms))
+            self.record_failure()
+            return
+        with self._lock:
+            if self.state == HALF_OPEN:
+                logging.info('Consul HTTP API trial call succeeded, closing circuit breaker.')
+                self.state = CLOSED
+                self._outcomes.clear()
+                self._is_trial_in_progress = False
+            self._outcomes.append(True)
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            if self.state == HALF_OPEN:
+                self._open()
+            elif self.state == CLOSED and len(self._outcomes) >= self._settings['minimum_calls'] and self.error_rate >= self._settings['error_rate_threshold']:
+                self._open()
+
+    def _open(self):
+        logging.warning('Consul HTTP API is failing or slow (error rate {0:.2f}), opening circuit breaker for {1} ms.'.format(self.error_rate, self._settings['open_duration_in_ms']))
+        self.state = OPEN
+        self._opened_at = time.time()
+        self._is_trial_in_progress = False
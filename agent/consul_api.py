@@ -1,11 +1,28 @@
 # Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
 
-import base64, json, logging, requests
-from retrying import retry
+import base64, copy, json, logging, re, requests, threading, time
+from circuit_breaker import CircuitBreaker
+from collections import OrderedDict
+from kv_cache import KeyValueCache, is_immutable_key, is_under_prefix
+from requests.adapters import HTTPAdapter
+from retry_policy import RetryPolicy
+from unix_socket_adapter import UnixSocketAdapter
+
+MAX_TRANSACTION_OPERATIONS = 64
+CONSISTENCY_MODES = ['default', 'stale', 'consistent']
+SERVICE_VERSION_PREFIX_PATTERN = re.compile(r'^environments/[^/]+/services/[^/]+/[^/]+/?$')
 
 class ConsulError(RuntimeError):
     pass
 
+class CircuitOpenError(ConsulError):
+    pass
+
+def decode_value(value):
+    if value is None:
+        return None
+    return json.loads(base64.b64decode(value))
+
 def handle_connection_error(func):
     def handle_error(*args, **kwargs):
         try:
@@ -18,18 +35,69 @@ def handle_connection_error(func):
 def retry_if_connection_error(exception):
     return isinstance(exception, requests.exceptions.ConnectionError)
 
+def retry_if_consul_error(exception):
+    # Retrying while the circuit breaker is open would only delay the fallback
+    return isinstance(exception, ConsulError) and not isinstance(exception, CircuitOpenError)
+
 class ConsulApi(object):
-    def __init__(self, consul_config):
+    def __init__(self, consul_config, retry_policy=None):
         self._config = consul_config
-        self._base_url = '{0}://{1}:{2}/{3}'.format(self._config['scheme'], self._config['host'], self._config['port'], self._config['version'])
-        self._last_known_modify_index = 0
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._session = requests.Session()
+        if self._config['scheme'] == 'unix':
+            # The host is only a placeholder, the adapter sends every request to the socket
+            self._base_url = 'http+unix://localhost/{0}'.format(self._config['version'])
+            self._adapter = UnixSocketAdapter(self._config['socket_path'], pool_maxsize=self._config.get('pool_size', 10))
+            self._session.mount('http+unix://', self._adapter)
+        else:
+            self._base_url = '{0}://{1}:{2}/{3}'.format(self._config['scheme'], self._config['host'], self._config['port'], self._config['version'])
+            self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._config.get('pool_size', 10))
+            self._session.mount('{0}://'.format(self._config['scheme']), self._adapter)
+        self.cache = KeyValueCache(self._config.get('cache_size', 1000))
+        # ModifyIndex of keys learned from reads and writes, so that check-and-set writes need no extra read
+        self._modify_indexes = {}
+        self.circuit_breaker = CircuitBreaker(self._config.get('circuit_breaker'))
+        # Key-value writes rejected while the circuit breaker is open, replayed in order once it closes
+        self._pending_writes = OrderedDict()
+        # Service and check registrations with the local Consul agent deferred while the circuit breaker is open, latest per service or check
+        self._pending_registrations = OrderedDict()
+        self._pending_writes_lock = threading.Lock()
+        self._last_service_catalogue = None
+        self._replay_lock = threading.Lock()
+        # Last index returned by the blocking queries on each watched key prefix, stale reads under it must not be older
+        self._watched_indexes = {}
+        self._consistency = {}
+        for call_class, settings in (self._config.get('consistency') or {}).iteritems():
+            settings = settings or {}
+            mode = settings.get('mode', 'default')
+            if mode not in CONSISTENCY_MODES:
+                raise ValueError('Unknown Consul consistency mode \'{0}\' for {1} reads. Supported modes: {2}'.format(mode, call_class, ', '.join(CONSISTENCY_MODES)))
+            self._consistency[call_class] = (mode, settings.get('max_stale_in_ms'))
+
+    def _send(self, method, url, is_blocking=False, **kwargs):
+        # Blocking queries are slow by design and bypass the circuit breaker
+        if is_blocking:
+            return method(url, **kwargs)
+        if not self.circuit_breaker.allow_request():
+            raise CircuitOpenError('Consul HTTP API circuit breaker is open, request to {0} not sent.'.format(url))
+        start = time.time()
+        try:
+            response = method(url, **kwargs)
+        except:
+            self.circuit_breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success((time.time() - start) * 1000)
+            self._replay_pending_writes()
+        return response
 
     @handle_connection_error
-    @retry(retry_on_exception=retry_if_connection_error, wait_exponential_multiplier=1000, wait_exponential_max=60000)
-    def _api_get(self, relative_url):
+    def _api_get(self, relative_url, is_blocking=False):
         url = '{0}/{1}'.format(self._base_url, relative_url)
         logging.debug('Consul HTTP API request: {0}'.format(url))
-        response = requests.get(url, headers={'X-Consul-Token': self._config['acl_token']})
+        response = self.retry_policy.call('consul_read', retry_if_connection_error, self._send, self._session.get, url, is_blocking, headers={'X-Consul-Token': self._config['acl_token']})
         logging.debug('Response status code: {0}'.format(response.status_code))
         logging.debug('Response content: {0}'.format(response.text))
         if response.status_code == 500:
@@ -37,20 +105,89 @@ class ConsulApi(object):
         return response
 
     @handle_connection_error
-    @retry(retry_on_exception=retry_if_connection_error, wait_exponential_multiplier=1000, wait_exponential_max=60000)
     def _api_put(self, relative_url, content):
         url = '{0}/{1}'.format(self._base_url, relative_url)
         logging.debug('Consul HTTP API PUT request URL: {0}'.format(url))
         logging.debug('Consul HTTP API PUT request content: {0}'.format(content))
-        response = requests.put(url, data=content, headers={'X-Consul-Token': self._config['acl_token']})
+        response = self.retry_policy.call('consul_write', retry_if_connection_error, self._send, self._session.put, url, data=content, headers={'X-Consul-Token': self._config['acl_token']})
         logging.debug('Response status code: {0}'.format(response.status_code))
         logging.debug('Response content: {0}'.format(response.text))
         if response.status_code == 500:
             raise ConsulError('Consul HTTP API internal error. Response content: {0}'.format(response.text))
         return response
 
-    @retry(wait_fixed=5000, stop_max_attempt_number=12)
+    def _min_index(self, keys):
+        return max([index for key_prefix, index in self._watched_indexes.items() if any(is_under_prefix(key, key_prefix) for key in keys)] or [0])
+
+    def _api_read(self, call_class, relative_url, content=None, min_index=0):
+        # Reads of a class configured for stale or consistent mode carry the matching query parameter, other reads use the default mode.
+        # A stale read older than min_index, the index a watch already reported for the keys read, is read again in default mode.
+        def request(url):
+            return self._api_get(url) if content is None else self._api_put(url, content)
+        mode, max_stale_in_ms = self._consistency.get(call_class, ('default', None))
+        if mode == 'default':
+            return request(relative_url)
+        response = request('{0}{1}{2}'.format(relative_url, '&' if '?' in relative_url else '?', mode))
+        if mode == 'stale' and max_stale_in_ms is not None:
+            try:
+                last_contact = int(response.headers.get('X-Consul-LastContact') or 0)
+            except ValueError:
+                last_contact = 0
+            if last_contact > max_stale_in_ms:
+                logging.debug('Stale read of \'{0}\' is {1} ms behind the leader, more than {2} ms allowed. Reading again in default mode.'.format(relative_url, last_contact, max_stale_in_ms))
+                return request(relative_url)
+        if mode == 'stale' and min_index:
+            try:
+                index = int(response.headers.get('X-Consul-Index') or 0)
+            except ValueError:
+                index = 0
+            if index < min_index:
+                logging.debug('Stale read of \'{0}\' at index {1} is older than index {2} already watched. Reading again in default mode.'.format(relative_url, index, min_index))
+                return request(relative_url)
+        return response
+
+    def _last_known_values(self, error, key_prefix):
+        values = self.cache.get_last_known_values(key_prefix)
+        if not values:
+            raise error
+        logging.warning('{0} Using {1} last known values under \'{2}\'.'.format(error, len(values), key_prefix))
+        return values
+
+    def _last_known_value(self, error, key):
+        is_known, value = self.cache.get_last_known(key)
+        if not is_known:
+            raise error
+        logging.warning('{0} Using last known value of \'{1}\'.'.format(error, key))
+        return value
+
+    def _replay_pending_writes(self):
+        if not (self._pending_writes or self._pending_registrations) or self.circuit_breaker.is_open or not self._replay_lock.acquire(False):
+            return
+        try:
+            while self._pending_registrations and not self.circuit_breaker.is_open:
+                with self._pending_writes_lock:
+                    identity, (relative_url, content) = self._pending_registrations.popitem(last=False)
+                logging.info('Replaying {0} deferred while Consul was unavailable.'.format(relative_url))
+                try:
+                    if not self._agent_put(identity, relative_url, content):
+                        logging.error('Consul agent rejected {0} deferred while Consul was unavailable.'.format(relative_url))
+                except ConsulError as e:
+                    logging.error('Failed to replay {0}: {1}'.format(relative_url, e))
+            while self._pending_writes and not self.circuit_breaker.is_open:
+                with self._pending_writes_lock:
+                    key, value = self._pending_writes.popitem(last=False)
+                logging.info('Replaying write of key \'{0}\' queued while Consul was unavailable.'.format(key))
+                try:
+                    self.write_value(key, value)
+                except ConsulError as e:
+                    logging.error('Failed to replay write of key \'{0}\': {1}'.format(key, e))
+        finally:
+            self._replay_lock.release()
+
     def _get_modify_index(self, key, for_write_operation):
+        return self.retry_policy.call('consul_read', retry_if_consul_error, self._read_modify_index, key, for_write_operation)
+
+    def _read_modify_index(self, key, for_write_operation):
         logging.debug('Retrieving Consul key-value store modify index for key: {0}'.format(key))
         response = self._api_get('kv/{0}?index'.format(key))
         # For new values modify_index == 0
@@ -61,6 +198,24 @@ class ConsulApi(object):
         logging.debug('Consul key-value store modify index for key \'{0}\': {1}'.format(key, modify_index))
         return modify_index
 
+    @property
+    def connection_reuse_rate(self):
+        number_of_requests = number_of_connections = 0
+        if isinstance(self._adapter, UnixSocketAdapter):
+            connection_pools = [self._adapter.pool]
+        else:
+            connection_pools = [self._adapter.poolmanager.pools.get(key) for key in self._adapter.poolmanager.pools.keys()]
+        for pool in connection_pools:
+            if pool is not None:
+                number_of_requests += pool.num_requests
+                number_of_connections += pool.num_connections
+        if number_of_requests == 0:
+            return 0.0
+        return float(max(number_of_requests - number_of_connections, 0)) / number_of_requests
+
+    def close(self):
+        self._session.close()
+
     def check_connectivity(self):
         logging.info('Checking Consul HTTP API connectivity')
         self._api_get('agent/self')
@@ -72,61 +227,202 @@ class ConsulApi(object):
         def not_found():
             logging.warning('Consul key-value store does not contain key prefix \'{0}\''.format(key_prefix))
             return []
-        response = self._api_get('kv/{0}?keys'.format(key_prefix))
+        try:
+            response = self._api_read('key_listings', 'kv/{0}?keys'.format(key_prefix), min_index=self._min_index([key_prefix]))
+        except CircuitOpenError as error:
+            return self._last_known_values(error, key_prefix).keys()
         cases = {200: decode, 404: not_found}
         return cases[response.status_code]()
 
     def get_service_catalogue(self):
-        response = self._api_get('agent/services')
-        return response.json()
+        try:
+            response = self._api_get('agent/services')
+        except CircuitOpenError as error:
+            if self._last_service_catalogue is None:
+                raise
+            logging.warning('{0} Using last known service catalogue with deferred registrations.'.format(error))
+            catalogue = copy.deepcopy(self._last_service_catalogue)
+            with self._pending_writes_lock:
+                for relative_url, content in self._pending_registrations.values():
+                    if relative_url == 'agent/service/register':
+                        service = json.loads(content)
+                        catalogue[service['ID']] = {'Service': service['Name'], 'ID': service['ID'], 'Address': service['Address'], 'Port': service['Port'], 'Tags': service['Tags']}
+            return catalogue
+        catalogue = response.json()
+        self._last_service_catalogue = copy.deepcopy(catalogue)
+        return catalogue
 
     def get_value(self, key):
         def decode():
             values = response.json()
             for value in values:
-                value['Value'] = json.loads(base64.b64decode(value['Value']))
+                value['Value'] = decode_value(value['Value'])
+            self.cache.put(key, values[0].get('ModifyIndex', 0), values[0].get('Value'))
+            self._modify_indexes[key] = values[0].get('ModifyIndex')
             return values[0].get('Value')
         def not_found():
             logging.warning('Consul key-value store does not contain a value for key \'{0}\''.format(key))
+            self._modify_indexes[key] = 0
             return None
-        response = self._api_get('kv/{0}'.format(key))
+        is_cached, value = self.cache.get(key)
+        if is_cached:
+            return value
+        try:
+            response = self._api_read('service_definitions' if is_immutable_key(key) else None, 'kv/{0}'.format(key))
+        except CircuitOpenError as error:
+            return self._last_known_value(error, key)
+        cases = {200: decode, 404: not_found}
+        return cases[response.status_code]()
+
+    def get_values(self, key_prefix):
+        def decode():
+            values = OrderedDict()
+            for entry in response.json():
+                try:
+                    values[entry['Key']] = decode_value(entry['Value'])
+                    self.cache.put(entry['Key'], entry['ModifyIndex'], values[entry['Key']])
+                except ValueError as e:
+                    logging.warning('Consul key-value store contains an invalid value for key \'{0}\': {1}'.format(entry['Key'], e))
+            return values
+        def not_found():
+            logging.warning('Consul key-value store does not contain key prefix \'{0}\''.format(key_prefix))
+            return OrderedDict()
+        call_class = 'service_definitions' if SERVICE_VERSION_PREFIX_PATTERN.match(key_prefix) else 'key_listings'
+        try:
+            response = self._api_read(call_class, 'kv/{0}?recurse'.format(key_prefix), min_index=self._min_index([key_prefix]))
+        except CircuitOpenError as error:
+            return self._last_known_values(error, key_prefix)
         cases = {200: decode, 404: not_found}
         return cases[response.status_code]()
 
+    def get_values_batch(self, keys):
+        values = OrderedDict((key, None) for key in keys)
+        keys = []
+        for key in values.keys():
+            is_cached, values[key] = self.cache.get(key)
+            if not is_cached:
+                keys.append(key)
+        call_class = 'service_definitions' if all(is_immutable_key(key) for key in keys) else 'key_listings'
+        min_index = self._min_index(keys)
+        for i in range(0, len(keys), MAX_TRANSACTION_OPERATIONS):
+            pending = keys[i:i + MAX_TRANSACTION_OPERATIONS]
+            while pending:
+                try:
+                    response = self._api_read(call_class, 'txn', json.dumps([{'KV': {'Verb': 'get', 'Key': key}} for key in pending]), min_index)
+                except CircuitOpenError as e:
+                    for key in pending:
+                        values[key] = self._last_known_value(e, key)
+                    break
+                if response.status_code == 200:
+                    for result in response.json().get('Results') or []:
+                        entry = result['KV']
+                        try:
+                            values[entry['Key']] = decode_value(entry['Value'])
+                            self.cache.put(entry['Key'], entry['ModifyIndex'], values[entry['Key']])
+                        except ValueError as e:
+                            logging.warning('Consul key-value store contains an invalid value for key \'{0}\': {1}'.format(entry['Key'], e))
+                    break
+                # A 'get' on a missing key rolls back the whole transaction, so drop the failed operations and try again
+                failed_operations = [error.get('OpIndex') for error in (response.json().get('Errors') or [])] if response.status_code == 409 else []
+                missing_keys = [pending[index] for index in failed_operations if index is not None and index < len(pending)]
+                if not missing_keys:
+                    raise ConsulError('Consul HTTP API transaction failed. Response content: {0}'.format(response.text))
+                for key in missing_keys:
+                    logging.warning('Consul key-value store does not contain a value for key \'{0}\''.format(key))
+                pending = [key for key in pending if key not in missing_keys]
+        return values
+
     def key_exists(self, key):
         return self.get_value(key) is not None
 
-    def deregister_check(self, id):
-        response = self._api_put('agent/check/deregister/{0}'.format(id), {})
+    def _agent_put(self, identity, relative_url, content):
+        # While the circuit breaker is open, registrations are deferred and reported as successful, so that running deployments complete
+        try:
+            response = self._api_put(relative_url, content)
+        except CircuitOpenError as error:
+            with self._pending_writes_lock:
+                self._pending_registrations.pop(identity, None)
+                self._pending_registrations[identity] = (relative_url, content)
+            logging.warning('{0} {1} deferred until Consul recovers.'.format(error, relative_url))
+            return True
         return response.status_code == 200
 
+    def deregister_check(self, id):
+        return self._agent_put(('check', id), 'agent/check/deregister/{0}'.format(id), {})
+
     def register_http_check(self, service_id, id, name, url, interval, tls_skip_verify=False):
-        response = self._api_put('agent/check/register', json.dumps({'ServiceID': service_id, 'ID': id, 'Name': name, 'HTTP': url, 'TLSSkipVerify': tls_skip_verify, 'Interval': interval}))
-        return response.status_code == 200
+        return self._agent_put(('check', id), 'agent/check/register', json.dumps({'ServiceID': service_id, 'ID': id, 'Name': name, 'HTTP': url, 'TLSSkipVerify': tls_skip_verify, 'Interval': interval}))
 
     def register_script_check(self, service_id, id, name, script_path, interval):
-        response = self._api_put('agent/check/register', json.dumps({'ServiceID': service_id, 'ID': id, 'Name': name, 'Script': script_path, 'Interval': interval}))
-        return response.status_code == 200
+        return self._agent_put(('check', id), 'agent/check/register', json.dumps({'ServiceID': service_id, 'ID': id, 'Name': name, 'Script': script_path, 'Interval': interval}))
 
     def register_service(self, id, name, address, port, tags):
-        response = self._api_put('agent/service/register', json.dumps({'ID': id, 'Name': name, 'Address': address, 'Port': port, 'Tags': tags}))
+        return self._agent_put(('service', id), 'agent/service/register', json.dumps({'ID': id, 'Name': name, 'Address': address, 'Port': port, 'Tags': tags}))
+
+    def create_session(self, name, ttl_in_ms):
+        # Keys held by the session are deleted when it is destroyed or expires
+        session = {'Name': name, 'TTL': '{0}s'.format(max(ttl_in_ms // 1000, 10)), 'Behavior': 'delete', 'LockDelay': '0s'}
+        response = self._api_put('session/create', json.dumps(session))
+        if response.status_code != 200:
+            raise ConsulError('Failed to create Consul session \'{0}\'. Response content: {1}'.format(name, response.text))
+        return response.json()['ID']
+
+    def renew_session(self, session_id):
+        response = self._api_put('session/renew/{0}'.format(session_id), {})
         return response.status_code == 200
 
-    def wait_for_change(self, key_prefix):
-        modify_index = self._get_modify_index(key_prefix, False)
-        if modify_index is None:
-            self._last_known_modify_index = modify_index
-            #raise ConsulError('Modify index is invalid.')
-        if self._last_known_modify_index is None:
-            logging.info('There may be changes that have not been processed yet, skipping blocking query.')
-            self._last_known_modify_index = modify_index
-            return
-        self._last_known_modify_index = modify_index
-        logging.debug('Blocking query to Consul HTTP API to wait for changes in the \'{0}\' key space...'.format(key_prefix))
-        # TODO: Timeout by default is 5 minutes. This can be changed by adding wait=10s or wait=10m to the query string
-        self._api_get('kv/{0}?index={1}'.format(key_prefix, self._last_known_modify_index))
+    def destroy_session(self, session_id):
+        response = self._api_put('session/destroy/{0}'.format(session_id), {})
+        return response.status_code == 200
+
+    def acquire_key(self, key, value, session_id):
+        response = self._api_put('kv/{0}?acquire={1}'.format(key, session_id), json.dumps(value))
+        return response.status_code == 200 and response.json() is True
+
+    def compare_and_set(self, key, value, modify_index):
+        # Writes value only if the key has not changed since modify_index, 0 meaning that the key does not exist
+        return self._write_value(key, value, modify_index)
+
+    def watch_key_prefix(self, key_prefix, index=0, wait_in_ms=None):
+        query = 'kv/{0}?recurse&index={1}'.format(key_prefix, index)
+        if wait_in_ms is not None:
+            query += '&wait={0}ms'.format(wait_in_ms)
+        if index:
+            logging.debug('Blocking query to Consul HTTP API to wait for changes in the \'{0}\' key space after index {1}...'.format(key_prefix, index))
+        response = self._api_get(query, is_blocking=index > 0)
+        entries = response.json() if response.status_code == 200 else []
+        self.cache.refresh(key_prefix, entries, decode_value)
+        try:
+            new_index = int(response.headers.get('X-Consul-Index'))
+        except (TypeError, ValueError):
+            new_index = 0
+        self._watched_indexes[key_prefix.rstrip('/')] = new_index
+        return (new_index, entries)
+
+    def _write_value(self, key, value, modify_index):
+        operation = {'Verb': 'cas', 'Key': key, 'Value': base64.b64encode(json.dumps(value)), 'Index': int(modify_index or 0)}
+        response = self._api_put('txn', json.dumps([{'KV': operation}]))
+        if response.status_code != 200:
+            self._modify_indexes.pop(key, None)
+            return False
+        self._modify_indexes[key] = response.json()['Results'][0]['KV']['ModifyIndex']
+        return True
 
     def write_value(self, key, value):
-        modify_index = self._get_modify_index(key, True)
-        response = self._api_put('kv/{0}?cas={1}'.format(key, modify_index), json.dumps(value))
-        return response.text == 'true'
+        try:
+            return self._write_value_with_retry(key, value)
+        except CircuitOpenError as error:
+            with self._pending_writes_lock:
+                self._pending_writes.pop(key, None)
+                self._pending_writes[key] = copy.deepcopy(value)
+            logging.warning('{0} Write of key \'{1}\' queued until Consul recovers.'.format(error, key))
+            return False
+
+    def _write_value_with_retry(self, key, value):
+        modify_index = self._modify_indexes.get(key)
+        if modify_index is None:
+            modify_index = self._get_modify_index(key, True)
+        if self._write_value(key, value, modify_index):
+            return True
+        logging.debug('Check-and-set write of key \'{0}\' conflicted with another write, retrying with current modify index.'.format(key))
+        return self._write_value(key, value, self._get_modify_index(key, True))
@@ -1,63 +1,183 @@
 # Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
 
+import json
 import key_naming_convention
 import logging
+from multiprocessing.pool import ThreadPool
 from consul_api import ConsulError
 from server_role import ServerRole
 from actions import InstallAction, UninstallAction, IgnoreAction
 from service import Service
+from service_memo import ServiceMemo
+
+def read_priority(definition):
+    priority = definition.get('Priority')
+    try:
+        return int(priority) if priority is not None else 0
+    except (TypeError, ValueError):
+        logging.warning('Invalid Priority {0} of service \'{1}\', using 0.'.format(json.dumps(priority), definition.get('Name')))
+        return 0
+
+def read_depends_on(definition):
+    depends_on = definition.get('DependsOn')
+    if depends_on is None:
+        return []
+    if isinstance(depends_on, basestring):
+        return [depends_on]
+    if isinstance(depends_on, list) and all(isinstance(name, basestring) for name in depends_on):
+        return list(depends_on)
+    logging.warning('Invalid DependsOn {0} of service \'{1}\', ignoring it.'.format(json.dumps(depends_on), definition.get('Name')))
+    return []
 
 class ConsulDataLoader(object):
-    def __init__(self, consul_api):
+    def __init__(self, consul_api, recursive_reads=False, batch_reads=False, read_pool_size=1, service_memo_size=200):
         self._consul_api = consul_api
+        self._recursive_reads = recursive_reads
+        self._batch_reads = batch_reads
+        self._read_pool_size = read_pool_size
+        self.service_memo = ServiceMemo(service_memo_size)
+        # Actions of the last load by role key, with the keys and modify indexes they were built from
+        self._previous_actions = {}
+        self.last_diff = None
+
+    def _modify_indexes(self, *keys):
+        return tuple(self._consul_api.cache.modify_index(key) for key in keys)
 
-    def _load_service(self, environment, deployment_id, name, version, deployment_slice):
+    def _load_service(self, get_value, environment, deployment_id, name, version, deployment_slice):
         definition_key = key_naming_convention.get_service_definition_key(environment, name, version)
         installation_key = key_naming_convention.get_service_installation_key(environment, name, version)
-        definition = self._consul_api.get_value(definition_key).get('Service', {})
-        definition['Address'] = environment.ip_address
-        installation = self._consul_api.get_value(installation_key)
         consul_name = environment.environment_name + '-' + name + ('-' + deployment_slice if deployment_slice != 'none' else '')
+        memo_key = (environment.environment_name, name, version)
+        service = self.service_memo.get(memo_key, self._modify_indexes(definition_key, installation_key))
+        if service is not None:
+            service.id = service.name = consul_name
+            return service
+        definition = get_value(definition_key)
+        if definition is None:
+            raise ValueError('Service definition not found at key \'{0}\'.'.format(definition_key))
+        installation = get_value(installation_key)
+        if installation is None:
+            raise ValueError('Service installation not found at key \'{0}\'.'.format(installation_key))
+        definition = definition.get('Service', {})
+        definition['Address'] = environment.ip_address
         definition['ID'] = consul_name
-        return Service(definition, installation)
+        service = Service(definition, installation)
+        self.service_memo.put(memo_key, self._modify_indexes(definition_key, installation_key), service)
+        return service
+
+    def _read_server_role(self, environment, services_key):
+        # Bulk read the role, then the definition and installation of every distinct service version it references
+        if self._recursive_reads:
+            values = self._consul_api.get_values(services_key)
+        else:
+            values = self._consul_api.get_values_batch(self._consul_api.get_keys(services_key))
+        keys = values.keys()
+        service_versions = []
+        for definition in values.values():
+            if isinstance(definition, dict) and definition.get('Name') is not None and definition.get('Version') is not None:
+                service_version = (definition['Name'], definition['Version'])
+                if service_version not in service_versions:
+                    service_versions.append(service_version)
+        if self._batch_reads:
+            service_keys = []
+            for name, version in service_versions:
+                service_keys.append(key_naming_convention.get_service_definition_key(environment, name, version))
+                service_keys.append(key_naming_convention.get_service_installation_key(environment, name, version))
+            values.update(self._consul_api.get_values_batch(service_keys))
+        else:
+            for name, version in service_versions:
+                service_keys = (key_naming_convention.get_service_definition_key(environment, name, version),
+                                key_naming_convention.get_service_installation_key(environment, name, version))
+                # Definitions and installations never change once written, a service version whose keys are cached needs no request
+                cached = [self._consul_api.cache.get(key) for key in service_keys]
+                if all(is_cached for is_cached, value in cached):
+                    values.update(zip(service_keys, [value for is_cached, value in cached]))
+                else:
+                    values.update(self._consul_api.get_values(key_naming_convention.get_service_key(environment, name, version)))
+        return (keys, values.get)
+
+    def _load_action(self, get_value, environment, key):
+        name = version = deployment_id = None
+        try:
+            definition = get_value(key)
+            if not isinstance(definition, dict):
+                raise ValueError('Server role entry not found or invalid at key \'{0}\'.'.format(key))
+            name = definition.get('Name')
+            version = definition.get('Version')
+            deployment_id = definition.get('DeploymentId')
+            deployment_slice = definition.get('Slice', 'none')
+
+            # If Action isn't specified, we assume it's Install for backward compatibility for now
+            deployment_action = definition.get('Action', 'Install')
+            service = self._load_service(get_value, environment, deployment_id, name, version, deployment_slice)
+            service.deployment_id = deployment_id
+            service.slice = deployment_slice
+            service.tag('deployment_id:', deployment_id)
+            service.tag('server_role:', environment.server_role)
+            service.tag('slice:', deployment_slice)
+
+            if deployment_slice is not None and deployment_slice != 'none':
+                service.port = service.portsConfig[deployment_slice]
+            else:
+                service.port = min([service.portsConfig['blue'], service.portsConfig['green']])
+
+            service_keys = (key, key_naming_convention.get_service_definition_key(environment, name, version),
+                            key_naming_convention.get_service_installation_key(environment, name, version))
+            action_types = {'Install': InstallAction, 'Uninstall': UninstallAction, 'Ignore': IgnoreAction}
+            if deployment_action in action_types:
+                action = action_types[deployment_action](deployment_id, service)
+                action.service_name = name
+                action.priority = read_priority(definition)
+                action.depends_on = read_depends_on(definition)
+                return (action, service_keys)
+            else:
+                logging.warning('Unknown deployment action \'{0}\', will ignore it.'.format(deployment_action))
+
+        except (ConsulError, ValueError) as e:
+            logging.exception(e)
+            logging.warning('Failed to read service from Consul, will ignore. [name: {0} version: {1} deployment_id: {2}]'.format(name, version, deployment_id))
+        return (None, None)
+
+    def _load_action_incrementally(self, get_value, environment, key):
+        previous = self._previous_actions.get(key)
+        if previous is not None:
+            service_keys, modify_indexes, action = previous
+            if self._modify_indexes(*service_keys) == modify_indexes:
+                return (action, previous, True)
+        action, service_keys = self._load_action(get_value, environment, key)
+        if action is None:
+            return (None, None, False)
+        modify_indexes = self._modify_indexes(*service_keys)
+        return (action, (service_keys, modify_indexes, action) if None not in modify_indexes else None, False)
 
     def load_server_role(self, environment):
         server_role = ServerRole(environment.server_role)
         services_key = key_naming_convention.get_server_role_services_key(environment)
-        for key in self._consul_api.get_keys(services_key):
+        if self._recursive_reads or self._batch_reads:
+            keys, get_value = self._read_server_role(environment, services_key)
+        else:
+            keys, get_value = self._consul_api.get_keys(services_key), self._consul_api.get_value
+        load_action = lambda key: self._load_action_incrementally(get_value, environment, key)
+        if self._read_pool_size > 1 and len(keys) > 1 and not (self._recursive_reads or self._batch_reads):
+            # Each service costs up to three requests in per-key mode, load them concurrently. map keeps the key order.
+            pool = ThreadPool(min(self._read_pool_size, len(keys)))
             try:
-                definition = self._consul_api.get_value(key)
-                name = definition.get('Name')
-                version = definition.get('Version')
-                deployment_id = definition.get('DeploymentId')
-                deployment_slice = definition.get('Slice', 'none')
-
-                # If Action isn't specified, we assume it's Install for backward compatibility for now
-                deployment_action = definition.get('Action', 'Install')
-                service = self._load_service(environment, deployment_id, name, version, deployment_slice)
-                service.deployment_id = deployment_id
-                service.slice = deployment_slice
-                service.tag('deployment_id:', deployment_id)
-                service.tag('server_role:', environment.server_role)
-                service.tag('slice:', deployment_slice)
-                
-                if deployment_slice is not None and deployment_slice != 'none':
-                    service.port = service.portsConfig[deployment_slice]
-                else:
-                    service.port = min([service.portsConfig['blue'], service.portsConfig['green']])
-
-                if deployment_action == 'Install':
-                    server_role.actions.append(InstallAction(deployment_id, service))
-                elif deployment_action == 'Uninstall':
-                    server_role.actions.append(UninstallAction(deployment_id, service))
-                elif deployment_action == 'Ignore':
-                    server_role.actions.append(IgnoreAction(deployment_id, service))
-                else:
-                    logging.warning('Unknown deployment action \'{0}\', will ignore it.'.format(deployment_action))
-
-            except (ConsulError, ValueError) as e:
-                logging.exception(e)
-                logging.warning('Failed to read service from Consul, will ignore. [name: {0} version: {1} deployment_id: {2}]'.format(name, version, deployment_id))
+                results = pool.map(load_action, keys)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [load_action(key) for key in keys]
+        previous_actions, self._previous_actions = self._previous_actions, {}
+        diff = {'added': 0, 'removed': len(set(previous_actions.keys()) - set(keys)), 'changed': 0, 'unchanged': 0}
+        for key, (action, state, is_unchanged) in zip(keys, results):
+            diff['unchanged' if is_unchanged else 'changed' if key in previous_actions else 'added'] += 1
+            if action is not None:
+                server_role.actions.append(action)
+            if state is not None:
+                self._previous_actions[key] = state
+        logging.info('Server role services: {added} added, {removed} removed, {changed} changed, {unchanged} unchanged.'.format(**diff))
+        self.last_diff = diff
         return server_role
 
     def load_service_catalogue(self):
@@ -0,0 +1,99 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import logging, sys, threading, time
+from consul_api import decode_value
+
+class ConsulSemaphore(object):
+    # Semaphore on Consul sessions: each contender holds a key under key_prefix with its own session and the .lock key lists
+    # the sessions holding a slot. Slots of sessions that are gone are reclaimed. Any failure lets the caller through (fails open).
+    def __init__(self, consul_api, key_prefix, limit, name='consul-deployment-agent', session_ttl_in_ms=30000, wait_timeout_in_ms=600000, blocking_query_wait_in_ms=60000):
+        self._consul_api = consul_api
+        self._key_prefix = key_prefix.rstrip('/')
+        self._lock_key = '{0}/.lock'.format(self._key_prefix)
+        self._limit = limit
+        self._name = name
+        self._session_ttl_in_ms = session_ttl_in_ms
+        self._wait_timeout = wait_timeout_in_ms / 1000.0
+        self._blocking_query_wait_in_ms = blocking_query_wait_in_ms
+        self._session_id = None
+        self._is_released = threading.Event()
+        self.is_held = False
+
+    def _renew_session(self, session_id):
+        while not self._is_released.wait(self._session_ttl_in_ms / 2000.0):
+            try:
+                if not self._consul_api.renew_session(session_id):
+                    logging.warning('Consul session {0} of semaphore \'{1}\' expired.'.format(session_id, self._key_prefix))
+                    return
+            except:
+                logging.exception(sys.exc_info()[1])
+
+    def _read(self, index=0, wait_in_ms=None):
+        return self._consul_api.watch_key_prefix(self._key_prefix + '/', index, wait_in_ms)
+
+    def _try_to_take_slot(self, entries):
+        lock_entry = next((entry for entry in entries if entry.get('Key') == self._lock_key), None)
+        lock = decode_value(lock_entry.get('Value')) if lock_entry is not None else None
+        holders = (lock or {}).get('Holders') or []
+        # Slots of contenders whose session is gone are free again
+        live_sessions = set(entry.get('Session') for entry in entries if entry.get('Key') != self._lock_key and entry.get('Session'))
+        holders = [holder for holder in holders if holder in live_sessions]
+        if self._session_id in holders:
+            return True
+        if len(holders) >= self._limit:
+            return False
+        holders.append(self._session_id)
+        modify_index = lock_entry.get('ModifyIndex') if lock_entry is not None else 0
+        return self._consul_api.compare_and_set(self._lock_key, {'Limit': self._limit, 'Holders': holders}, modify_index)
+
+    def acquire(self):
+        # Returns True once a slot is held, False if the semaphore could not be used or the wait timed out
+        deadline = time.time() + self._wait_timeout
+        try:
+            self._session_id = self._consul_api.create_session(self._name, self._session_ttl_in_ms)
+            renewal = threading.Thread(target=self._renew_session, args=(self._session_id,), name='semaphore-session-{0}'.format(self._session_id))
+            renewal.daemon = True
+            renewal.start()
+            if not self._consul_api.acquire_key('{0}/{1}'.format(self._key_prefix, self._session_id), {'Name': self._name}, self._session_id):
+                raise RuntimeError('Failed to register as contender of semaphore \'{0}\'.'.format(self._key_prefix))
+            index, entries = self._read()
+            while True:
+                if self._try_to_take_slot(entries):
+                    self.is_held = True
+                    logging.debug('Acquired a slot of semaphore \'{0}\' limited to {1}.'.format(self._key_prefix, self._limit))
+                    return True
+                remaining_in_ms = int((deadline - time.time()) * 1000)
+                if remaining_in_ms <= 0:
+                    logging.warning('Timed out waiting for a slot of semaphore \'{0}\', proceeding without it.'.format(self._key_prefix))
+                    self.release()
+                    return False
+                # Wait for a holder to leave, or retry at once if the lock was updated concurrently
+                index, entries = self._read(index, min(remaining_in_ms, self._blocking_query_wait_in_ms))
+        except:
+            logging.warning('Failed to acquire semaphore \'{0}\', proceeding without it.'.format(self._key_prefix))
+            logging.exception(sys.exc_info()[1])
+            self.release()
+            return False
+
+    def release(self):
+        if self._session_id is None:
+            return
+        session_id, self._session_id = self._session_id, None
+        self._is_released.set()
+        try:
+            if self.is_held:
+                # Other contenders would reclaim the slot anyway once the session is destroyed, this only frees it sooner
+                for _ in range(3):
+                    index, entries = self._read()
+                    lock_entry = next((entry for entry in entries if entry.get('Key') == self._lock_key), None)
+                    if lock_entry is None:
+                        break
+                    lock = decode_value(lock_entry.get('Value')) or {}
+                    holders = [holder for holder in lock.get('Holders') or [] if holder != session_id]
+                    if self._consul_api.compare_and_set(self._lock_key, dict(lock, Holders=holders), lock_entry.get('ModifyIndex')):
+                        break
+            self._consul_api.destroy_session(session_id)
+        except:
+            logging.warning('Failed to release semaphore \'{0}\', its session will expire.'.format(self._key_prefix))
+            logging.exception(sys.exc_info()[1])
+        self.is_held = False
@@ -0,0 +1,41 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import logging
+
+class ConsulWatcher(object):
+    def __init__(self, consul_api, key_prefix, wait_in_ms=300000):
+        self._consul_api = consul_api
+        self.key_prefix = key_prefix
+        self.wait_in_ms = wait_in_ms
+        self.index = 0
+        self.entries = []
+
+    def _update(self, index, entries):
+        if index < self.index:
+            logging.info('Consul index for \'{0}\' went backwards from {1} to {2}, resetting.'.format(self.key_prefix, self.index, index))
+        # Consul never returns index 0 once the key space has been written, treat it as the lowest valid index
+        self.index = max(index, 1)
+        self.entries = entries
+
+    def prime(self):
+        index, entries = self._consul_api.watch_key_prefix(self.key_prefix)
+        self._update(index, entries)
+        logging.debug('Watching \'{0}\' key space from index {1}.'.format(self.key_prefix, self.index))
+        return self.index
+
+    def poll(self):
+        index, entries = self._consul_api.watch_key_prefix(self.key_prefix, self.index, self.wait_in_ms)
+        if index == self.index:
+            logging.debug('No change in \'{0}\' key space before blocking query timeout.'.format(self.key_prefix))
+            return False
+        self._update(index, entries)
+        return True
+
+    def wait_for_change(self):
+        while not self.poll():
+            pass
+        return self.index
+
+    def changes(self):
+        while True:
+            yield self.wait_for_change()
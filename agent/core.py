@@ -2,13 +2,24 @@
 
 import argparse, logging, logging.config, os.path, platform, sys, yaml
 import key_naming_convention
-from consul_api import ConsulApi, ConsulError
+from consul_api import ConsulApi, ConsulError, decode_value
 from consul_data_loader import ConsulDataLoader
-from deployment import Deployment
+from role_change_filter import RoleChangeFilter
+from service_registry import ServiceRegistry
+from snapshot import Snapshot, is_up_to_date
+from watch_manager import WatchManager
+from deployment import Deployment, LINUX_BASE_DIR, WINDOWS_BASE_DIR
+from bundle_prefetcher import BundlePrefetcher
+from deployment_executor import DeploymentExecutor, get_action_resources
+from duration_history import DurationHistory, ORDERING_POLICIES
+from incremental_planner import IncrementalPlanner
 from environment import Environment, EnvironmentError
 from retrying import retry, RetryError
+from retry_policy import RetryPolicy
 from actions import InstallAction, IgnoreAction, UninstallAction
 from block_check import BlockCheckService
+from consul_semaphore import ConsulSemaphore
+from s3_file_manager import S3FileManager
 
 try:
     from version import semantic_version
@@ -18,10 +29,14 @@ except:
 parser = argparse.ArgumentParser()
 parser.add_argument('-config-dir', help='Location of configuration files (e.g. config.yml and config-logging.yml)')
 parser.add_argument('-v', '--version', action='version', version=semantic_version)
+parser.add_argument('--plan', action='store_true', help='Print the pending deployment actions with their estimated duration and download size, without deploying anything')
 
 config = {
     'aws': {'access_key_id': None, 'aws_secret_access_key': None, 'deployment_logs': {'bucket_name': None, 'key_prefix': None }},
-    'consul': {'host': 'localhost', 'port': 8500, 'scheme': 'http', 'acl_token': None, 'version': 'v1'},
+    'consul': {'host': 'localhost', 'port': 8500, 'scheme': 'http', 'socket_path': None, 'acl_token': None, 'version': 'v1', 'pool_size': 10, 'recursive_reads': False, 'batch_reads': False, 'read_pool_size': 1, 'service_memo_size': 200, 'catalogue_sync_interval_in_ms': None, 'blocking_query_wait_in_ms': 300000, 'watch_debounce_in_ms': 1000, 'watch_max_delay_in_ms': 10000, 'cache_size': 1000, 'report_write_delay_in_ms': 1000, 'consistency': {}, 'circuit_breaker': {}},
+    'deployment': {'max_workers': 1, 'ordering': 'role', 'duration_history_filepath': None, 'prefetch_bundles': 0, 'prefetch_max_disk_usage_in_mb': 1024, 'prefetch_directory': None,
+                   'download_semaphore': {'limit': 0, 'session_ttl_in_ms': 30000, 'wait_timeout_in_ms': 600000}},
+    'retry': {'converge_stagger_in_ms': 0},
     'sensu': {
         'healthcheck_search_paths': ['/etc/some_fake_path', '/opt/sensu_server_scripts'],
         'sensu_check_path': '/etc/sensu/conf.d/checks.local'
@@ -43,6 +58,7 @@ config = {
         'delay_in_ms_between_readiness_check': 5000,
         'max_wait_for_instance_readiness_in_ms': 1800000,
         'semaphore_filepath': None,
+        'snapshot_filepath': None,
         'wait_for_instance_readiness': False
     }
 }
@@ -58,6 +74,17 @@ def load_configuration(args):
         config_settings = yaml.load(file(config_filepath, 'r'))
         if 'sensu' in config_settings and config_settings['sensu'] is not None:
             config['sensu'] = config_settings['sensu']
+        if 'deployment' in config_settings and config_settings['deployment'] is not None:
+            config['deployment']['max_workers'] = config_settings['deployment'].get('max_workers', config['deployment']['max_workers'])
+            config['deployment']['ordering'] = config_settings['deployment'].get('ordering', config['deployment']['ordering'])
+            config['deployment']['duration_history_filepath'] = config_settings['deployment'].get('duration_history_filepath')
+            for setting in ['prefetch_bundles', 'prefetch_max_disk_usage_in_mb', 'prefetch_directory']:
+                config['deployment'][setting] = config_settings['deployment'].get(setting, config['deployment'][setting])
+            config['deployment']['download_semaphore'].update(config_settings['deployment'].get('download_semaphore') or {})
+            if config['deployment']['ordering'] not in ORDERING_POLICIES:
+                raise ValueError('Deployment ordering must be one of {0}.'.format(', '.join(ORDERING_POLICIES)))
+        if 'retry' in config_settings and config_settings['retry'] is not None:
+            config['retry'] = config_settings['retry']
         if 'aws' in config_settings and config_settings['aws'] is not None:
             config['aws']['access_key_id'] = config_settings['aws'].get('access_key_id')
             config['aws']['aws_secret_access_key'] = config_settings['aws'].get('aws_secret_access_key')
@@ -66,8 +93,24 @@ def load_configuration(args):
                 config['aws']['deployment_logs']['key_prefix'] = config_settings['aws']['deployment_logs'].get('key_prefix')
         if 'consul' in config_settings and config_settings['consul'] is not None:
             config['consul']['acl_token'] = config_settings['consul'].get('acl_token')
+            for setting in ['host', 'port', 'scheme', 'socket_path']:
+                config['consul'][setting] = config_settings['consul'].get(setting, config['consul'][setting])
+            config['consul']['pool_size'] = config_settings['consul'].get('pool_size', config['consul']['pool_size'])
+            config['consul']['recursive_reads'] = config_settings['consul'].get('recursive_reads', False)
+            config['consul']['batch_reads'] = config_settings['consul'].get('batch_reads', False)
+            config['consul']['read_pool_size'] = config_settings['consul'].get('read_pool_size', config['consul']['read_pool_size'])
+            config['consul']['catalogue_sync_interval_in_ms'] = config_settings['consul'].get('catalogue_sync_interval_in_ms')
+            config['consul']['service_memo_size'] = config_settings['consul'].get('service_memo_size', config['consul']['service_memo_size'])
+            config['consul']['blocking_query_wait_in_ms'] = config_settings['consul'].get('blocking_query_wait_in_ms', config['consul']['blocking_query_wait_in_ms'])
+            config['consul']['watch_debounce_in_ms'] = config_settings['consul'].get('watch_debounce_in_ms', config['consul']['watch_debounce_in_ms'])
+            config['consul']['watch_max_delay_in_ms'] = config_settings['consul'].get('watch_max_delay_in_ms', config['consul']['watch_max_delay_in_ms'])
+            config['consul']['cache_size'] = config_settings['consul'].get('cache_size', config['consul']['cache_size'])
+            config['consul']['report_write_delay_in_ms'] = config_settings['consul'].get('report_write_delay_in_ms', config['consul']['report_write_delay_in_ms'])
+            config['consul']['consistency'] = config_settings['consul'].get('consistency') or {}
+            config['consul']['circuit_breaker'] = config_settings['consul'].get('circuit_breaker') or {}
         if 'startup' in config_settings and config_settings['startup'] is not None:
             config['startup']['semaphore_filepath'] = config_settings['startup'].get('semaphore_filepath')
+            config['startup']['snapshot_filepath'] = config_settings['startup'].get('snapshot_filepath')
             config['startup']['wait_for_instance_readiness'] = config_settings['startup'].get('wait_for_instance_readiness', False)
     if os.path.isfile(config_logging_filepath):
         config['logging'] = yaml.load(file(config_logging_filepath, 'r'))
@@ -98,16 +141,41 @@ def wait_for_instance_readiness(config):
     except RetryError:
         logging.warning('Instance readiness timeout has been reached, will assume instance is ready for deployments.')
 
-def execute(action, action_info, environment, consul_api):
+def estimate_duration(action, duration_history):
+    # Ignore and uninstall actions do not deploy anything
+    if not isinstance(action, InstallAction):
+        return 0
+    return duration_history.estimate_in_ms(action.service.id)
+
+def get_download_size(action, s3_file_manager):
+    if not isinstance(action, InstallAction):
+        return 0
+    return s3_file_manager.get_file_size(action.service.installation['package_bucket'], action.service.installation['package_key'])
+
+def get_download_semaphore_factory(environment, consul_api):
+    settings = config['deployment']['download_semaphore']
+    if not settings['limit']:
+        return None
+    key_prefix = key_naming_convention.get_download_semaphore_key(environment)
+    return lambda: ConsulSemaphore(consul_api, key_prefix, settings['limit'], 'consul-deployment-agent-{0}'.format(environment.instance_id),
+                                   settings['session_ttl_in_ms'], settings['wait_timeout_in_ms'], config['consul']['blocking_query_wait_in_ms'])
+
+def execute(action, action_info, environment, consul_api, service_registry, duration_history, bundle_prefetcher):
     if isinstance(action, InstallAction):
         deployment_config = {
+            'bundle_prefetcher': bundle_prefetcher,
             'cause': 'Deployment',
+            'create_download_semaphore': get_download_semaphore_factory(environment, consul_api),
             'deployment_id': action.deployment_id,
+            'duration_history': duration_history,
             'environment': environment,
             'last_deployment_id': action_info['last_deployment_id'],
             'platform': platform.system().lower(),
+            'report_write_delay_in_ms': config['consul']['report_write_delay_in_ms'],
+            'retry_policy': consul_api.retry_policy,
             'sensu': config['sensu'],
-            'service': action.service
+            'service': action.service,
+            'service_registry': service_registry
         }
         deployment = Deployment(config=deployment_config, consul_api=consul_api, aws_config=config['aws'])
         return deployment.run()
@@ -118,31 +186,82 @@ def execute(action, action_info, environment, consul_api):
         logging.info('Uninstall action not yet supported!')
         return {'id': action.deployment_id, 'is_success': True}
 
-def converge(consul_api, environment):
+def converge(consul_api, environment, data_loader, planner, service_registry, duration_history, bundle_prefetcher=None):
+    # Returns whether the converge completed, and whether every planned action is applied. Failed deployments are only quarantined.
     try:
-        data_loader = ConsulDataLoader(consul_api)
         server_role = data_loader.load_server_role(environment)
-        registered_services = data_loader.load_service_catalogue()
+        # The registry is checked against the Consul catalogue once per converge, then kept up to date by the deployments
+        service_registry.sync()
+        registered_services = service_registry.services()
         logging.debug('Registered services:')
         for service in registered_services:
             logging.debug(service)
 
         logging.info('Start converging to server role configuration.')
-        missing_action = server_role.find_action_to_execute(registered_services)
-        while missing_action is not None:
-            action, action_info = missing_action
-            report = execute(action, action_info, environment, consul_api)
-            # if not report['is_success']:
-            server_role.quarantine_action(report['id'])
-            missing_action = server_role.find_action_to_execute(data_loader.load_service_catalogue())
+        actions = server_role.actions
+        server_role.actions = planner.actions_to_plan(server_role, registered_services)
+        def prefetch(waiting_actions, running_actions):
+            bundle_prefetcher.prefetch([action for action in waiting_actions if isinstance(action, InstallAction)], running_actions)
+        executor = DeploymentExecutor(lambda action, action_info: execute(action, action_info, environment, consul_api, service_registry, duration_history, bundle_prefetcher),
+                                      config['deployment']['max_workers'], lambda action, action_info: get_action_resources(action, action_info, platform.system().lower()),
+                                      get_duration_estimator(duration_history), prefetch if bundle_prefetcher is not None else None)
+        is_applied = executor.run(server_role, service_registry.services)
+        planner.record(actions, service_registry.services())
 
         logging.info('Finished converging to server role configuration.')
-        return True
+        logging.debug('Consul HTTP API connection reuse rate: {0:.2f}'.format(consul_api.connection_reuse_rate))
+        logging.debug('Consul key-value cache hits: {0}, misses: {1}'.format(consul_api.cache.hits, consul_api.cache.misses))
+        logging.debug('Service memo hits: {0}, misses: {1}'.format(data_loader.service_memo.hits, data_loader.service_memo.misses))
+        if bundle_prefetcher is not None:
+            logging.debug('Prefetched bundle hits: {0}, misses: {1}'.format(bundle_prefetcher.number_of_hits, bundle_prefetcher.number_of_misses))
+        return (True, is_applied)
     except:
         logging.exception(sys.exc_info()[1])
-        return False
+        return (False, False)
+
+def get_duration_estimator(duration_history):
+    if config['deployment']['ordering'] != 'shortest_first':
+        return None
+    return lambda action: estimate_duration(action, duration_history)
 
-def main():
+def print_plan(consul_api, environment, data_loader, duration_history):
+    server_role = data_loader.load_server_role(environment)
+    pending_actions = server_role.plan(data_loader.load_service_catalogue(), get_duration_estimator(duration_history))
+    s3_file_manager = S3FileManager(config['aws'], consul_api.retry_policy)
+    print('Deployment plan of server role \'{0}\' ({1} ordering), {2} actions pending:'.format(server_role.id, config['deployment']['ordering'], len(pending_actions)))
+    for action, action_info in pending_actions:
+        estimated_duration = estimate_duration(action, duration_history)
+        download_size = get_download_size(action, s3_file_manager)
+        print('  {0} {1} {2}: estimated duration {3}, download {4}'.format(
+            type(action).__name__, action.service.id, action.deployment_id,
+            '{0} ms'.format(estimated_duration) if estimated_duration is not None else 'unknown',
+            '{0} bytes'.format(download_size) if download_size is not None else 'unknown'))
+
+def create_bundle_prefetcher(environment, consul_api):
+    if not config['deployment']['prefetch_bundles']:
+        return None
+    base_dir = LINUX_BASE_DIR if platform.system().lower() == 'linux' else WINDOWS_BASE_DIR
+    directory = config['deployment']['prefetch_directory'] or base_dir + '-prefetch'
+    return BundlePrefetcher(S3FileManager(config['aws'], consul_api.retry_policy), directory, config['deployment']['prefetch_bundles'],
+                            config['deployment']['prefetch_max_disk_usage_in_mb'], get_download_semaphore_factory(environment, consul_api))
+
+def get_watched_key_prefixes(environment, role_entries):
+    # The server role and the definition and installation of every service version it refers to
+    key_prefixes = [key_naming_convention.get_server_role_key(environment)]
+    services_prefix = key_naming_convention.get_server_role_services_key(environment) + '/'
+    for entry in role_entries:
+        if not entry.get('Key', '').startswith(services_prefix):
+            continue
+        try:
+            definition = decode_value(entry.get('Value'))
+            key_prefix = key_naming_convention.get_service_key(environment, definition.get('Name'), definition.get('Version')) + '/'
+        except (AttributeError, ValueError):
+            continue
+        if key_prefix not in key_prefixes:
+            key_prefixes.append(key_prefix)
+    return key_prefixes
+
+def main(is_plan_only=False):
     logging.config.dictConfig(config['logging'])
     logging.info('Start initialisation, consul-deployment-agent version: {0}'.format(semantic_version))
     try:
@@ -154,39 +273,88 @@ def main():
         sys.exit(1)
 
     try:
-        consul_api = ConsulApi(config['consul'])
+        consul_api = ConsulApi(config['consul'], RetryPolicy(config['retry']))
         consul_api.check_connectivity()
     except ConsulError as error:
         logging.exception(error)
         logging.critical('Exiting with error code 1.')
         sys.exit(1)
 
+    # Created once so that parsed services are reused across converges
+    data_loader = ConsulDataLoader(consul_api, recursive_reads=config['consul']['recursive_reads'], batch_reads=config['consul']['batch_reads'],
+                                   read_pool_size=config['consul']['read_pool_size'], service_memo_size=config['consul']['service_memo_size'])
+    duration_history = DurationHistory(config['deployment']['duration_history_filepath'])
+    if is_plan_only:
+        print_plan(consul_api, environment, data_loader, duration_history)
+        return
+
     if config['startup']['wait_for_instance_readiness']:
         wait_for_instance_readiness(config)
 
-    b = BlockCheckService()
+    b = BlockCheckService(consul_api=consul_api)
     b.register_block()
 
-    if converge(consul_api, environment):
+    server_role_key = key_naming_convention.get_server_role_key(environment)
+    watch_manager = WatchManager(consul_api, config['consul']['blocking_query_wait_in_ms'], config['consul']['watch_debounce_in_ms'], config['consul']['watch_max_delay_in_ms'])
+    watcher = watch_manager.add(server_role_key)
+    planner = IncrementalPlanner()
+    bundle_prefetcher = create_bundle_prefetcher(environment, consul_api)
+    service_registry = ServiceRegistry(data_loader.load_service_catalogue, config['consul']['catalogue_sync_interval_in_ms'])
+    change_filter = RoleChangeFilter(key_naming_convention.get_server_role_services_key(environment))
+    snapshot = Snapshot(config['startup']['snapshot_filepath']) if config['startup']['snapshot_filepath'] else None
+    last_state = snapshot.load(server_role_key) if snapshot is not None else None
+    if last_state is not None:
+        for key, modify_index, value in last_state.get('entries') or []:
+            consul_api.cache.put(key, modify_index, value)
+    try:
+        # Record the index before converging so that changes made during initialisation are not missed
+        watcher.prime()
+        change_filter.prime(watcher.entries)
+    except ConsulError as error:
+        logging.exception(error)
+
+    def converge_and_save(role_index, role_digest):
+        # The watcher keeps polling during the converge, only the index and digest seen before it started are known to be converged
+        is_success, is_applied = converge(consul_api, environment, data_loader, planner, service_registry, duration_history, bundle_prefetcher)
+        if not is_success:
+            # Retry on the next notification even if the desired state has not changed
+            change_filter.reset()
+        if snapshot is not None:
+            # Failed deployments are retried on restart, so the initial converge is only skipped once every action is applied
+            snapshot.save(server_role_key, role_index, role_digest, is_applied, consul_api.cache.immutable_entries())
+        return is_success
+
+    role_index, role_digest = watcher.index, change_filter.digest
+    if is_up_to_date(last_state, role_index, role_digest):
+        logging.info('Server role unchanged since last successful converge at index {0}, skipping initial converge.'.format(last_state['role_index']))
+        logging.info('Initialisation completed.')
+    elif converge_and_save(role_index, role_digest):
         logging.info('Initialisation completed.')
     else:
         logging.error('Initialisation failed.')
 
-    server_role_key = key_naming_convention.get_server_role_key(environment)
+    # Wake-ups suppressed by the change filter are saved converges too, so converges are counted here rather than by the coalescer
+    number_of_converges = 0
     while True:
-        try:
-            consul_api.wait_for_change(server_role_key)
-            logging.info('Change detected in Consul {0} key space.'.format(server_role_key))
-            logging.info('Start converging to updated server role configuration...')
-            if converge(consul_api, environment):
-                logging.info('Finished converging to updated server role configuration.')
-            else:
-                logging.error('Failed to converge to updated server role configuration.')
-        except ConsulError as error:
-            logging.error('Error detecting changes in Consul key-value store. Skipping converging configuration.')
-            logging.exception(error)
+        watch_manager.watch(get_watched_key_prefixes(environment, watcher.entries))
+        changed_prefixes = watch_manager.wait_for_change()
+        # Read before the entries, so that the saved index is never newer than the state that was converged
+        role_index = watcher.index
+        is_role_changed = server_role_key in changed_prefixes and change_filter.has_changed(watcher.entries)
+        if not is_role_changed and not changed_prefixes - set([server_role_key]):
+            continue
+        # Every instance in the role is notified at once, spread their Consul and S3 requests
+        consul_api.retry_policy.stagger(environment.instance_id)
+        logging.info('Start converging to updated server role configuration...')
+        number_of_converges += 1
+        if converge_and_save(role_index, change_filter.digest):
+            logging.info('Finished converging to updated server role configuration.')
+        else:
+            logging.error('Failed to converge to updated server role configuration.')
+        number_of_notifications = watch_manager.coalescer.number_of_notifications
+        logging.info('{0} change notifications triggered {1} converges, {2} converges saved.'.format(number_of_notifications, number_of_converges, number_of_notifications - number_of_converges))
 
 if __name__ == '__main__':
     args = parser.parse_args()
     config = load_configuration(args)
-    main()
+    main(args.plan)
@@ -6,7 +6,7 @@ import key_naming_convention
 import logging
 import os
 import sys
-from consul_api import ConsulError
+import time
 from deployment_stages import CheckDiskSpace, ValidateDeployment, StopApplication, DownloadBundleFromS3, ValidateBundle, BeforeInstall, \
     CopyFiles, ApplyPermissions, AfterInstall, StartApplication, ValidateService, RegisterWithConsul, \
     DeregisterOldConsulHealthChecks, RegisterConsulHealthChecks, DeregisterOldSensuHealthChecks, \
@@ -14,6 +14,16 @@ from deployment_stages import CheckDiskSpace, ValidateDeployment, StopApplicatio
 from s3_file_manager import S3FileManager
 from version import semantic_version
 from find_deployment import find_deployment_dir_win
+from report_writer import ReportWriter
+
+LINUX_BASE_DIR = '/opt/consul-deployment-agent/deployments'
+WINDOWS_BASE_DIR = 'C:\TLDeploy'
+
+def find_deployment_dir(platform, service_id, deployment_id):
+    if platform == 'linux':
+        deployment_dir = os.path.join(LINUX_BASE_DIR, service_id, deployment_id)
+        return deployment_dir if os.path.isdir(deployment_dir) else None
+    return find_deployment_dir_win(WINDOWS_BASE_DIR, service_id, deployment_id)
 
 
 class Deployment(object):
@@ -35,10 +45,16 @@ class Deployment(object):
         self.id = config.get('deployment_id')
         self.last_id = config.get('last_deployment_id')
         self.max_number_of_attempts = config.get('max_number_of_attempts', 1)
+        self._report_write_delay_in_ms = config.get('report_write_delay_in_ms', 1000)
+        self._report_writer = None
         self.platform = config.get('platform')
         self.sensu = config.get('sensu')
-        self.s3_file_manager = S3FileManager(self._aws_config)
+        self.s3_file_manager = S3FileManager(self._aws_config, config.get('retry_policy'))
         self.service = config.get('service')
+        self.service_registry = config.get('service_registry')
+        self.duration_history = config.get('duration_history')
+        self.bundle_prefetcher = config.get('bundle_prefetcher')
+        self.create_download_semaphore = config.get('create_download_semaphore')
         self.timeout = self.service.installation['timeout']
         self._is_success = self.logger = self._log_filename = self._log_filepath = self._report = self._report_key = None
         self.number_of_attempts = 0
@@ -62,7 +78,7 @@ class Deployment(object):
                        DeletePreviousDeploymentFiles()]
 
         if self.platform == 'linux':
-            base_dir = '/opt/consul-deployment-agent/deployments'
+            base_dir = LINUX_BASE_DIR
             self.base_dir = base_dir
             self.dir = os.path.join(base_dir, self.service.id, self.id)
             if self.last_id is not None:
@@ -70,7 +86,7 @@ class Deployment(object):
                     base_dir, self.service.id, self.last_id)
                 self.last_archive_dir = os.path.join(self.last_dir, 'archive')
         else:
-            base_dir = 'C:\TLDeploy'
+            base_dir = WINDOWS_BASE_DIR
             self.base_dir = base_dir
             self.dir = os.path.join(base_dir, self.service.id, self.id)
             if self.last_id is not None:
@@ -207,12 +223,17 @@ class Deployment(object):
         update_if_specified(self._report, 'Status', updates.get('status'))
         logging.debug('Report updated: %s' % self._report)
         if write_to_consul:
-            try:
-                logging.debug('Writing report to Consul.')
-                self.consul_api.write_value(self._report_key, self._report)
-            except ConsulError as error:
-                logging.error('Failed to write deployment report to Consul.')
-                logging.exception(error)
+            # Writes happen in the background and rapid updates are merged, see _close_report
+            if self._report_writer is None:
+                self._report_writer = ReportWriter(self.consul_api, self._report_key, self._report_write_delay_in_ms)
+            self._report_writer.submit(self._report)
+
+    def _update_stage_report(self, updates):
+        self._update_report(updates, write_to_consul=True)
+
+    def _close_report(self):
+        if self._report_writer is not None:
+            self._report_writer.close()
 
     def _validate_config(self, config):
         def check_not_none(property_name, dictionary):
@@ -237,8 +258,11 @@ class Deployment(object):
             self.logger.info('Attempt number: {0}'.format(
                 self.number_of_attempts + 1))
 
+            stage_durations = {}
             self._is_success = run_stages(
-                self.stages, self, self._update_report, self.logger)
+                self.stages, self, self._update_stage_report, self.logger, stage_durations)
+            if self._is_success and self.duration_history is not None:
+                self.duration_history.record(self.service.id, stage_durations)
 
             self._finalise_log()
             self._finalise_report()
@@ -248,14 +272,19 @@ class Deployment(object):
             self.logger.error('Deployment has failed.')
             self._finalise_log()
             self._finalise_report()
+            # The final status must be in Consul before the deployment is reported as finished
+            self._close_report()
             self._is_success = False
             return {'id': self.id, 'is_success': self._is_success}
 
 
-def run_stages(stages, deployment, reporter, logger):
+def run_stages(stages, deployment, reporter, logger, durations=None):
     success = False
     for stage in stages:
+        start_time = time.time()
         success = stage.run(deployment)
+        if durations is not None:
+            durations[stage.name] = int((time.time() - start_time) * 1000)
         reporter({'last_completed_stage': stage.name})
         if not success:
             logger.error('Deployment stage ' + stage.name +
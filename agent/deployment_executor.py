@@ -0,0 +1,112 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import logging, os, Queue, sys, threading, yaml
+from deployment import find_deployment_dir
+
+def get_action_resources(action, action_info, platform):
+    # Resources an action may modify: its service ID, its port and the destinations of the files of the deployment it replaces.
+    # The destinations of the new bundle are only known once it is downloaded, copying files is serialised for that reason.
+    resources = set([('service', action.service.id)])
+    if action.service.port:
+        resources.add(('port', action.service.port))
+    last_deployment_id = action_info.get('last_deployment_id')
+    last_dir = find_deployment_dir(platform, action.service.id, last_deployment_id) if last_deployment_id is not None else None
+    appspec_filepath = os.path.join(last_dir, 'archive', 'appspec.yml') if last_dir is not None else None
+    if appspec_filepath is not None and os.path.isfile(appspec_filepath):
+        try:
+            with open(appspec_filepath, 'r') as appspec_file:
+                appspec = yaml.safe_load(appspec_file) or {}
+            for file in appspec.get('files') or []:
+                resources.add(('path', os.path.normpath(file['destination'])))
+        except (IOError, KeyError, TypeError, AttributeError, yaml.YAMLError) as e:
+            logging.warning('Failed to read files of previous deployment from {0}: {1}'.format(appspec_filepath, e))
+    return resources
+
+def is_conflicting(resources, other_resources):
+    for kind, value in resources:
+        for other_kind, other_value in other_resources:
+            if kind != other_kind:
+                continue
+            if kind == 'path':
+                # Nested destinations conflict as well
+                if value == other_value or value.startswith(other_value.rstrip(os.sep) + os.sep) or other_value.startswith(value.rstrip(os.sep) + os.sep):
+                    return True
+            elif value == other_value:
+                return True
+    return False
+
+class DeploymentExecutor(object):
+    # Runs pending actions of a server role on up to max_workers threads, as soon as the services they depend on are deployed.
+    # Conflicting actions run one after the other in plan order.
+    def __init__(self, execute, max_workers=1, get_resources=None, estimate_duration=None, prefetch=None):
+        self._execute = execute
+        self._max_workers = max(max_workers, 1)
+        self._get_resources = get_resources or (lambda action, action_info: set([('service', action.service.id)]))
+        self._estimate_duration = estimate_duration
+        self._prefetch = prefetch
+
+    def _is_waiting(self, action, unfinished_services):
+        # A dependency is satisfied once no action of that service is pending or running, whatever its outcome
+        return any(name in unfinished_services for name in action.depends_on if name != action.service_name)
+
+    def _run_action(self, action, action_info, completed):
+        try:
+            completed.put((action, self._execute(action, action_info), None))
+        except:
+            completed.put((action, None, sys.exc_info()))
+
+    def _wait_for_completion(self, completed):
+        while True:
+            try:
+                # Waiting with a timeout keeps the main thread responsive to interrupts
+                return completed.get(True, 1)
+            except Queue.Empty:
+                pass
+
+    def run(self, server_role, get_registered_services):
+        # Returns True if every action was applied, that is none reported a failure and none is left pending
+        running = {}
+        completed = Queue.Queue()
+        error = None
+        is_applied = True
+        while True:
+            if error is None:
+                pending_actions = [(action, action_info) for action, action_info in server_role.plan(get_registered_services(), self._estimate_duration) if action not in running]
+                logging.info('{0} deployment actions pending, {1} running.'.format(len(pending_actions), len(running)))
+                reserved = list(running.values())
+                unfinished_services = set(action.service_name for action, action_info in pending_actions) | set(action.service_name for action in running)
+                is_deadlocked = not running and all(self._is_waiting(action, unfinished_services) for action, action_info in pending_actions)
+                if is_deadlocked and pending_actions:
+                    logging.warning('Dependencies between pending deployment actions form a cycle, ignoring them for {0}.'.format(pending_actions[0][0].service_name))
+                for action, action_info in pending_actions:
+                    if len(running) >= self._max_workers:
+                        break
+                    if self._is_waiting(action, unfinished_services) and not (is_deadlocked and action is pending_actions[0][0]):
+                        continue
+                    resources = self._get_resources(action, action_info)
+                    is_blocked = any(is_conflicting(resources, other_resources) for other_resources in reserved)
+                    # Actions that conflict with a skipped action wait behind it, so conflicting actions keep their order
+                    reserved.append(resources)
+                    if is_blocked:
+                        continue
+                    running[action] = resources
+                    thread = threading.Thread(target=self._run_action, args=(action, action_info, completed), name='deployment-{0}'.format(action.deployment_id))
+                    thread.daemon = True
+                    thread.start()
+                if self._prefetch is not None:
+                    # Actions left waiting can get ready while the running deployments execute their hooks
+                    self._prefetch([action for action, action_info in pending_actions if action not in running], list(running))
+            if not running:
+                break
+            action, report, exc_info = self._wait_for_completion(completed)
+            del running[action]
+            if exc_info is not None:
+                # Like a sequential converge, stop on the first unexpected error, once the running deployments are finished
+                error = error or exc_info
+                continue
+            is_applied = is_applied and report.get('is_success', False)
+            # if not report['is_success']:
+            server_role.quarantine_action(report['id'])
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return is_applied and not pending_actions
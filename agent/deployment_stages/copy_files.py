@@ -2,9 +2,13 @@
 
 import os
 import shutil
+import threading
 from agent.tweaked_shutil import mergetree
 from .common import DeploymentStage
 
+# Deployments running in parallel may copy files to the same destinations
+copy_lock = threading.Lock()
+
 class CopyFiles(DeploymentStage):
     def __init__(self):
         DeploymentStage.__init__(self, name='CopyFiles')
@@ -32,6 +36,7 @@ class CopyFiles(DeploymentStage):
         if 'files' not in deployment.appspec:
             deployment.logger.info('Skipping CopyFiles stage as there are no file operations defined in appspec.yml.')
             return
-        clean_up(deployment.appspec.get('files', []), deployment.logger)
-        copy_files(deployment.appspec.get('files', []), deployment.logger)
+        with copy_lock:
+            clean_up(deployment.appspec.get('files', []), deployment.logger)
+            copy_files(deployment.appspec.get('files', []), deployment.logger)
         
\ No newline at end of file
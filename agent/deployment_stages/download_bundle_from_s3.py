@@ -14,9 +14,22 @@ class DownloadBundleFromS3(DeploymentStage):
         package_bucket = deployment.service.installation['package_bucket']
         package_key = deployment.service.installation['package_key']
         bundle_filepath = os.path.join(deployment.dir, 'bundle.zip')
-        deployment.logger.debug('Downloading bundle from S3 bucket \'{0}\' with key \'{1}\' to {2}.'.format(package_bucket, package_key, bundle_filepath))
-        if not deployment.s3_file_manager.download_file(package_bucket, package_key, bundle_filepath):
-            raise DeploymentError('Failed to download bundle from S3 bucket \'{0}\' with key \'{1}\' to {2}.'.format(package_bucket, package_key, bundle_filepath))
+        if deployment.bundle_prefetcher is not None and deployment.bundle_prefetcher.take(deployment.id, bundle_filepath):
+            deployment.logger.debug('Using bundle prefetched from S3 bucket \'{0}\' with key \'{1}\'.'.format(package_bucket, package_key))
+        else:
+            # Limits how many instances of the server role download at once, the download proceeds anyway if the semaphore is unavailable
+            semaphore = deployment.create_download_semaphore() if deployment.create_download_semaphore is not None else None
+            if semaphore is not None:
+                deployment.logger.debug('Waiting for a download slot of the server role.')
+                semaphore.acquire()
+            try:
+                deployment.logger.debug('Downloading bundle from S3 bucket \'{0}\' with key \'{1}\' to {2}.'.format(package_bucket, package_key, bundle_filepath))
+                is_downloaded = deployment.s3_file_manager.download_file(package_bucket, package_key, bundle_filepath)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+            if not is_downloaded:
+                raise DeploymentError('Failed to download bundle from S3 bucket \'{0}\' with key \'{1}\' to {2}.'.format(package_bucket, package_key, bundle_filepath))
 
         deployment.logger.debug('Extracting {0} to {1}.'.format(bundle_filepath, deployment.archive_dir))
         bundle_fh = open(bundle_filepath, 'rb')
@@ -16,5 +16,7 @@ class RegisterWithConsul(DeploymentStage):
         )
         if is_success:
             deployment.logger.info('Service registered in Consul catalogue.')
+            if deployment.service_registry is not None:
+                deployment.service_registry.register(deployment.service)
         else:
             deployment.logger.warning('Failed to register service in Consul catalogue.')
@@ -0,0 +1,61 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import json, logging, os, threading
+
+ORDERING_POLICIES = ['role', 'shortest_first']
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+class DurationHistory(object):
+    # Stage durations of the last successful deployments of each service, kept in a local file when a path is given
+    def __init__(self, filepath=None, max_samples=10):
+        self.filepath = filepath
+        self._max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples = self._load()
+
+    def _load(self):
+        if self.filepath is None or not os.path.isfile(self.filepath):
+            return {}
+        try:
+            with open(self.filepath, 'r') as history_file:
+                samples = json.load(history_file)
+            if isinstance(samples, dict):
+                return samples
+        except (IOError, ValueError) as e:
+            logging.warning('Failed to read deployment duration history at {0}, ignoring it: {1}'.format(self.filepath, e))
+        return {}
+
+    def _save(self):
+        temporary_filepath = self.filepath + '.tmp'
+        try:
+            with open(temporary_filepath, 'w') as history_file:
+                json.dump(self._samples, history_file)
+            try:
+                os.rename(temporary_filepath, self.filepath)
+            except OSError:
+                # Windows does not replace an existing file on rename
+                os.remove(self.filepath)
+                os.rename(temporary_filepath, self.filepath)
+        except (IOError, OSError) as e:
+            logging.warning('Failed to save deployment duration history to {0}: {1}'.format(self.filepath, e))
+
+    def record(self, service_id, stage_durations_in_ms):
+        with self._lock:
+            samples = self._samples.setdefault(service_id, [])
+            samples.append(dict(stage_durations_in_ms))
+            del samples[:-self._max_samples]
+            if self.filepath is not None:
+                self._save()
+
+    def estimate_in_ms(self, service_id):
+        # Sum of the median duration of each stage, None for a service never deployed
+        with self._lock:
+            samples = self._samples.get(service_id)
+            if not samples:
+                return None
+            stages = set(stage for sample in samples for stage in sample)
+            return sum(median([sample[stage] for sample in samples if stage in sample]) for stage in stages)
@@ -0,0 +1,29 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import logging
+
+class IncrementalPlanner(object):
+    # Actions reused by the data loader that were already applied at the end of the last converge need no planning,
+    # unless the catalogue entries of their service or deployment have changed since
+    def __init__(self):
+        self._applied_actions = set()
+        self._catalogue = frozenset()
+
+    def _catalogue_of(self, registered_services):
+        return frozenset((service.id, service.deployment_id) for service in registered_services)
+
+    def actions_to_plan(self, server_role, registered_services):
+        catalogue = self._catalogue_of(registered_services)
+        changed_entries = catalogue.symmetric_difference(self._catalogue)
+        changed = set()
+        for service_id, deployment_id in changed_entries:
+            changed.update([service_id, deployment_id])
+        actions = [action for action in server_role.actions
+                   if action not in self._applied_actions or action.service.id in changed or action.deployment_id in changed]
+        logging.info('Planning {0} of {1} server role actions, {2} catalogue entries changed.'.format(len(actions), len(server_role.actions), len(changed_entries)))
+        return actions
+
+    def record(self, actions, registered_services):
+        deployment_ids = set(service.deployment_id for service in registered_services)
+        self._applied_actions = set(action for action in actions if action.deployment_id in deployment_ids)
+        self._catalogue = self._catalogue_of(registered_services)
@@ -33,3 +33,9 @@ def get_service_definition_key(environment, name, version):
 
 def get_service_installation_key(environment, name, version):
     return '%s/installation' % get_service_key(environment, name, version)
+
+def get_download_semaphore_key(environment):
+    # Kept outside of the server role key space so that semaphore updates do not wake up the server role watch
+    if environment is None:
+        raise ValueError('environment must be specified.')
+    return 'environments/{0}/semaphores/{1}/download'.format(environment.environment_name, environment.server_role)
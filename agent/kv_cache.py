@@ -0,0 +1,118 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import copy, logging, re, threading
+from collections import OrderedDict, namedtuple
+
+# Service definitions and installations are written once per version and never modified afterwards
+IMMUTABLE_KEY_PATTERN = re.compile(r'^environments/[^/]+/services/[^/]+/[^/]+/(definition|installation)$')
+
+CacheEntry = namedtuple('CacheEntry', ['modify_index', 'value', 'is_valid'])
+
+def is_immutable_key(key):
+    return IMMUTABLE_KEY_PATTERN.match(key) is not None
+
+def is_under_prefix(key, key_prefix):
+    # Prefixes match whole path segments, so that 'roles/web' does not cover 'roles/web-canary'
+    key_prefix = key_prefix.rstrip('/')
+    return key == key_prefix or key.startswith(key_prefix + '/')
+
+class KeyValueCache(object):
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._watched_prefixes = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_watched(self, key):
+        return any(is_under_prefix(key, prefix) for prefix in self._watched_prefixes)
+
+    def _store(self, key, modify_index, value):
+        self._entries.pop(key, None)
+        self._entries[key] = CacheEntry(modify_index, value, True)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _is_trusted(self, key, entry):
+        # Mutable keys can only be trusted while a blocking query keeps them up to date
+        return entry is not None and entry.is_valid and (is_immutable_key(key) or self._is_watched(key))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not self._is_trusted(key, entry):
+                self.misses += 1
+                return (False, None)
+            self.hits += 1
+            self._entries.pop(key)
+            self._entries[key] = entry
+            return (True, copy.deepcopy(entry.value))
+
+    def modify_index(self, key):
+        # None for keys the cache would not serve, so that callers read them again
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.modify_index if self._is_trusted(key, entry) else None
+
+    def prefix_index(self, key_prefix):
+        # Highest modify index of the valid entries under key_prefix, None if there is none
+        with self._lock:
+            indexes = [entry.modify_index for key, entry in self._entries.iteritems() if entry.is_valid and is_under_prefix(key, key_prefix)]
+            return max(indexes) if indexes else None
+
+    def put(self, key, modify_index, value):
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None and existing.modify_index > modify_index:
+                return
+            self._store(key, modify_index, copy.deepcopy(value))
+
+    def watch(self, key_prefix):
+        # Mutable keys under a watched prefix are served from the cache, the caller keeps them up to date with blocking queries
+        with self._lock:
+            self._watched_prefixes.add(key_prefix.rstrip('/'))
+
+    def unwatch(self, key_prefix):
+        with self._lock:
+            self._watched_prefixes.discard(key_prefix.rstrip('/'))
+
+    def refresh(self, key_prefix, entries, decode):
+        with self._lock:
+            keys = set()
+            for entry in entries:
+                key = entry['Key']
+                keys.add(key)
+                existing = self._entries.get(key)
+                if existing is not None and existing.is_valid and existing.modify_index == entry['ModifyIndex']:
+                    continue
+                try:
+                    self._store(key, entry['ModifyIndex'], decode(entry['Value']))
+                except ValueError:
+                    self._invalidate(key)
+            for key in [k for k in self._entries.keys() if is_under_prefix(k, key_prefix) and k not in keys]:
+                logging.debug('Key \'{0}\' no longer exists, invalidating cached value.'.format(key))
+                self._invalidate(key)
+
+    def _invalidate(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries[key] = entry._replace(is_valid=False)
+
+    def immutable_entries(self):
+        with self._lock:
+            return [[key, entry.modify_index, entry.value] for key, entry in self._entries.iteritems() if entry.is_valid and is_immutable_key(key)]
+
+    def get_last_known(self, key):
+        # Degraded reads accept any value that was valid when last seen, watched or not
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not entry.is_valid:
+                return (False, None)
+            return (True, copy.deepcopy(entry.value))
+
+    def get_last_known_values(self, key_prefix):
+        with self._lock:
+            return OrderedDict((key, copy.deepcopy(entry.value)) for key, entry in sorted(self._entries.iteritems()) if entry.is_valid and key.startswith(key_prefix))
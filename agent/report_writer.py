@@ -0,0 +1,79 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import copy, logging, sys, threading, time
+
+class ReportWriter(object):
+    def __init__(self, consul_api, key, max_delay_in_ms=1000):
+        self._consul_api = consul_api
+        self._key = key
+        self._max_delay = max_delay_in_ms / 1000.0
+        self._condition = threading.Condition()
+        self._pending_report = None
+        self._pending_since = None
+        self._is_flush_requested = False
+        self._is_writing = False
+        self._is_closed = False
+        self.number_of_updates = self.number_of_writes = 0
+        self._thread = threading.Thread(target=self._run, name='report-writer-{0}'.format(key))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _next_report(self):
+        with self._condition:
+            while self._pending_report is None and not self._is_closed:
+                self._condition.wait()
+            if self._pending_report is None:
+                return None
+            # Give further updates a chance to be merged into this write, up to the maximum delay
+            deadline = self._pending_since + self._max_delay
+            while not self._is_flush_requested and not self._is_closed and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+            report = self._pending_report
+            self._pending_report = self._pending_since = None
+            self._is_flush_requested = False
+            self._is_writing = True
+            return report
+
+    def _run(self):
+        while True:
+            report = self._next_report()
+            if report is None:
+                return
+            try:
+                logging.debug('Writing report to Consul.')
+                self._consul_api.write_value(self._key, report)
+                self.number_of_writes += 1
+            except:
+                # Keep the writer alive whatever the failure, otherwise flush would wait forever
+                logging.error('Failed to write deployment report to Consul.')
+                logging.exception(sys.exc_info()[1])
+            finally:
+                with self._condition:
+                    self._is_writing = False
+                    self._condition.notify_all()
+
+    def submit(self, report):
+        with self._condition:
+            if self._is_closed:
+                raise RuntimeError('Report writer for \'{0}\' is closed.'.format(self._key))
+            self._pending_report = copy.deepcopy(report)
+            if self._pending_since is None:
+                self._pending_since = time.time()
+            self.number_of_updates += 1
+            self._condition.notify_all()
+
+    def flush(self):
+        with self._condition:
+            self._is_flush_requested = True
+            self._condition.notify_all()
+            while self._pending_report is not None or self._is_writing:
+                self._condition.wait()
+            self._is_flush_requested = False
+
+    def close(self):
+        self.flush()
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        logging.debug('Report writer merged {0} updates into {1} writes.'.format(self.number_of_updates, self.number_of_writes))
@@ -0,0 +1,79 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import logging, random, threading, time, zlib
+from retrying import Retrying
+
+DEFAULT_SETTINGS = {
+    'consul_read': {'base_delay_in_ms': 1000, 'max_delay_in_ms': 60000, 'max_attempts': None, 'retry_budget': 20, 'retry_ratio': 0.1},
+    'consul_write': {'base_delay_in_ms': 1000, 'max_delay_in_ms': 60000, 'max_attempts': None, 'retry_budget': 20, 'retry_ratio': 0.1},
+    's3': {'base_delay_in_ms': 5000, 'max_delay_in_ms': 20000, 'max_attempts': 3, 'retry_budget': 10, 'retry_ratio': 0.1}
+}
+
+class RetryBudget(object):
+    # Token bucket shared by all operations of a class: each call earns a fraction of a retry, each retry spends one
+    def __init__(self, capacity, ratio):
+        self._capacity = float(capacity)
+        self._ratio = ratio
+        self._balance = float(capacity)
+        self._lock = threading.Lock()
+
+    @property
+    def balance(self):
+        return self._balance
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self._capacity, self._balance + self._ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+class RetryPolicy(object):
+    def __init__(self, config=None):
+        config = config or {}
+        self._settings = {}
+        self._budgets = {}
+        for operation_class, defaults in DEFAULT_SETTINGS.iteritems():
+            settings = dict(defaults)
+            settings.update(config.get(operation_class) or {})
+            self._settings[operation_class] = settings
+            self._budgets[operation_class] = RetryBudget(settings['retry_budget'], settings['retry_ratio'])
+        self._converge_stagger_in_ms = config.get('converge_stagger_in_ms', 0)
+
+    def budget(self, operation_class):
+        return self._budgets[operation_class]
+
+    def delay_in_ms(self, operation_class, attempt_number):
+        # Full jitter: a uniformly random delay up to the exponential backoff keeps a fleet of agents from retrying in lockstep
+        settings = self._settings[operation_class]
+        return random.uniform(0, min(settings['max_delay_in_ms'], settings['base_delay_in_ms'] * 2 ** (attempt_number - 1)))
+
+    def converge_stagger_in_ms(self, instance_id):
+        if not self._converge_stagger_in_ms or instance_id is None:
+            return 0
+        return (zlib.crc32(instance_id) & 0xffffffff) % (self._converge_stagger_in_ms + 1)
+
+    def stagger(self, instance_id):
+        delay = self.converge_stagger_in_ms(instance_id)
+        if delay:
+            logging.info('Waiting {0} ms before converging to spread load across instances.'.format(delay))
+            time.sleep(delay / 1000.0)
+
+    def call(self, operation_class, retry_on_exception, func, *args, **kwargs):
+        settings = self._settings[operation_class]
+        budget = self._budgets[operation_class]
+        def stop(attempt_number, delay_since_first_attempt_ms):
+            if settings['max_attempts'] is not None and attempt_number >= settings['max_attempts']:
+                return True
+            if not budget.withdraw():
+                logging.warning('Retry budget for {0} operations is exhausted, giving up after {1} attempts.'.format(operation_class, attempt_number))
+                return True
+            return False
+        def wait(attempt_number, delay_since_first_attempt_ms):
+            return self.delay_in_ms(operation_class, attempt_number)
+        budget.deposit()
+        return Retrying(retry_on_exception=retry_on_exception, stop_func=stop, wait_func=wait).call(func, *args, **kwargs)
@@ -0,0 +1,43 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import hashlib, json, logging
+from consul_api import decode_value
+
+class RoleChangeFilter(object):
+    def __init__(self, services_key):
+        self._services_prefix = services_key + '/'
+        self.digest = None
+        self.number_of_suppressed_changes = 0
+
+    def _compute_digest(self, entries):
+        desired_state = []
+        for entry in entries:
+            if not entry.get('Key', '').startswith(self._services_prefix):
+                continue
+            try:
+                definition = decode_value(entry.get('Value'))
+            except ValueError:
+                definition = None
+            if isinstance(definition, dict):
+                desired_state.append([definition.get('Name'), definition.get('Version'), definition.get('Slice', 'none'),
+                                      definition.get('DeploymentId'), definition.get('Action', 'Install'),
+                                      definition.get('Priority'), definition.get('DependsOn')])
+            else:
+                # Keep entries that cannot be decoded so that fixing them still triggers a converge
+                desired_state.append([entry.get('Key'), entry.get('Value')])
+        return hashlib.sha1(json.dumps(sorted(desired_state))).hexdigest()
+
+    def prime(self, entries):
+        self.digest = self._compute_digest(entries)
+
+    def reset(self):
+        self.digest = None
+
+    def has_changed(self, entries):
+        digest = self._compute_digest(entries)
+        if digest == self.digest:
+            self.number_of_suppressed_changes += 1
+            logging.info('Desired state of server role services is unchanged, skipping converge. Suppressed wake-ups so far: {0}'.format(self.number_of_suppressed_changes))
+            return False
+        self.digest = digest
+        return True
@@ -3,10 +3,14 @@
 import logging, sys
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
-from retrying import retry
+from retry_policy import RetryPolicy
+
+def retry_on_any_exception(exception):
+    return True
 
 class S3FileManager(object):
-    def __init__(self, config):
+    def __init__(self, config, retry_policy=None):
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
         if config is None:
             self._access_key_id = self._aws_secret_access_key = None
         else:
@@ -14,7 +18,6 @@ class S3FileManager(object):
             self._aws_secret_access_key = config.get('aws_secret_access_key')
         self._s3_connection = None
 
-    @retry(wait_fixed=5000, stop_max_attempt_number=3)
     def _download_file(self, bucket_name, key, output_path):
         if self._s3_connection is None:
             self._init_connection()
@@ -22,10 +25,15 @@ class S3FileManager(object):
         s3_key = s3_bucket.get_key(key)
         s3_key.get_contents_to_filename(output_path)
 
+    def _get_file_size(self, bucket_name, key):
+        if self._s3_connection is None:
+            self._init_connection()
+        s3_key = self._s3_connection.get_bucket(bucket_name).get_key(key)
+        return s3_key.size if s3_key is not None else None
+
     def _init_connection(self):
         self._s3_connection = S3Connection(aws_access_key_id=self._access_key_id, aws_secret_access_key=self._aws_secret_access_key)
 
-    @retry(wait_fixed=5000, stop_max_attempt_number=3)
     def _upload_file(self, bucket_name, key, filepath):
         if self._s3_connection is None:
             self._init_connection()
@@ -37,16 +45,24 @@ class S3FileManager(object):
 
     def download_file(self, bucket_name, key, output_path):
         try:
-            self._download_file(bucket_name, key, output_path)
+            self._retry_policy.call('s3', retry_on_any_exception, self._download_file, bucket_name, key, output_path)
             return True
         except:
             logging.error('Failed to download file from S3.')
             logging.exception(sys.exc_info()[1])
             return False
 
+    def get_file_size(self, bucket_name, key):
+        try:
+            return self._retry_policy.call('s3', retry_on_any_exception, self._get_file_size, bucket_name, key)
+        except:
+            logging.error('Failed to get size of file in S3.')
+            logging.exception(sys.exc_info()[1])
+            return None
+
     def upload_file(self, bucket_name, key, filepath):
         try:
-            return self._upload_file(bucket_name, key, filepath)
+            return self._retry_policy.call('s3', retry_on_any_exception, self._upload_file, bucket_name, key, filepath)
         except:
             logging.error('Failed to upload file to S3.')
             logging.exception(sys.exc_info()[1])
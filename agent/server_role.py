@@ -6,32 +6,47 @@ class ServerRole(object):
     def __init__(self, id):
         self.actions = []
         self.id = id
-        self.quarantine = []
+        self.quarantine = set()
 
     def __str__(self):
         return json.dumps(
             {'id': self.id,
              'actions': [str(s) for s in self.actions],
-             'quarantine': self.quarantine})
+             'quarantine': sorted(self.quarantine)})
 
-    def find_action_to_execute(self, registered_services):
+    def plan(self, registered_services, estimate_duration=None):
+        # Index the catalogue once so that planning is linear in the number of actions and registered services
+        deployment_ids = set(s.deployment_id for s in registered_services)
+        installed_services = {}
+        for s in registered_services:
+            installed_services.setdefault(s.id, s)
+        pending_actions = []
         for action in self.actions:
             if action.deployment_id in self.quarantine:
                 logging.warn('Following deployment action is quarantined, skipping deployment.\n{0}'.format(action))
                 continue
-            deployment_id = next((s.deployment_id for s in registered_services if s.deployment_id == action.deployment_id), None)
-            if deployment_id is None:
-                # Deployment action has not been applied to this instance or was unsuccessful
-                installed_service = next((s for s in registered_services if s.id == action.service.id), None)
-                if installed_service is None:
-                    # There is no existing deployment of the service on this instance, no need to specify last_deployment_id
-                    return (action, {'last_deployment_id': None})
-                else:
-                    # There is an existing deployment of the service on this instance, need to specify last_deployment_id
-                    return (action, {'last_deployment_id': installed_service.deployment_id})
-        return None
+            if action.deployment_id in deployment_ids:
+                continue
+            # Deployment action has not been applied to this instance or was unsuccessful
+            installed_service = installed_services.get(action.service.id)
+            # If there is an existing deployment of the service on this instance, last_deployment_id refers to it
+            action_info = {'last_deployment_id': installed_service.deployment_id if installed_service is not None else None}
+            if estimate_duration is not None:
+                action_info['estimated_duration_in_ms'] = estimate_duration(action)
+            pending_actions.append((action, action_info))
+        # sorted is stable, actions of the same priority keep the server role order unless they are ordered shortest first
+        # from their estimated duration, in which case actions never deployed before come last
+        def order(pending_action):
+            action, action_info = pending_action
+            if estimate_duration is None:
+                return (action.priority,)
+            return (action.priority, action_info['estimated_duration_in_ms'] is None, action_info['estimated_duration_in_ms'])
+        return sorted(pending_actions, key=order)
+
+    def find_action_to_execute(self, registered_services):
+        pending_actions = self.plan(registered_services)
+        return pending_actions[0] if pending_actions else None
 
     def quarantine_action(self, deployment_id):
         logging.info('Quarantining deployment with ID: %s' % deployment_id)
-        self.quarantine.append(deployment_id)
-        
+        self.quarantine.add(deployment_id)
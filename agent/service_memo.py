@@ -0,0 +1,35 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import copy, threading
+from collections import OrderedDict
+
+class ServiceMemo(object):
+    # Parsed services by (environment, name, version), valid while the modify indexes of their definition and installation are unchanged
+    def __init__(self, max_entries=200):
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, modify_indexes):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or None in modify_indexes or entry[0] != modify_indexes:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.pop(key)
+            self._entries[key] = entry
+            return copy.deepcopy(entry[1])
+
+    def put(self, key, modify_indexes, service):
+        if None in modify_indexes:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (modify_indexes, copy.deepcopy(service))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,36 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import copy, logging, threading, time
+from collections import OrderedDict
+
+class ServiceRegistry(object):
+    # Local view of the Consul agent service catalogue, updated in place by the deployments of this agent
+    def __init__(self, load_service_catalogue, sync_interval_in_ms=None):
+        self._load_service_catalogue = load_service_catalogue
+        self._sync_interval_in_ms = sync_interval_in_ms
+        self._services = OrderedDict()
+        self._synced_at = None
+        self._lock = threading.Lock()
+
+    def sync(self):
+        services = self._load_service_catalogue()
+        with self._lock:
+            self._services = OrderedDict((service.id, service) for service in services)
+            self._synced_at = time.time()
+        logging.debug('Service registry synchronised with Consul catalogue: {0} services.'.format(len(services)))
+
+    def _is_expired(self):
+        if self._synced_at is None:
+            return True
+        return self._sync_interval_in_ms is not None and (time.time() - self._synced_at) * 1000 >= self._sync_interval_in_ms
+
+    def services(self):
+        if self._is_expired():
+            self.sync()
+        with self._lock:
+            return self._services.values()
+
+    def register(self, service):
+        with self._lock:
+            self._services.pop(service.id, None)
+            self._services[service.id] = copy.deepcopy(service)
@@ -0,0 +1,47 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import json, logging, os
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+def is_up_to_date(state, role_index, role_digest):
+    # The last converge covered the current desired state if it applied every action and neither the role index nor its services changed since
+    if state is None or not state.get('is_success') or not role_index:
+        return False
+    return state.get('role_index') == role_index or (role_digest is not None and state.get('role_digest') == role_digest)
+
+class Snapshot(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def load(self, role_key):
+        if not os.path.isfile(self.filepath):
+            logging.info('No Consul snapshot found at {0}'.format(self.filepath))
+            return None
+        try:
+            with open(self.filepath, 'r') as snapshot_file:
+                state = json.load(snapshot_file)
+        except (IOError, ValueError) as e:
+            logging.warning('Failed to read Consul snapshot at {0}, ignoring it: {1}'.format(self.filepath, e))
+            return None
+        if not isinstance(state, dict) or state.get('version') != SNAPSHOT_FORMAT_VERSION or state.get('role_key') != role_key:
+            logging.info('Consul snapshot at {0} does not belong to server role \'{1}\', ignoring it.'.format(self.filepath, role_key))
+            return None
+        return state
+
+    def save(self, role_key, role_index, role_digest, is_success, entries):
+        state = {'version': SNAPSHOT_FORMAT_VERSION, 'role_key': role_key, 'role_index': role_index, 'role_digest': role_digest,
+                 'is_success': is_success, 'entries': entries}
+        temporary_filepath = self.filepath + '.tmp'
+        try:
+            with open(temporary_filepath, 'w') as snapshot_file:
+                json.dump(state, snapshot_file)
+            try:
+                os.rename(temporary_filepath, self.filepath)
+            except OSError:
+                # Windows does not replace an existing file on rename
+                os.remove(self.filepath)
+                os.rename(temporary_filepath, self.filepath)
+            logging.debug('Saved Consul snapshot of server role \'{0}\' at index {1} to {2}'.format(role_key, role_index, self.filepath))
+        except (IOError, OSError) as e:
+            logging.warning('Failed to save Consul snapshot to {0}: {1}'.format(self.filepath, e))
@@ -0,0 +1,40 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import threading, time
+
+class TriggerCoalescer(object):
+    # Collapses change notifications into a single trigger once no notification arrived for the quiet period,
+    # or once the oldest pending notification is max_delay old. Notifications received during a converge are kept for the next one.
+    def __init__(self, quiet_period_in_ms=1000, max_delay_in_ms=10000):
+        self._quiet_period = quiet_period_in_ms / 1000.0
+        self._max_delay = max_delay_in_ms / 1000.0
+        self._condition = threading.Condition()
+        self._pending = set()
+        self._first_notified_at = self._last_notified_at = None
+        self.number_of_notifications = self.number_of_triggers = 0
+
+    def notify(self, key):
+        with self._condition:
+            self._pending.add(key)
+            self._last_notified_at = time.time()
+            if self._first_notified_at is None:
+                self._first_notified_at = self._last_notified_at
+            self.number_of_notifications += 1
+            self._condition.notify_all()
+
+    def wait(self):
+        with self._condition:
+            while True:
+                # Waiting with a timeout keeps the main thread responsive to interrupts
+                timeout = 1
+                if self._pending:
+                    deadline = min(self._last_notified_at + self._quiet_period, self._first_notified_at + self._max_delay)
+                    timeout = min(timeout, deadline - time.time())
+                    if timeout <= 0:
+                        break
+                self._condition.wait(timeout)
+            keys = self._pending
+            self._pending = set()
+            self._first_notified_at = self._last_notified_at = None
+            self.number_of_triggers += 1
+            return keys
@@ -0,0 +1,44 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import socket
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+
+class UnixSocketHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class UnixSocketHTTPConnectionPool(HTTPConnectionPool):
+    def __init__(self, socket_path, maxsize=1):
+        HTTPConnectionPool.__init__(self, 'localhost', maxsize=maxsize)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        self.num_connections += 1
+        return UnixSocketHTTPConnection(self.socket_path, self.timeout.connect_timeout)
+
+class UnixSocketAdapter(HTTPAdapter):
+    """Sends every request to the HTTP server listening on socket_path, whatever the host in the URL."""
+    def __init__(self, socket_path, pool_maxsize=10):
+        HTTPAdapter.__init__(self, pool_connections=1, pool_maxsize=pool_maxsize)
+        self.pool = UnixSocketHTTPConnectionPool(socket_path, maxsize=pool_maxsize)
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        HTTPAdapter.close(self)
+        self.pool.close()
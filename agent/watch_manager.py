@@ -0,0 +1,85 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import logging, sys, threading, time
+from consul_watcher import ConsulWatcher
+from trigger_coalescer import TriggerCoalescer
+
+class WatchManager(object):
+    # Runs one blocking query per key prefix in its own thread and reports changes through a single coalesced trigger
+    def __init__(self, consul_api, wait_in_ms=300000, debounce_in_ms=1000, max_delay_in_ms=10000):
+        self._consul_api = consul_api
+        self._wait_in_ms = wait_in_ms
+        self._condition = threading.Condition()
+        self._watchers = {}
+        self._threads = {}
+        self.coalescer = TriggerCoalescer(debounce_in_ms, max_delay_in_ms)
+
+    @property
+    def key_prefixes(self):
+        with self._condition:
+            return sorted(self._watchers.keys())
+
+    def add(self, key_prefix):
+        # A watcher added before watch is started reports its first result as a change unless primed by the caller.
+        # Watchers added by watch start from the cached entries under their prefix, which are the ones the last converge read,
+        # so that a write made since is reported as a change.
+        with self._condition:
+            if key_prefix not in self._watchers:
+                self._watchers[key_prefix] = ConsulWatcher(self._consul_api, key_prefix, self._wait_in_ms)
+            return self._watchers[key_prefix]
+
+    def watch(self, key_prefixes):
+        with self._condition:
+            for key_prefix in [k for k in self._watchers.keys() if k not in key_prefixes]:
+                logging.debug('Stopped watching \'{0}\' key space.'.format(key_prefix))
+                self._consul_api.cache.unwatch(key_prefix)
+                del self._watchers[key_prefix]
+                self._threads.pop(key_prefix, None)
+            for key_prefix in key_prefixes:
+                if key_prefix in self._threads:
+                    continue
+                if key_prefix not in self._watchers:
+                    self.add(key_prefix).index = self._consul_api.cache.prefix_index(key_prefix) or 1
+                    is_primed = False
+                else:
+                    is_primed = self._watchers[key_prefix].index > 0
+                thread = threading.Thread(target=self._run, args=(self._watchers[key_prefix], is_primed), name='watch-{0}'.format(key_prefix))
+                thread.daemon = True
+                self._threads[key_prefix] = thread
+                thread.start()
+
+    def _is_watched(self, watcher):
+        with self._condition:
+            return self._watchers.get(watcher.key_prefix) is watcher
+
+    def _set_cache_trust(self, watcher, is_trusted):
+        # The cache serves keys of a prefix only while its watch thread runs and its last query succeeded
+        with self._condition:
+            if self._watchers.get(watcher.key_prefix) is not watcher:
+                return
+            if is_trusted:
+                self._consul_api.cache.watch(watcher.key_prefix)
+            else:
+                self._consul_api.cache.unwatch(watcher.key_prefix)
+
+    def _run(self, watcher, is_primed):
+        number_of_consecutive_errors = 0
+        if is_primed:
+            self._set_cache_trust(watcher, True)
+        while self._is_watched(watcher):
+            try:
+                if watcher.poll() and self._is_watched(watcher):
+                    logging.info('Change detected in Consul {0} key space.'.format(watcher.key_prefix))
+                    self.coalescer.notify(watcher.key_prefix)
+                self._set_cache_trust(watcher, True)
+                number_of_consecutive_errors = 0
+            except:
+                self._set_cache_trust(watcher, False)
+                logging.error('Error watching Consul {0} key space.'.format(watcher.key_prefix))
+                logging.exception(sys.exc_info()[1])
+                number_of_consecutive_errors += 1
+                time.sleep(self._consul_api.retry_policy.delay_in_ms('consul_read', number_of_consecutive_errors) / 1000.0)
+
+    def wait_for_change(self):
+        # Changes made together, such as a role update and its new service versions, trigger a single converge
+        return self.coalescer.wait()
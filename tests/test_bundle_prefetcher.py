@@ -0,0 +1,103 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import os, shutil, tempfile, threading, time, unittest
+from agent.bundle_prefetcher import BundlePrefetcher
+
+class MockService(object):
+    def __init__(self, package_key):
+        self.installation = {'package_bucket': 'bucket', 'package_key': package_key}
+
+class MockAction(object):
+    def __init__(self, deployment_id):
+        self.deployment_id = deployment_id
+        self.service = MockService('{0}.zip'.format(deployment_id))
+
+class MockS3FileManager(object):
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.downloads = []
+        self.can_download = threading.Event()
+        self.can_download.set()
+
+    def get_file_size(self, bucket_name, key):
+        return self.sizes.get(key)
+
+    def download_file(self, bucket_name, key, output_path):
+        self.can_download.wait(5)
+        self.downloads.append(key)
+        with open(output_path, 'w') as output_file:
+            output_file.write(key)
+        return True
+
+class MockSemaphore(object):
+    def __init__(self, s3_file_manager, events):
+        self.s3_file_manager = s3_file_manager
+        self.events = events
+
+    def acquire(self):
+        self.events.append(('acquire', list(self.s3_file_manager.downloads)))
+        return True
+
+    def release(self):
+        self.events.append(('release', list(self.s3_file_manager.downloads)))
+
+class TestBundlePrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.prefetch_directory = os.path.join(self.directory, 'prefetch')
+        self.s3_file_manager = MockS3FileManager({'d1.zip': 1024 * 1024, 'd2.zip': 1024 * 1024, 'd3.zip': 1024 * 1024})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def wait_for_disk_usage(self, prefetcher, disk_usage_in_mb):
+        deadline = time.time() + 5
+        while prefetcher.disk_usage < disk_usage_in_mb * 1024 * 1024 and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_deployment_takes_prefetched_bundle(self):
+        prefetcher = BundlePrefetcher(self.s3_file_manager, self.prefetch_directory, max_bundles=2)
+        prefetcher.prefetch([MockAction('d1'), MockAction('d2'), MockAction('d3')])
+        self.wait_for_disk_usage(prefetcher, 2)
+        bundle_filepath = os.path.join(self.directory, 'bundle.zip')
+        self.assertTrue(prefetcher.take('d1', bundle_filepath))
+        with open(bundle_filepath) as bundle_file:
+            self.assertEqual(bundle_file.read(), 'd1.zip')
+        self.assertFalse(prefetcher.take('d3', bundle_filepath))
+        self.assertEqual((prefetcher.number_of_hits, prefetcher.number_of_misses), (1, 1))
+
+    def test_downloads_hold_a_slot_of_the_download_semaphore(self):
+        events = []
+        prefetcher = BundlePrefetcher(self.s3_file_manager, self.prefetch_directory, max_bundles=1,
+                                      create_download_semaphore=lambda: MockSemaphore(self.s3_file_manager, events))
+        prefetcher.prefetch([MockAction('d1')])
+        self.wait_for_disk_usage(prefetcher, 1)
+        self.assertTrue(prefetcher.take('d1', os.path.join(self.directory, 'bundle.zip')))
+        self.assertEqual(events, [('acquire', []), ('release', ['d1.zip'])])
+
+    def test_take_waits_for_bundle_being_downloaded(self):
+        self.s3_file_manager.can_download.clear()
+        prefetcher = BundlePrefetcher(self.s3_file_manager, self.prefetch_directory, max_bundles=1)
+        prefetcher.prefetch([MockAction('d1')])
+        threading.Timer(0.1, self.s3_file_manager.can_download.set).start()
+        self.wait_for_disk_usage(prefetcher, 1)
+        self.assertTrue(prefetcher.take('d1', os.path.join(self.directory, 'bundle.zip')))
+        self.assertEqual(self.s3_file_manager.downloads, ['d1.zip'])
+
+    def test_disk_usage_is_bounded(self):
+        prefetcher = BundlePrefetcher(self.s3_file_manager, self.prefetch_directory, max_bundles=3, max_disk_usage_in_mb=2)
+        prefetcher.prefetch([MockAction('d1'), MockAction('d2'), MockAction('d3')])
+        self.wait_for_disk_usage(prefetcher, 2)
+        time.sleep(0.1)
+        self.assertTrue(prefetcher.take('d2', os.path.join(self.directory, 'bundle.zip')))
+        self.assertFalse(prefetcher.take('d3', os.path.join(self.directory, 'bundle.zip')))
+        self.assertEqual(sorted(self.s3_file_manager.downloads), ['d1.zip', 'd2.zip'])
+
+    def test_bundles_no_longer_pending_are_discarded(self):
+        prefetcher = BundlePrefetcher(self.s3_file_manager, self.prefetch_directory, max_bundles=2)
+        prefetcher.prefetch([MockAction('d1'), MockAction('d2')])
+        self.wait_for_disk_usage(prefetcher, 2)
+        prefetcher.prefetch([MockAction('d3')], running_actions=[MockAction('d2')])
+        self.wait_for_disk_usage(prefetcher, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.prefetch_directory, 'd1.zip')))
+        self.assertTrue(prefetcher.take('d2', os.path.join(self.directory, 'bundle.zip')))
@@ -0,0 +1,61 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import unittest
+from agent.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from mock import patch
+
+config = {'window_size': 4, 'minimum_calls': 4, 'error_rate_threshold': 0.5, 'slow_call_in_ms': 100, 'open_duration_in_ms': 1000}
+
+class TestCircuitBreaker(unittest.TestCase):
+    def open_breaker(self, circuit_breaker):
+        for i in range(4):
+            circuit_breaker.record_failure()
+
+    def test_stays_closed_below_minimum_calls(self):
+        circuit_breaker = CircuitBreaker(config)
+        for i in range(3):
+            circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CLOSED)
+        self.assertTrue(circuit_breaker.allow_request())
+
+    def test_opens_on_error_rate(self):
+        circuit_breaker = CircuitBreaker(config)
+        circuit_breaker.record_success(10)
+        circuit_breaker.record_success(10)
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CLOSED)
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, OPEN)
+        self.assertFalse(circuit_breaker.allow_request())
+        self.assertEqual(circuit_breaker.number_of_rejected_calls, 1)
+
+    def test_slow_calls_count_as_failures(self):
+        circuit_breaker = CircuitBreaker(config)
+        for i in range(4):
+            circuit_breaker.record_success(500)
+        self.assertEqual(circuit_breaker.state, OPEN)
+
+    @patch('agent.circuit_breaker.time.time')
+    def test_trial_call_closes_breaker(self, mock_time):
+        mock_time.return_value = 100.0
+        circuit_breaker = CircuitBreaker(config)
+        self.open_breaker(circuit_breaker)
+        mock_time.return_value = 101.0
+        self.assertTrue(circuit_breaker.allow_request())
+        self.assertEqual(circuit_breaker.state, HALF_OPEN)
+        self.assertFalse(circuit_breaker.allow_request())
+        circuit_breaker.record_success(10)
+        self.assertEqual(circuit_breaker.state, CLOSED)
+        self.assertEqual(circuit_breaker.error_rate, 0.0)
+
+    @patch('agent.circuit_breaker.time.time')
+    def test_failed_trial_call_reopens_breaker(self, mock_time):
+        mock_time.return_value = 100.0
+        circuit_breaker = CircuitBreaker(config)
+        self.open_breaker(circuit_breaker)
+        mock_time.return_value = 101.0
+        self.assertTrue(circuit_breaker.allow_request())
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, OPEN)
+        mock_time.return_value = 101.5
+        self.assertFalse(circuit_breaker.allow_request())
@@ -1,9 +1,26 @@
-import base64, json, responses, unittest
-from agent.consul_api import ConsulApi, ConsulError
+import base64, json, responses, threading, unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from agent.consul_api import CircuitOpenError, ConsulApi, ConsulError
 from mock import patch
 
 consul_config = {'scheme':'http', 'host':'localhost', 'port':8500, 'version':'v1', 'acl_token':None}
 
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def do_GET(self):
+        content = json.dumps({'some': 'content'})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+    def log_message(self, format, *args):
+        pass
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
 class TestConsulApi(unittest.TestCase):
     @responses.activate
     def test_check_connectivity_succeeds(self):
@@ -11,6 +28,23 @@ class TestConsulApi(unittest.TestCase):
         consul_api = ConsulApi(consul_config)
         consul_api.check_connectivity()
 
+    def test_connections_are_reused_across_requests(self):
+        server = KeepAliveServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            config = dict(consul_config, host='127.0.0.1', port=server.server_address[1])
+            consul_api = ConsulApi(config)
+            self.assertEqual(consul_api.connection_reuse_rate, 0.0)
+            for _ in range(4):
+                consul_api.check_connectivity()
+            self.assertEqual(consul_api.connection_reuse_rate, 0.75)
+            consul_api.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
     @patch('agent.consul_api.ConsulApi._api_get')
     def test_check_connectivity_fails(self, mock_call):
         mock_call.side_effect = ConsulError('Some error message')
@@ -48,6 +82,28 @@ class TestConsulApi(unittest.TestCase):
         actual_value = consul_api.get_value(key)
         self.assertEqual(actual_value, decoded_value)
 
+    @responses.activate
+    def test_get_value_for_service_definition_is_cached(self):
+        key = 'environments/env/services/Service1/1.0.0/definition'
+        value = [{'Key':key, 'Value':base64.b64encode(json.dumps({'Service': {}})), 'ModifyIndex':100}]
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/{0}'.format(key), json=value, status=200)
+        consul_api = ConsulApi(consul_config)
+        consul_api.get_value(key)['Service']['Address'] = '127.0.0.1'
+        self.assertEqual(consul_api.get_value(key), {'Service': {}})
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual((consul_api.cache.hits, consul_api.cache.misses), (1, 1))
+
+    @responses.activate
+    def test_get_value_for_watched_key_is_cached(self):
+        key = 'environments/env/roles/role/services/Service1/blue'
+        value = [{'Key':key, 'Value':base64.b64encode(json.dumps({'Version': '1.0.0'})), 'ModifyIndex':100}]
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/environments/env/roles/role', json=value, status=200, adding_headers={'X-Consul-Index': '100'})
+        consul_api = ConsulApi(consul_config)
+        consul_api.watch_key_prefix('environments/env/roles/role')
+        consul_api.cache.watch('environments/env/roles/role')
+        self.assertEqual(consul_api.get_value(key), {'Version': '1.0.0'})
+        self.assertEqual(len(responses.calls), 1)
+
     @responses.activate
     def test_get_value_for_unknown_key(self):
         key = 'key'
@@ -56,6 +112,77 @@ class TestConsulApi(unittest.TestCase):
         actual_value = consul_api.get_value(key)
         self.assertEqual(actual_value, None)
 
+    @responses.activate
+    def test_get_values_for_existing_key_prefix(self):
+        key_prefix = 'keyprefix'
+        entries = [
+            {'Key':'keyprefix/a', 'Value':base64.b64encode(json.dumps({'property': 'a'})), 'ModifyIndex':100},
+            {'Key':'keyprefix/b', 'Value':None, 'ModifyIndex':101},
+            {'Key':'keyprefix/c', 'Value':base64.b64encode('not json'), 'ModifyIndex':102}]
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/{0}'.format(key_prefix), json=entries, status=200)
+        consul_api = ConsulApi(consul_config)
+        actual_values = consul_api.get_values(key_prefix)
+        self.assertEqual(actual_values.items(), [('keyprefix/a', {'property': 'a'}), ('keyprefix/b', None)])
+        self.assertTrue(responses.calls[0].request.url.endswith('?recurse'))
+
+    @responses.activate
+    def test_get_values_for_unknown_key_prefix(self):
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/keyprefix', status=404)
+        consul_api = ConsulApi(consul_config)
+        self.assertEqual(len(consul_api.get_values('keyprefix')), 0)
+
+    @responses.activate
+    def test_get_values_batch_splits_transactions(self):
+        keys = ['key{0}'.format(i) for i in range(70)]
+        def callback(request):
+            operations = json.loads(request.body)
+            results = [{'KV': {'Key': op['KV']['Key'], 'Value': base64.b64encode(json.dumps(op['KV']['Key'])), 'ModifyIndex': 1}} for op in operations]
+            return (200, {}, json.dumps({'Results': results, 'Errors': None}))
+        responses.add_callback(responses.PUT, 'http://localhost:8500/v1/txn', callback=callback)
+        consul_api = ConsulApi(consul_config)
+        values = consul_api.get_values_batch(keys)
+        self.assertEqual(values.keys(), keys)
+        self.assertEqual(values.values(), keys)
+        self.assertEqual([len(json.loads(call.request.body)) for call in responses.calls], [64, 6])
+
+    @responses.activate
+    def test_get_values_batch_reports_missing_keys(self):
+        def callback(request):
+            operations = json.loads(request.body)
+            errors = [{'OpIndex': i, 'What': 'key doesn\'t exist'} for i, op in enumerate(operations) if op['KV']['Key'] == 'missing']
+            if errors:
+                return (409, {}, json.dumps({'Results': None, 'Errors': errors}))
+            results = [{'KV': {'Key': op['KV']['Key'], 'Value': base64.b64encode(json.dumps({'property': 'value'})), 'ModifyIndex': 1}} for op in operations]
+            return (200, {}, json.dumps({'Results': results, 'Errors': None}))
+        responses.add_callback(responses.PUT, 'http://localhost:8500/v1/txn', callback=callback)
+        consul_api = ConsulApi(consul_config)
+        consul_api.cache.put('environments/env/services/Service1/1.0.0/definition', 1, {'property': 'cached'})
+        values = consul_api.get_values_batch(['key1', 'missing', 'environments/env/services/Service1/1.0.0/definition', 'key2'])
+        self.assertEqual(values.items(), [('key1', {'property': 'value'}), ('missing', None), ('environments/env/services/Service1/1.0.0/definition', {'property': 'cached'}), ('key2', {'property': 'value'})])
+        self.assertEqual(len(json.loads(responses.calls[0].request.body)), 3)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_get_values_batch_fails_on_transaction_error(self):
+        responses.add(responses.PUT, 'http://localhost:8500/v1/txn', status=413, body='too large')
+        consul_api = ConsulApi(consul_config)
+        with self.assertRaises(ConsulError):
+            consul_api.get_values_batch(['key1'])
+
+    @responses.activate
+    def test_watch_key_prefix_returns_index_and_entries(self):
+        entries = [{'Key':'keyprefix/a', 'Value':None, 'ModifyIndex':100}]
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/keyprefix', json=entries, status=200, adding_headers={'X-Consul-Index': '120'})
+        consul_api = ConsulApi(consul_config)
+        self.assertEqual(consul_api.watch_key_prefix('keyprefix', 100, 5000), (120, entries))
+        self.assertTrue(responses.calls[0].request.url.endswith('?recurse&index=100&wait=5000ms'))
+
+    @responses.activate
+    def test_watch_key_prefix_for_unknown_key_prefix(self):
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/keyprefix', status=404, adding_headers={'X-Consul-Index': '7'})
+        consul_api = ConsulApi(consul_config)
+        self.assertEqual(consul_api.watch_key_prefix('keyprefix'), (7, []))
+
     @responses.activate
     def test_get_service_catalogue(self):
         service_catalogue = { 'consul':{ 'Service':'consul', 'Tags':[], 'ModifyIndex':0, 'EnableTagOverride':False, 'ID':'consul','Address':'','CreateIndex':0, 'Port':8300}}
@@ -112,3 +239,208 @@ class TestConsulApi(unittest.TestCase):
         consul_api = ConsulApi(consul_config)
         is_success = consul_api.register_service(id='service_id', name='service_name', address='127.0.0.1', port=8080, tags=['tag'])
         self.assertEqual(is_success, False)
+
+class TestConsulApiConsistency(unittest.TestCase):
+    definition_key = 'environments/env/services/Service1/1.0.0/definition'
+
+    def create_consul_api(self, consistency):
+        config = dict(consul_config)
+        config['consistency'] = consistency
+        return ConsulApi(config)
+
+    def add_definition(self, last_contact='0'):
+        value = [{'Key':self.definition_key, 'Value':base64.b64encode(json.dumps({'Service': {}})), 'ModifyIndex':100}]
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/{0}'.format(self.definition_key), json=value, status=200, adding_headers={'X-Consul-LastContact': last_contact})
+
+    @responses.activate
+    def test_reads_use_default_mode_unless_configured(self):
+        self.add_definition()
+        self.create_consul_api({}).get_value(self.definition_key)
+        self.create_consul_api({'service_definitions': None}).get_value(self.definition_key)
+        self.assertTrue(all(call.request.url.endswith('/definition') for call in responses.calls))
+
+    @responses.activate
+    def test_service_definitions_are_read_in_configured_mode(self):
+        self.add_definition()
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/keyprefix', json=['keyprefix/a'], status=200)
+        consul_api = self.create_consul_api({'service_definitions': {'mode': 'stale'}, 'key_listings': {'mode': 'consistent'}})
+        consul_api.get_value(self.definition_key)
+        consul_api.get_keys('keyprefix')
+        self.assertTrue(responses.calls[0].request.url.endswith('/definition?stale'))
+        self.assertTrue(responses.calls[1].request.url.endswith('?keys&consistent'))
+
+    @responses.activate
+    def test_mutable_keys_and_watches_use_default_mode(self):
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/key', status=404)
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/keyprefix', status=404, adding_headers={'X-Consul-Index': '7'})
+        consul_api = self.create_consul_api({'service_definitions': {'mode': 'stale'}, 'key_listings': {'mode': 'stale'}})
+        consul_api.get_value('key')
+        consul_api.watch_key_prefix('keyprefix', 5)
+        self.assertTrue(responses.calls[0].request.url.endswith('/kv/key'))
+        self.assertTrue(responses.calls[1].request.url.endswith('?recurse&index=5'))
+
+    @responses.activate
+    def test_stale_read_beyond_bound_is_read_again_in_default_mode(self):
+        self.add_definition(last_contact='5000')
+        consul_api = self.create_consul_api({'service_definitions': {'mode': 'stale', 'max_stale_in_ms': 1000}})
+        self.assertEqual(consul_api.get_value(self.definition_key), {'Service': {}})
+        self.assertEqual(len(responses.calls), 2)
+        self.assertTrue(responses.calls[1].request.url.endswith('/definition'))
+
+    @responses.activate
+    def test_stale_read_within_bound_is_accepted(self):
+        self.add_definition(last_contact='500')
+        consul_api = self.create_consul_api({'service_definitions': {'mode': 'stale', 'max_stale_in_ms': 1000}})
+        consul_api.get_value(self.definition_key)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_stale_listing_older_than_watched_index_is_read_again_in_default_mode(self):
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/environments/env/roles/role', json=[], status=200, adding_headers={'X-Consul-Index': '7'})
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/environments/env/roles/role/services', json=['a'], status=200, adding_headers={'X-Consul-Index': '5'})
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/environments/env/roles/role/services', json=['a', 'b'], status=200, adding_headers={'X-Consul-Index': '7'})
+        consul_api = self.create_consul_api({'key_listings': {'mode': 'stale'}})
+        consul_api.watch_key_prefix('environments/env/roles/role')
+        self.assertEqual(consul_api.get_keys('environments/env/roles/role/services'), ['a', 'b'])
+        self.assertTrue(responses.calls[1].request.url.endswith('?keys&stale'))
+        self.assertTrue(responses.calls[2].request.url.endswith('?keys'))
+
+    @responses.activate
+    def test_batch_reads_of_service_definitions_use_configured_mode(self):
+        responses.add(responses.PUT, 'http://localhost:8500/v1/txn', json={'Results': [], 'Errors': None}, status=200)
+        consul_api = self.create_consul_api({'service_definitions': {'mode': 'stale'}})
+        consul_api.get_values_batch([self.definition_key])
+        consul_api.get_values_batch(['environments/env/roles/role/services/Service1/blue'])
+        self.assertTrue(responses.calls[0].request.url.endswith('/txn?stale'))
+        self.assertTrue(responses.calls[1].request.url.endswith('/txn'))
+
+    def test_unknown_mode_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.create_consul_api({'service_definitions': {'mode': 'eventual'}})
+
+class TestConsulApiWrites(unittest.TestCase):
+    key = 'deployments/1234/nodes/i-1234'
+
+    def add_txn_callback(self, modify_index=[100]):
+        def callback(request):
+            operation = json.loads(request.body)[0]['KV']
+            if operation['Index'] != modify_index[0]:
+                return (409, {}, json.dumps({'Results': None, 'Errors': [{'OpIndex': 0, 'What': 'failed to set key'}]}))
+            modify_index[0] += 1
+            return (200, {}, json.dumps({'Results': [{'KV': {'Key': operation['Key'], 'Value': None, 'ModifyIndex': modify_index[0]}}], 'Errors': None}))
+        responses.add_callback(responses.PUT, 'http://localhost:8500/v1/txn', callback=callback)
+        return modify_index
+
+    @responses.activate
+    def test_write_value_reuses_modify_index_from_read(self):
+        self.add_txn_callback()
+        value = [{'Key':self.key, 'Value':base64.b64encode(json.dumps({'Status': 'In Progress'})), 'ModifyIndex':100}]
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/{0}'.format(self.key), json=value, status=200)
+        consul_api = ConsulApi(consul_config)
+        consul_api.get_value(self.key)
+        self.assertTrue(consul_api.write_value(self.key, {'Status': 'Success'}))
+        self.assertTrue(consul_api.write_value(self.key, {'Status': 'Success'}))
+        self.assertEqual([call.request.method for call in responses.calls], ['GET', 'PUT', 'PUT'])
+        self.assertEqual(json.loads(responses.calls[2].request.body)[0]['KV']['Index'], 101)
+
+    @responses.activate
+    def test_write_value_creates_unknown_key(self):
+        self.add_txn_callback([0])
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/{0}'.format(self.key), status=404)
+        consul_api = ConsulApi(consul_config)
+        self.assertFalse(consul_api.key_exists(self.key))
+        self.assertTrue(consul_api.write_value(self.key, {'Status': 'In Progress'}))
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_write_value_reloads_modify_index_on_conflict(self):
+        modify_index = self.add_txn_callback([100])
+        responses.add_callback(responses.GET, 'http://localhost:8500/v1/kv/{0}'.format(self.key), callback=lambda request: (200, {'X-Consul-Index': str(modify_index[0])}, '[]'))
+        consul_api = ConsulApi(consul_config)
+        self.assertTrue(consul_api.write_value(self.key, {'Status': 'In Progress'}))
+        # Another writer updates the key
+        modify_index[0] = 200
+        self.assertTrue(consul_api.write_value(self.key, {'Status': 'Success'}))
+        self.assertEqual([call.request.method for call in responses.calls], ['GET', 'PUT', 'PUT', 'GET', 'PUT'])
+        self.assertEqual([call.response.status_code for call in responses.calls], [200, 200, 409, 200, 200])
+
+class TestConsulApiDegradedMode(unittest.TestCase):
+    key = 'deployments/1234/nodes/i-1234'
+
+    def create_open_consul_api(self):
+        config = dict(consul_config)
+        config['circuit_breaker'] = {'minimum_calls': 1, 'open_duration_in_ms': 60000}
+        consul_api = ConsulApi(config)
+        consul_api.circuit_breaker.record_failure()
+        return consul_api
+
+    @responses.activate
+    def test_reads_are_served_from_last_known_values(self):
+        consul_api = self.create_open_consul_api()
+        consul_api.cache.put('keyprefix/a', 10, {'property': 'a'})
+        consul_api.cache.put('keyprefix/b', 11, {'property': 'b'})
+        self.assertEqual(consul_api.get_value('keyprefix/a'), {'property': 'a'})
+        self.assertEqual(consul_api.get_keys('keyprefix'), ['keyprefix/a', 'keyprefix/b'])
+        self.assertEqual(consul_api.get_values('keyprefix').items(), [('keyprefix/a', {'property': 'a'}), ('keyprefix/b', {'property': 'b'})])
+        self.assertEqual(consul_api.get_values_batch(['keyprefix/b']).items(), [('keyprefix/b', {'property': 'b'})])
+        self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    def test_service_catalogue_is_served_from_last_known_catalogue(self):
+        with self.assertRaises(CircuitOpenError):
+            self.create_open_consul_api().get_service_catalogue()
+        config = dict(consul_config)
+        config['circuit_breaker'] = {'minimum_calls': 1, 'open_duration_in_ms': 60000}
+        consul_api = ConsulApi(config)
+        responses.add(responses.GET, 'http://localhost:8500/v1/agent/services', json={'Service1': {'Service': 'Service1', 'ID': 'Service1', 'Address': '', 'Port': 80, 'Tags': []}}, status=200)
+        consul_api.get_service_catalogue()
+        consul_api.circuit_breaker.record_failure()
+        self.assertTrue(consul_api.register_service('Service2', 'Service2', '', 81, ['deployment_id:1234']))
+        catalogue = consul_api.get_service_catalogue()
+        self.assertEqual(sorted(catalogue.keys()), ['Service1', 'Service2'])
+        self.assertEqual(catalogue['Service2']['Tags'], ['deployment_id:1234'])
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    @patch('agent.circuit_breaker.time.time')
+    def test_registrations_are_deferred_and_replayed_when_breaker_closes(self, mock_time):
+        mock_time.return_value = 100.0
+        responses.add(responses.GET, 'http://localhost:8500/v1/agent/self', json={}, status=200)
+        responses.add(responses.PUT, 'http://localhost:8500/v1/agent/service/register', status=200)
+        responses.add(responses.PUT, 'http://localhost:8500/v1/agent/check/register', status=200)
+        responses.add(responses.PUT, 'http://localhost:8500/v1/agent/check/deregister/Service1:check', status=200)
+        consul_api = self.create_open_consul_api()
+        self.assertTrue(consul_api.register_http_check('Service1', 'Service1:check', 'check', 'http://localhost/health', '10s'))
+        self.assertTrue(consul_api.deregister_check('Service1:check'))
+        self.assertTrue(consul_api.register_service('Service1', 'Service1', '', 80, []))
+        self.assertEqual(len(responses.calls), 0)
+        mock_time.return_value = 200.0
+        consul_api.check_connectivity()
+        self.assertEqual([call.request.url.split('/v1/')[1] for call in responses.calls], ['agent/self', 'agent/check/deregister/Service1:check', 'agent/service/register'])
+
+    @responses.activate
+    def test_unknown_values_fail_fast(self):
+        consul_api = self.create_open_consul_api()
+        with self.assertRaises(CircuitOpenError):
+            consul_api.get_value('keyprefix/a')
+        with self.assertRaises(CircuitOpenError):
+            consul_api.get_keys('keyprefix')
+        self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    @patch('agent.circuit_breaker.time.time')
+    def test_writes_are_queued_and_replayed_when_breaker_closes(self, mock_time):
+        mock_time.return_value = 100.0
+        responses.add(responses.GET, 'http://localhost:8500/v1/agent/self', json={}, status=200)
+        responses.add(responses.GET, 'http://localhost:8500/v1/kv/{0}'.format(self.key), status=404)
+        responses.add(responses.PUT, 'http://localhost:8500/v1/txn', json={'Results': [{'KV': {'Key': self.key, 'ModifyIndex': 12}}], 'Errors': None}, status=200)
+        consul_api = self.create_open_consul_api()
+        self.assertFalse(consul_api.write_value(self.key, {'Status': 'In Progress'}))
+        self.assertFalse(consul_api.write_value(self.key, {'Status': 'Success'}))
+        self.assertEqual(len(responses.calls), 0)
+        mock_time.return_value = 200.0
+        consul_api.check_connectivity()
+        self.assertFalse(consul_api.circuit_breaker.is_open)
+        self.assertEqual([call.request.method for call in responses.calls], ['GET', 'GET', 'PUT'])
+        operation = json.loads(responses.calls[2].request.body)[0]['KV']
+        self.assertEqual(json.loads(base64.b64decode(operation['Value'])), {'Status': 'Success'})
@@ -1,8 +1,21 @@
 # Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
 
 import unittest
+from collections import OrderedDict
 from agent import key_naming_convention
 from agent.consul_data_loader import ConsulDataLoader
+from agent.kv_cache import is_immutable_key
+
+class MockCache(object):
+    def __init__(self):
+        self.modify_indexes = {}
+        self.values = {}
+
+    def get(self, key):
+        return (True, self.values[key]) if key in self.values and is_immutable_key(key) else (False, None)
+
+    def modify_index(self, key):
+        return self.modify_indexes.get(key)
 
 class MockConsulApi(object):
     def __init__(self, environment):
@@ -24,17 +37,31 @@ class MockConsulApi(object):
             self.incorrectly_defined_service_definition_key:{ 'Service':{'Name':'Service2', 'Port':20202, 'Tags':['version:1.0.0']} },
             self.incorrectly_defined_service_installation_key:{ 'PackagePath':'http://some-location/8269ec14-1063-4e27-9e29-38e7454cdd98', 'InstallationTimeout':15 },
         }
+        self.requests = 0
+        self.cache = MockCache()
 
     def get_keys(self, services_key):
+        self.requests += 1
         if services_key == self.server_role_services_key:
             return [self.incorrectly_defined_service_key, self.correctly_defined_service_key]
         return []
 
     def get_value(self, key):
+        self.requests += 1
         print('requested key: %s' % key)
         print('value: %s' % self.kv.get(key))
         return self.kv.get(key)
 
+    def get_values(self, key_prefix):
+        self.requests += 1
+        values = OrderedDict((key, self.kv[key]) for key in sorted(self.kv.keys()) if key.startswith(key_prefix + '/'))
+        self.cache.values.update(values)
+        return values
+
+    def get_values_batch(self, keys):
+        self.requests += 1
+        return OrderedDict((key, self.kv.get(key)) for key in keys)
+
     def get_service_catalogue(self):
         return {
             'consul': {'Service':'consul', 'ID':'consul', 'Address':'', 'Port':8300, 'Tags':[]},
@@ -58,6 +85,127 @@ class TestConsulDataLoader(unittest.TestCase):
         self.assertEqual(server_role.actions[1].service.name, 'env-Service1-blue')
         self.assertEqual(server_role.actions[1].service.slice, 'blue')
 
+    def test_load_server_role_recursively(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        consul_data_loader = ConsulDataLoader(consul_api, recursive_reads=True)
+        server_role = consul_data_loader.load_server_role(environment)
+        self.assertEqual(len(server_role.actions), 2)
+        self.assertEqual(server_role.actions[0].service.name, 'env-Service1-blue')
+        self.assertEqual(server_role.actions[0].service.port, 0)
+        self.assertEqual(server_role.actions[1].service.name, 'env-Service2')
+        self.assertEqual(consul_api.requests, 3)
+
+    def test_load_server_role_recursively_reads_cached_services_once(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        consul_data_loader = ConsulDataLoader(consul_api, recursive_reads=True)
+        consul_data_loader.load_server_role(environment)
+        consul_api.requests = 0
+        server_role = consul_data_loader.load_server_role(environment)
+        self.assertEqual(len(server_role.actions), 2)
+        self.assertEqual(consul_api.requests, 1)
+
+    def test_load_server_role_in_batches(self):
+        environment = MockEnvironment('env', 'role')
+        for recursive_reads in [False, True]:
+            consul_api = MockConsulApi(environment)
+            consul_data_loader = ConsulDataLoader(consul_api, recursive_reads=recursive_reads, batch_reads=True)
+            server_role = consul_data_loader.load_server_role(environment)
+            self.assertEqual(len(server_role.actions), 2)
+            self.assertEqual(server_role.actions[0].service.installation['timeout'], 900)
+            self.assertEqual(consul_api.requests, 2 if recursive_reads else 3)
+
+    def test_load_server_role_ignores_service_with_missing_definition(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        del consul_api.kv[consul_api.incorrectly_defined_service_definition_key]
+        for recursive_reads, batch_reads in [(False, False), (True, False), (False, True)]:
+            server_role = ConsulDataLoader(consul_api, recursive_reads=recursive_reads, batch_reads=batch_reads).load_server_role(environment)
+            self.assertEqual([action.service.name for action in server_role.actions], ['env-Service1-blue'])
+
+    def test_load_server_role_ignores_invalid_role_entry(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        # Batch reads leave undecodable or deleted entries as None
+        consul_api.kv[consul_api.incorrectly_defined_service_key] = None
+        for recursive_reads, batch_reads in [(False, False), (True, True), (False, True)]:
+            server_role = ConsulDataLoader(consul_api, recursive_reads=recursive_reads, batch_reads=batch_reads).load_server_role(environment)
+            self.assertEqual([action.service.name for action in server_role.actions], ['env-Service1-blue'])
+
+    def test_load_server_role_in_parallel_keeps_key_order(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        server_role = ConsulDataLoader(consul_api, read_pool_size=4).load_server_role(environment)
+        self.assertEqual([action.service.name for action in server_role.actions], ['env-Service2', 'env-Service1-blue'])
+        self.assertEqual(consul_api.requests, 7)
+
+    def test_load_server_role_in_parallel_ignores_service_with_missing_definition(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        del consul_api.kv[consul_api.incorrectly_defined_service_definition_key]
+        server_role = ConsulDataLoader(consul_api, read_pool_size=4).load_server_role(environment)
+        self.assertEqual([action.service.name for action in server_role.actions], ['env-Service1-blue'])
+
+    def test_load_server_role_reuses_parsed_services(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        for key in consul_api.kv.keys():
+            consul_api.cache.modify_indexes[key] = 10
+        consul_data_loader = ConsulDataLoader(consul_api)
+        consul_data_loader.load_server_role(environment)
+        consul_api.kv[consul_api.correctly_defined_service_key]['Slice'] = 'green'
+        consul_api.cache.modify_indexes[consul_api.correctly_defined_service_key] = 11
+        consul_api.requests = 0
+        server_role = consul_data_loader.load_server_role(environment)
+        self.assertEqual(consul_api.requests, 2)
+        self.assertEqual((consul_data_loader.service_memo.hits, consul_data_loader.service_memo.misses), (1, 2))
+        service = server_role.actions[1].service
+        self.assertEqual((service.name, service.slice), ('env-Service1-green', 'green'))
+        self.assertEqual([tag for tag in service.tags if tag.startswith('slice:')], ['slice:green'])
+
+    def test_load_server_role_reloads_service_with_new_modify_index(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        for key in consul_api.kv.keys():
+            consul_api.cache.modify_indexes[key] = 10
+        consul_data_loader = ConsulDataLoader(consul_api)
+        consul_data_loader.load_server_role(environment)
+        consul_api.kv[consul_api.correctly_defined_service_installation_key] = {'InstallationTimeout': 30}
+        consul_api.cache.modify_indexes[consul_api.correctly_defined_service_installation_key] = 11
+        server_role = consul_data_loader.load_server_role(environment)
+        self.assertEqual(server_role.actions[1].service.installation['timeout'], 1800)
+
+    def test_load_server_role_reuses_unchanged_actions(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        for key in consul_api.kv.keys():
+            consul_api.cache.modify_indexes[key] = 10
+        consul_data_loader = ConsulDataLoader(consul_api)
+        first_actions = consul_data_loader.load_server_role(environment).actions
+        consul_api.cache.modify_indexes[consul_api.correctly_defined_service_installation_key] = 11
+        server_role = consul_data_loader.load_server_role(environment)
+        self.assertEqual(consul_data_loader.last_diff, {'added': 0, 'removed': 0, 'changed': 1, 'unchanged': 1})
+        self.assertIs(server_role.actions[0], first_actions[0])
+        self.assertIsNot(server_role.actions[1], first_actions[1])
+
+    def test_load_server_role_reads_priority_and_dependencies(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        consul_api.kv[consul_api.correctly_defined_service_key].update({'Priority': '-1', 'DependsOn': 'Service2'})
+        server_role = ConsulDataLoader(consul_api).load_server_role(environment)
+        self.assertEqual([(action.service_name, action.priority, action.depends_on) for action in server_role.actions],
+                         [('Service2', 0, []), ('Service1', -1, ['Service2'])])
+
+    def test_load_server_role_ignores_invalid_priority_and_dependencies(self):
+        environment = MockEnvironment('env', 'role')
+        consul_api = MockConsulApi(environment)
+        consul_api.kv[consul_api.correctly_defined_service_key].update({'Priority': None, 'DependsOn': 5})
+        consul_api.kv[consul_api.incorrectly_defined_service_key].update({'Priority': 'high', 'DependsOn': [None]})
+        server_role = ConsulDataLoader(consul_api).load_server_role(environment)
+        self.assertEqual([(action.service_name, action.priority, action.depends_on) for action in server_role.actions],
+                         [('Service2', 0, []), ('Service1', 0, [])])
+
     def test_load_service_catalog(self):
         consul_data_loader = ConsulDataLoader(MockConsulApi(MockEnvironment('env', 'role',)))
         services = consul_data_loader.load_service_catalogue()
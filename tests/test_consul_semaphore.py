@@ -0,0 +1,143 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import base64, json, re, responses, threading, time, unittest, urlparse
+from agent.consul_api import ConsulApi
+from agent.consul_semaphore import ConsulSemaphore
+from agent.retry_policy import RetryPolicy
+
+consul_config = {'scheme':'http', 'host':'localhost', 'port':8500, 'version':'v1', 'acl_token':None}
+key_prefix = 'environments/env/semaphores/role/download'
+
+class ConsulStandIn(object):
+    # Sessions, lock acquisition, check-and-set transactions and blocking queries of the Consul HTTP API, kept in memory
+    def __init__(self):
+        self.kv = {}
+        self.sessions = set()
+        self.index = 1
+        self.condition = threading.Condition()
+
+    def register(self):
+        base_url = 'http://localhost:8500/v1/'
+        responses.add_callback(responses.PUT, re.compile(base_url + 'session/create'), callback=self.create_session)
+        responses.add_callback(responses.PUT, re.compile(base_url + 'session/renew/.*'), callback=self.renew_session)
+        responses.add_callback(responses.PUT, re.compile(base_url + 'session/destroy/.*'), callback=self.destroy_session)
+        responses.add_callback(responses.PUT, re.compile(base_url + 'kv/.*'), callback=self.acquire)
+        responses.add_callback(responses.GET, re.compile(base_url + 'kv/.*'), callback=self.read)
+        responses.add_callback(responses.PUT, base_url + 'txn', callback=self.transaction)
+
+    def _set(self, key, value, session=None):
+        self.index += 1
+        self.kv[key] = {'Key': key, 'Value': base64.b64encode(value), 'ModifyIndex': self.index, 'Session': session}
+        self.condition.notify_all()
+
+    def expire(self, session_id):
+        with self.condition:
+            self.sessions.discard(session_id)
+            for key in [key for key, entry in self.kv.items() if entry['Session'] == session_id]:
+                del self.kv[key]
+            self.index += 1
+            self.condition.notify_all()
+
+    def create_session(self, request):
+        with self.condition:
+            session_id = 'session-{0}'.format(self.index)
+            self.index += 1
+            self.sessions.add(session_id)
+        return (200, {}, json.dumps({'ID': session_id}))
+
+    def renew_session(self, request):
+        return (200 if request.url.split('/')[-1] in self.sessions else 404, {}, '[]')
+
+    def destroy_session(self, request):
+        self.expire(request.url.split('/')[-1])
+        return (200, {}, 'true')
+
+    def acquire(self, request):
+        url = urlparse.urlparse(request.url)
+        key = url.path[len('/v1/kv/'):]
+        session_id = urlparse.parse_qs(url.query)['acquire'][0]
+        with self.condition:
+            entry = self.kv.get(key)
+            if session_id not in self.sessions or (entry is not None and entry['Session'] not in (None, session_id)):
+                return (200, {}, 'false')
+            self._set(key, request.body, session_id)
+        return (200, {}, 'true')
+
+    def read(self, request):
+        url = urlparse.urlparse(request.url)
+        key_prefix = url.path[len('/v1/kv/'):]
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+        index = int(query.get('index', ['0'])[0])
+        deadline = time.time() + int(query.get('wait', ['0ms'])[0][:-2]) / 1000.0
+        with self.condition:
+            while index and self.index <= index and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            entries = [dict(entry) for key, entry in sorted(self.kv.items()) if key.startswith(key_prefix)]
+            return (200 if entries else 404, {'X-Consul-Index': str(self.index)}, json.dumps(entries))
+
+    def transaction(self, request):
+        operation = json.loads(request.body)[0]['KV']
+        with self.condition:
+            entry = self.kv.get(operation['Key'])
+            if (entry['ModifyIndex'] if entry is not None else 0) != operation['Index']:
+                return (409, {}, json.dumps({'Errors': [{'What': 'failed to set key'}]}))
+            self._set(operation['Key'], base64.b64decode(operation['Value']))
+            return (200, {}, json.dumps({'Results': [{'KV': {'ModifyIndex': self.index}}]}))
+
+class TestConsulSemaphore(unittest.TestCase):
+    def setUp(self):
+        self.consul = ConsulStandIn()
+        self.consul_api = ConsulApi(consul_config, RetryPolicy({'consul_read': {'max_attempts': 1}, 'consul_write': {'max_attempts': 1}}))
+
+    def create_semaphore(self, limit=2, wait_timeout_in_ms=5000):
+        return ConsulSemaphore(self.consul_api, key_prefix, limit, wait_timeout_in_ms=wait_timeout_in_ms, blocking_query_wait_in_ms=1000)
+
+    def holders(self):
+        return json.loads(base64.b64decode(self.consul.kv['{0}/.lock'.format(key_prefix)]['Value']))['Holders']
+
+    @responses.activate
+    def test_slots_are_limited_and_wait_fails_open_on_timeout(self):
+        self.consul.register()
+        semaphores = [self.create_semaphore(wait_timeout_in_ms=200) for _ in range(3)]
+        self.assertEqual([semaphore.acquire() for semaphore in semaphores], [True, True, False])
+        self.assertEqual(len(self.holders()), 2)
+        # The contender key of the semaphore that gave up is deleted with its session
+        self.assertEqual(len([key for key in self.consul.kv if not key.endswith('.lock')]), 2)
+        for semaphore in semaphores:
+            semaphore.release()
+        self.assertEqual(self.holders(), [])
+
+    @responses.activate
+    def test_released_slot_is_taken_by_waiting_contender(self):
+        self.consul.register()
+        first, second = self.create_semaphore(limit=1), self.create_semaphore(limit=1)
+        self.assertTrue(first.acquire())
+        results = []
+        thread = threading.Thread(target=lambda: results.append(second.acquire()))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+        first.release()
+        thread.join(5)
+        self.assertEqual(results, [True])
+        second.release()
+        self.assertEqual(self.holders(), [])
+
+    @responses.activate
+    def test_slot_of_expired_session_is_reclaimed(self):
+        self.consul.register()
+        first, second = self.create_semaphore(limit=1), self.create_semaphore(limit=1)
+        self.assertTrue(first.acquire())
+        self.consul.expire(self.holders()[0])
+        self.assertTrue(second.acquire())
+        self.assertEqual(len(self.holders()), 1)
+        first.release()
+        second.release()
+
+    @responses.activate
+    def test_fails_open_when_consul_is_unavailable(self):
+        responses.add(responses.PUT, 'http://localhost:8500/v1/session/create', status=500, body='Some error message')
+        semaphore = self.create_semaphore()
+        self.assertFalse(semaphore.acquire())
+        self.assertFalse(semaphore.is_held)
+        semaphore.release()
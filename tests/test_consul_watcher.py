@@ -0,0 +1,60 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import unittest
+from agent.consul_watcher import ConsulWatcher
+
+class MockConsulApi(object):
+    def __init__(self, indexes):
+        self.indexes = list(indexes)
+        self.queries = []
+
+    def watch_key_prefix(self, key_prefix, index=0, wait_in_ms=None):
+        self.queries.append((key_prefix, index, wait_in_ms))
+        new_index = self.indexes.pop(0)
+        return (new_index, [{'Key': key_prefix, 'ModifyIndex': new_index}])
+
+class TestConsulWatcher(unittest.TestCase):
+    def test_prime_does_not_block(self):
+        consul_api = MockConsulApi([10])
+        watcher = ConsulWatcher(consul_api, 'prefix', wait_in_ms=1000)
+        self.assertEqual(watcher.prime(), 10)
+        self.assertEqual(consul_api.queries, [('prefix', 0, None)])
+
+    def test_index_is_chained_between_queries(self):
+        consul_api = MockConsulApi([10, 12, 15])
+        watcher = ConsulWatcher(consul_api, 'prefix', wait_in_ms=1000)
+        watcher.prime()
+        self.assertEqual(watcher.wait_for_change(), 12)
+        self.assertEqual(watcher.wait_for_change(), 15)
+        self.assertEqual(consul_api.queries, [('prefix', 0, None), ('prefix', 10, 1000), ('prefix', 12, 1000)])
+        self.assertEqual(watcher.entries, [{'Key': 'prefix', 'ModifyIndex': 15}])
+
+    def test_timeouts_are_not_reported_as_changes(self):
+        consul_api = MockConsulApi([10, 10, 10, 11])
+        watcher = ConsulWatcher(consul_api, 'prefix')
+        watcher.prime()
+        self.assertEqual(watcher.wait_for_change(), 11)
+        self.assertEqual(len(consul_api.queries), 4)
+
+    def test_index_going_backwards_is_reported_as_change(self):
+        consul_api = MockConsulApi([10, 4, 5])
+        watcher = ConsulWatcher(consul_api, 'prefix')
+        watcher.prime()
+        self.assertEqual(watcher.wait_for_change(), 4)
+        self.assertEqual(watcher.wait_for_change(), 5)
+
+    def test_index_reset_to_zero_is_clamped(self):
+        consul_api = MockConsulApi([10, 0, 3])
+        watcher = ConsulWatcher(consul_api, 'prefix')
+        watcher.prime()
+        self.assertEqual(watcher.wait_for_change(), 1)
+        self.assertEqual(consul_api.queries[-1][1], 10)
+        watcher.wait_for_change()
+        self.assertEqual(consul_api.queries[-1][1], 1)
+
+    def test_changes_yields_each_change(self):
+        consul_api = MockConsulApi([1, 2, 2, 3])
+        watcher = ConsulWatcher(consul_api, 'prefix')
+        watcher.prime()
+        changes = watcher.changes()
+        self.assertEqual([next(changes), next(changes)], [2, 3])
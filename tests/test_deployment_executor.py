@@ -0,0 +1,145 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import os, shutil, tempfile, threading, unittest
+from agent.actions import InstallAction
+from agent.deployment_executor import DeploymentExecutor, get_action_resources, is_conflicting
+from agent.server_role import ServerRole
+from mock import patch
+
+class MockService(object):
+    def __init__(self, id, deployment_id, port=0):
+        self.id = id
+        self.deployment_id = deployment_id
+        self.port = port
+
+class MockDeployments(object):
+    # Registers the service of every executed action, optionally waiting until a number of deployments run at once
+    def __init__(self, number_of_concurrent_deployments=1):
+        self.registered_services = []
+        self.executed = []
+        self.lock = threading.Lock()
+        self.all_started = threading.Event()
+        self.number_of_concurrent_deployments = number_of_concurrent_deployments
+        self.number_of_running_deployments = self.max_number_of_running_deployments = 0
+
+    def execute(self, action, action_info):
+        with self.lock:
+            self.executed.append(action.deployment_id)
+            self.number_of_running_deployments += 1
+            self.max_number_of_running_deployments = max(self.max_number_of_running_deployments, self.number_of_running_deployments)
+            if self.number_of_running_deployments >= self.number_of_concurrent_deployments:
+                self.all_started.set()
+        self.all_started.wait(5)
+        with self.lock:
+            self.number_of_running_deployments -= 1
+            self.registered_services.append(MockService(action.service.id, action.deployment_id))
+        return {'id': action.deployment_id, 'is_success': True}
+
+    def services(self):
+        with self.lock:
+            return list(self.registered_services)
+
+def create_server_role(*services):
+    server_role = ServerRole('role')
+    server_role.actions = [InstallAction(service.deployment_id, service) for service in services]
+    for action in server_role.actions:
+        action.service_name = action.service.id
+    return server_role
+
+class TestDeploymentExecutor(unittest.TestCase):
+    def test_single_worker_runs_actions_in_order(self):
+        deployments = MockDeployments()
+        server_role = create_server_role(MockService('Service1', 'd1'), MockService('Service2', 'd2'))
+        self.assertTrue(DeploymentExecutor(deployments.execute).run(server_role, deployments.services))
+        self.assertEqual(deployments.executed, ['d1', 'd2'])
+        self.assertEqual(deployments.max_number_of_running_deployments, 1)
+        self.assertEqual(server_role.quarantine, set(['d1', 'd2']))
+
+    def test_actions_for_different_services_run_concurrently(self):
+        deployments = MockDeployments(number_of_concurrent_deployments=3)
+        server_role = create_server_role(MockService('Service1', 'd1'), MockService('Service2', 'd2'), MockService('Service3', 'd3'))
+        DeploymentExecutor(deployments.execute, max_workers=3).run(server_role, deployments.services)
+        self.assertEqual(deployments.max_number_of_running_deployments, 3)
+        self.assertEqual(server_role.quarantine, set(['d1', 'd2', 'd3']))
+
+    def test_conflicting_actions_run_in_order(self):
+        deployments = MockDeployments()
+        server_role = create_server_role(MockService('Service1', 'd1', port=8080), MockService('Service2', 'd2', port=8080), MockService('Service1', 'd3'))
+        def get_resources(action, action_info):
+            return set([('service', action.service.id), ('port', action.service.port)])
+        DeploymentExecutor(deployments.execute, max_workers=3, get_resources=get_resources).run(server_role, deployments.services)
+        self.assertEqual(deployments.executed, ['d1', 'd2', 'd3'])
+        self.assertEqual(deployments.max_number_of_running_deployments, 1)
+
+    def test_actions_wait_for_the_services_they_depend_on(self):
+        deployments = MockDeployments()
+        server_role = create_server_role(MockService('Service1', 'd1'), MockService('Service2', 'd2'), MockService('Service3', 'd3'))
+        server_role.actions[0].depends_on = ['Service2']
+        server_role.actions[1].depends_on = ['Service3', 'Unknown']
+        DeploymentExecutor(deployments.execute, max_workers=3).run(server_role, deployments.services)
+        self.assertEqual(deployments.executed, ['d3', 'd2', 'd1'])
+        self.assertEqual(deployments.max_number_of_running_deployments, 1)
+
+    def test_dependency_cycle_does_not_block_deployments(self):
+        deployments = MockDeployments()
+        server_role = create_server_role(MockService('Service1', 'd1'), MockService('Service2', 'd2'), MockService('Service3', 'd3'))
+        server_role.actions[0].depends_on = ['Service2']
+        server_role.actions[1].depends_on = ['Service1']
+        DeploymentExecutor(deployments.execute, max_workers=3).run(server_role, deployments.services)
+        self.assertEqual(deployments.executed, ['d3', 'd1', 'd2'])
+
+    def test_waiting_actions_are_prefetched(self):
+        deployments = MockDeployments()
+        server_role = create_server_role(MockService('Service1', 'd1'), MockService('Service2', 'd2'), MockService('Service3', 'd3'))
+        prefetched = []
+        def prefetch(waiting_actions, running_actions):
+            prefetched.append(([action.deployment_id for action in waiting_actions], [action.deployment_id for action in running_actions]))
+        DeploymentExecutor(deployments.execute, prefetch=prefetch).run(server_role, deployments.services)
+        self.assertEqual(prefetched, [(['d2', 'd3'], ['d1']), (['d3'], ['d2']), ([], ['d3']), ([], [])])
+
+    def test_failed_deployment_is_quarantined_and_reported(self):
+        deployments = MockDeployments()
+        def execute(action, action_info):
+            report = deployments.execute(action, action_info)
+            return dict(report, is_success=action.deployment_id != 'd1')
+        server_role = create_server_role(MockService('Service1', 'd1'), MockService('Service2', 'd2'))
+        self.assertFalse(DeploymentExecutor(execute).run(server_role, deployments.services))
+        self.assertEqual(deployments.executed, ['d1', 'd2'])
+        self.assertEqual(server_role.quarantine, set(['d1', 'd2']))
+
+    def test_unexpected_error_is_raised_once_running_deployments_finish(self):
+        deployments = MockDeployments(number_of_concurrent_deployments=2)
+        def execute(action, action_info):
+            if action.deployment_id == 'd1':
+                raise RuntimeError('Some error message')
+            return deployments.execute(action, action_info)
+        deployments.all_started.set()
+        server_role = create_server_role(MockService('Service1', 'd1'), MockService('Service2', 'd2'), MockService('Service3', 'd3'))
+        with self.assertRaises(RuntimeError):
+            DeploymentExecutor(execute, max_workers=2).run(server_role, deployments.services)
+        self.assertNotIn('d1', server_role.quarantine)
+
+class TestActionResources(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_is_conflicting(self):
+        self.assertTrue(is_conflicting(set([('port', 8080)]), set([('service', 'Service1'), ('port', 8080)])))
+        self.assertTrue(is_conflicting(set([('path', '/opt/app')]), set([('path', '/opt/app/config')])))
+        self.assertFalse(is_conflicting(set([('path', '/opt/app')]), set([('path', '/opt/application')])))
+        self.assertFalse(is_conflicting(set([('service', 'Service1')]), set([('service', 'Service2')])))
+
+    @patch('agent.deployment_executor.find_deployment_dir')
+    def test_resources_include_files_of_previous_deployment(self, mock_find_deployment_dir):
+        os.makedirs(os.path.join(self.directory, 'archive'))
+        with open(os.path.join(self.directory, 'archive', 'appspec.yml'), 'w') as appspec_file:
+            appspec_file.write('files:\n  - source: /app\n    destination: /opt/app/\n')
+        mock_find_deployment_dir.return_value = self.directory
+        action = InstallAction('d2', MockService('Service1', 'd2', port=8080))
+        resources = get_action_resources(action, {'last_deployment_id': 'd1'}, 'linux')
+        self.assertEqual(resources, set([('service', 'Service1'), ('port', 8080), ('path', '/opt/app')]))
+        mock_find_deployment_dir.assert_called_with('linux', 'Service1', 'd1')
+        self.assertEqual(get_action_resources(action, {'last_deployment_id': None}, 'linux'), set([('service', 'Service1'), ('port', 8080)]))
@@ -0,0 +1,42 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import os, shutil, tempfile, unittest
+from agent.duration_history import DurationHistory, median
+
+class TestDurationHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'durations.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_median(self):
+        self.assertEqual(median([3, 1, 2]), 2)
+        self.assertEqual(median([4, 1, 2, 3]), 2.5)
+
+    def test_estimate_of_unknown_service(self):
+        self.assertIsNone(DurationHistory().estimate_in_ms('Service1'))
+
+    def test_estimate_sums_median_stage_durations(self):
+        history = DurationHistory()
+        history.record('Service1', {'DownloadBundleFromS3': 100, 'StartApplication': 10})
+        history.record('Service1', {'DownloadBundleFromS3': 300, 'StartApplication': 30})
+        history.record('Service1', {'DownloadBundleFromS3': 200, 'StartApplication': 2000})
+        self.assertEqual(history.estimate_in_ms('Service1'), 230)
+
+    def test_keeps_recent_samples_only(self):
+        history = DurationHistory(max_samples=2)
+        for duration in [1000, 10, 20]:
+            history.record('Service1', {'CopyFiles': duration})
+        self.assertEqual(history.estimate_in_ms('Service1'), 15)
+
+    def test_history_is_saved_and_loaded(self):
+        DurationHistory(self.filepath).record('Service1', {'CopyFiles': 50})
+        self.assertEqual(DurationHistory(self.filepath).estimate_in_ms('Service1'), 50)
+        self.assertEqual(os.listdir(self.directory), ['durations.json'])
+
+    def test_corrupt_history_is_ignored(self):
+        with open(self.filepath, 'w') as history_file:
+            history_file.write('{')
+        self.assertIsNone(DurationHistory(self.filepath).estimate_in_ms('Service1'))
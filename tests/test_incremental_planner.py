@@ -0,0 +1,44 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import unittest
+from agent.actions import InstallAction
+from agent.incremental_planner import IncrementalPlanner
+from agent.server_role import ServerRole
+
+class MockService(object):
+    def __init__(self, id, deployment_id):
+        self.id = id
+        self.deployment_id = deployment_id
+
+def create_server_role(*actions):
+    server_role = ServerRole('role')
+    server_role.actions = list(actions)
+    return server_role
+
+class TestIncrementalPlanner(unittest.TestCase):
+    def setUp(self):
+        self.action1 = InstallAction('d1', MockService('Service1', 'd1'))
+        self.action2 = InstallAction('d2', MockService('Service2', 'd2'))
+        self.catalogue = [MockService('Service1', 'd1'), MockService('Service2', 'd2')]
+        self.planner = IncrementalPlanner()
+
+    def test_all_actions_are_planned_initially(self):
+        server_role = create_server_role(self.action1, self.action2)
+        self.assertEqual(self.planner.actions_to_plan(server_role, self.catalogue), [self.action1, self.action2])
+
+    def test_applied_actions_are_not_planned_again(self):
+        self.planner.record([self.action1, self.action2], self.catalogue)
+        action3 = InstallAction('d3', MockService('Service2', 'd3'))
+        server_role = create_server_role(self.action1, action3)
+        self.assertEqual(self.planner.actions_to_plan(server_role, self.catalogue), [action3])
+
+    def test_actions_not_applied_are_planned_again(self):
+        self.planner.record([self.action1, self.action2], self.catalogue[:1])
+        server_role = create_server_role(self.action1, self.action2)
+        self.assertEqual(self.planner.actions_to_plan(server_role, self.catalogue[:1]), [self.action2])
+
+    def test_actions_with_changed_catalogue_entries_are_planned_again(self):
+        self.planner.record([self.action1, self.action2], self.catalogue)
+        server_role = create_server_role(self.action1, self.action2)
+        # Service1 was deregistered outside of the agent
+        self.assertEqual(self.planner.actions_to_plan(server_role, self.catalogue[1:]), [self.action1])
@@ -61,3 +61,6 @@ class TestKeyNamingConvention(unittest.TestCase):
 
     def test_service_installation_key(self):
         self.assertEqual(key_naming_convention.get_service_installation_key(MockEnvironment('env'), 'name', 'version'), 'environments/env/services/name/version/installation')
+
+    def test_download_semaphore_key(self):
+        self.assertEqual(key_naming_convention.get_download_semaphore_key(MockEnvironment('env', 'role')), 'environments/env/semaphores/role/download')
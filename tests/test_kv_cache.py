@@ -0,0 +1,115 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import base64, json, unittest
+from agent.kv_cache import KeyValueCache, is_immutable_key
+
+definition_key = 'environments/env/services/Service1/1.0.0/definition'
+role_key = 'environments/env/roles/role'
+
+def decode(value):
+    return json.loads(base64.b64decode(value))
+
+def entry(key, value, modify_index):
+    return {'Key': key, 'Value': base64.b64encode(json.dumps(value)), 'ModifyIndex': modify_index}
+
+class TestKeyValueCache(unittest.TestCase):
+    def test_is_immutable_key(self):
+        self.assertTrue(is_immutable_key(definition_key))
+        self.assertTrue(is_immutable_key('environments/env/services/Service1/1.0.0/installation'))
+        self.assertFalse(is_immutable_key('environments/env/roles/role/services/Service1/blue'))
+        self.assertFalse(is_immutable_key('deployments/1234/nodes/i-1234'))
+
+    def test_immutable_key_is_served_from_cache(self):
+        cache = KeyValueCache()
+        cache.put(definition_key, 10, {'Service': {'Name': 'Service1'}})
+        self.assertEqual(cache.get(definition_key), (True, {'Service': {'Name': 'Service1'}}))
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_cached_values_are_copies(self):
+        cache = KeyValueCache()
+        value = {'Service': {'Name': 'Service1'}}
+        cache.put(definition_key, 10, value)
+        value['Service']['Address'] = '127.0.0.1'
+        is_cached, cached_value = cache.get(definition_key)
+        cached_value['Service']['ID'] = 'id'
+        self.assertEqual(cache.get(definition_key)[1], {'Service': {'Name': 'Service1'}})
+
+    def test_unwatched_mutable_key_is_not_served_from_cache(self):
+        cache = KeyValueCache()
+        cache.put('deployments/1234/nodes/i-1234', 10, {'Status': 'Success'})
+        self.assertEqual(cache.get('deployments/1234/nodes/i-1234'), (False, None))
+        self.assertEqual(cache.misses, 1)
+
+    def test_older_modify_index_does_not_replace_value(self):
+        cache = KeyValueCache()
+        cache.put(definition_key, 10, 'new')
+        cache.put(definition_key, 9, 'old')
+        self.assertEqual(cache.get(definition_key), (True, 'new'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = KeyValueCache(max_entries=2)
+        keys = ['environments/env/services/Service{0}/1.0.0/definition'.format(i) for i in range(3)]
+        cache.put(keys[0], 1, 0)
+        cache.put(keys[1], 1, 1)
+        cache.get(keys[0])
+        cache.put(keys[2], 1, 2)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(keys[1]), (False, None))
+        self.assertEqual(cache.get(keys[0]), (True, 0))
+
+    def test_refresh_keeps_watched_keys_up_to_date(self):
+        cache = KeyValueCache()
+        service_key = role_key + '/services/Service1/blue'
+        other_key = role_key + '/services/Service2/blue'
+        cache.watch(role_key)
+        cache.refresh(role_key, [entry(service_key, {'Version': '1.0.0'}, 10), entry(other_key, {'Version': '2.0.0'}, 11)], decode)
+        self.assertEqual(cache.get(service_key), (True, {'Version': '1.0.0'}))
+        cache.refresh(role_key, [entry(service_key, {'Version': '1.0.1'}, 12)], decode)
+        self.assertEqual(cache.get(service_key), (True, {'Version': '1.0.1'}))
+        self.assertEqual(cache.get(other_key), (False, None))
+
+    def test_refresh_invalidates_undecodable_values(self):
+        cache = KeyValueCache()
+        service_key = role_key + '/services/Service1/blue'
+        cache.watch(role_key)
+        cache.refresh(role_key, [entry(service_key, {'Version': '1.0.0'}, 10)], decode)
+        cache.refresh(role_key, [{'Key': service_key, 'Value': base64.b64encode('not json'), 'ModifyIndex': 11}], decode)
+        self.assertEqual(cache.get(service_key), (False, None))
+
+    def test_refreshed_keys_are_not_served_from_cache_once_unwatched(self):
+        cache = KeyValueCache()
+        service_key = role_key + '/services/Service1/blue'
+        cache.refresh(role_key, [entry(service_key, {'Version': '1.0.0'}, 10)], decode)
+        self.assertEqual(cache.get(service_key), (False, None))
+        cache.watch(role_key)
+        self.assertEqual(cache.get(service_key), (True, {'Version': '1.0.0'}))
+        cache.unwatch(role_key)
+        self.assertEqual(cache.get(service_key), (False, None))
+
+    def test_watched_prefix_matches_whole_path_segments(self):
+        cache = KeyValueCache()
+        other_role_key = role_key + '-canary/services/Service1/blue'
+        cache.watch(role_key)
+        cache.put(other_role_key, 10, {'Version': '1.0.0'})
+        cache.refresh(role_key, [], decode)
+        self.assertEqual(cache.get(other_role_key), (False, None))
+        self.assertEqual(cache.get_last_known(other_role_key), (True, {'Version': '1.0.0'}))
+
+    def test_prefix_index_is_highest_modify_index_under_prefix(self):
+        cache = KeyValueCache()
+        service_prefix = 'environments/env/services/Service1/1.0.0/'
+        self.assertIsNone(cache.prefix_index(service_prefix))
+        cache.put(definition_key, 10, {'Service': {}})
+        cache.put(service_prefix + 'installation', 12, {})
+        cache.put('environments/env/services/Service1/1.0.01/definition', 20, {})
+        self.assertEqual(cache.prefix_index(service_prefix), 12)
+
+    def test_modify_index_of_mutable_key_is_unknown_unless_watched(self):
+        cache = KeyValueCache()
+        service_key = role_key + '/services/Service1/blue'
+        cache.put(definition_key, 10, {'Service': {}})
+        cache.put(service_key, 11, {'Version': '1.0.0'})
+        self.assertEqual(cache.modify_index(definition_key), 10)
+        self.assertIsNone(cache.modify_index(service_key))
+        cache.watch(role_key)
+        self.assertEqual(cache.modify_index(service_key), 11)
@@ -0,0 +1,65 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import threading, time, unittest
+from agent.consul_api import ConsulError
+from agent.report_writer import ReportWriter
+
+class MockConsulApi(object):
+    def __init__(self, delay=0, error=None):
+        self.delay = delay
+        self.error = error
+        self.writes = []
+        self.lock = threading.Lock()
+
+    def write_value(self, key, value):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            self.writes.append((key, value))
+        return True
+
+class TestReportWriter(unittest.TestCase):
+    def test_submit_does_not_wait_for_write(self):
+        consul_api = MockConsulApi(delay=0.5)
+        writer = ReportWriter(consul_api, 'key', max_delay_in_ms=0)
+        start = time.time()
+        writer.submit({'Status': 'In Progress'})
+        self.assertTrue(time.time() - start < 0.1)
+        writer.close()
+        self.assertEqual(consul_api.writes, [('key', {'Status': 'In Progress'})])
+
+    def test_rapid_updates_are_merged(self):
+        consul_api = MockConsulApi()
+        writer = ReportWriter(consul_api, 'key', max_delay_in_ms=10000)
+        report = {}
+        for i in range(10):
+            report['LastCompletedStage'] = 'Stage{0}'.format(i)
+            writer.submit(report)
+        report['Status'] = 'Success'
+        writer.submit(report)
+        writer.close()
+        self.assertEqual(consul_api.writes, [('key', {'LastCompletedStage': 'Stage9', 'Status': 'Success'})])
+        self.assertEqual((writer.number_of_updates, writer.number_of_writes), (11, 1))
+
+    def test_pending_update_is_written_after_max_delay(self):
+        consul_api = MockConsulApi()
+        writer = ReportWriter(consul_api, 'key', max_delay_in_ms=50)
+        writer.submit({'Status': 'In Progress'})
+        time.sleep(0.5)
+        self.assertEqual(len(consul_api.writes), 1)
+        writer.close()
+
+    def test_flush_waits_for_write(self):
+        consul_api = MockConsulApi(delay=0.1)
+        writer = ReportWriter(consul_api, 'key', max_delay_in_ms=10000)
+        writer.submit({'Status': 'In Progress'})
+        writer.flush()
+        self.assertEqual(len(consul_api.writes), 1)
+        writer.close()
+
+    def test_failed_write_does_not_block_close(self):
+        writer = ReportWriter(MockConsulApi(error=ConsulError('Some error message')), 'key', max_delay_in_ms=0)
+        writer.submit({'Status': 'Failed'})
+        writer.close()
+        self.assertEqual(writer.number_of_writes, 0)
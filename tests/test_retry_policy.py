@@ -0,0 +1,91 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import unittest
+from agent.retry_policy import RetryBudget, RetryPolicy
+from mock import patch
+
+class Failing(object):
+    def __init__(self, number_of_failures):
+        self.number_of_failures = number_of_failures
+        self.number_of_calls = 0
+    def __call__(self):
+        self.number_of_calls += 1
+        if self.number_of_calls <= self.number_of_failures:
+            raise IOError('Failure {0}'.format(self.number_of_calls))
+        return 'result'
+
+def retry_on_io_error(exception):
+    return isinstance(exception, IOError)
+
+config = {'s3': {'base_delay_in_ms': 0, 'max_delay_in_ms': 0, 'max_attempts': 3, 'retry_budget': 2, 'retry_ratio': 0.5}}
+
+class TestRetryBudget(unittest.TestCase):
+    def test_withdraw_until_exhausted(self):
+        budget = RetryBudget(2, 0.5)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+    def test_deposit_is_capped(self):
+        budget = RetryBudget(2, 0.5)
+        budget.withdraw()
+        for _ in range(10):
+            budget.deposit()
+        self.assertEqual(budget.balance, 2)
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_delay_is_within_exponential_bound(self):
+        policy = RetryPolicy({'consul_read': {'base_delay_in_ms': 100, 'max_delay_in_ms': 1000}})
+        for attempt_number, bound in [(1, 100), (2, 200), (4, 800), (5, 1000), (10, 1000)]:
+            for _ in range(50):
+                delay = policy.delay_in_ms('consul_read', attempt_number)
+                self.assertTrue(0 <= delay <= bound)
+
+    @patch('agent.retry_policy.random.uniform')
+    def test_delay_uses_full_jitter(self, mock_uniform):
+        mock_uniform.return_value = 42
+        policy = RetryPolicy({'consul_read': {'base_delay_in_ms': 100, 'max_delay_in_ms': 1000}})
+        self.assertEqual(policy.delay_in_ms('consul_read', 3), 42)
+        mock_uniform.assert_called_with(0, 400)
+
+    def test_call_retries_until_success(self):
+        func = Failing(2)
+        self.assertEqual(RetryPolicy(config).call('s3', retry_on_io_error, func), 'result')
+        self.assertEqual(func.number_of_calls, 3)
+
+    def test_call_stops_after_max_attempts(self):
+        func = Failing(5)
+        with self.assertRaises(IOError):
+            RetryPolicy(config).call('s3', retry_on_io_error, func)
+        self.assertEqual(func.number_of_calls, 3)
+
+    def test_call_does_not_retry_other_exceptions(self):
+        def func():
+            raise ValueError('Some error message')
+        with self.assertRaises(ValueError):
+            RetryPolicy(config).call('s3', retry_on_io_error, func)
+
+    def test_call_stops_when_budget_is_exhausted(self):
+        policy = RetryPolicy(config)
+        policy.call('s3', retry_on_io_error, Failing(2))
+        func = Failing(2)
+        with self.assertRaises(IOError):
+            policy.call('s3', retry_on_io_error, func)
+        self.assertEqual(func.number_of_calls, 1)
+        # The next call earns enough of the budget back for one retry
+        self.assertEqual(policy.call('s3', retry_on_io_error, Failing(1)), 'result')
+
+    def test_budgets_are_per_operation_class(self):
+        policy = RetryPolicy(config)
+        policy.call('s3', retry_on_io_error, Failing(2))
+        self.assertEqual(policy.call('consul_read', retry_on_io_error, Failing(1)), 'result')
+
+    def test_converge_stagger_is_stable_per_instance(self):
+        policy = RetryPolicy({'converge_stagger_in_ms': 10000})
+        delays = [policy.converge_stagger_in_ms('i-{0:08x}'.format(i)) for i in range(100)]
+        self.assertEqual(delays[0], policy.converge_stagger_in_ms('i-00000000'))
+        self.assertTrue(all(0 <= delay <= 10000 for delay in delays))
+        self.assertTrue(len(set(delays)) > 90)
+
+    def test_converge_stagger_is_disabled_by_default(self):
+        self.assertEqual(RetryPolicy().converge_stagger_in_ms('i-1234'), 0)
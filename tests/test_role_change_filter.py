@@ -0,0 +1,57 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import base64, json, unittest
+from agent.role_change_filter import RoleChangeFilter
+
+services_key = 'environments/env/roles/role/services'
+
+def entry(key, value, modify_index=1):
+    return {'Key': key, 'Value': base64.b64encode(json.dumps(value)) if value is not None else None, 'ModifyIndex': modify_index}
+
+def service_entry(name, version, deployment_id, modify_index=1, **kwargs):
+    value = {'Name': name, 'Version': version, 'Slice': 'blue', 'DeploymentId': deployment_id}
+    value.update(kwargs)
+    return entry('{0}/{1}/blue'.format(services_key, name), value, modify_index)
+
+class TestRoleChangeFilter(unittest.TestCase):
+    def setUp(self):
+        self.entries = [
+            entry('environments/env/roles/role/configuration', {'some': 'configuration'}),
+            service_entry('Service1', '1.0.0', 'd1'),
+            service_entry('Service2', '2.0.0', 'd2')]
+        self.change_filter = RoleChangeFilter(services_key)
+        self.change_filter.prime(self.entries)
+
+    def test_unrelated_write_is_suppressed(self):
+        entries = [entry('environments/env/roles/role/configuration', {'some': 'other configuration'}, 2)] + self.entries[1:]
+        self.assertFalse(self.change_filter.has_changed(entries))
+        self.assertEqual(self.change_filter.number_of_suppressed_changes, 1)
+
+    def test_rewrite_of_same_desired_state_is_suppressed(self):
+        entries = [self.entries[0], self.entries[2], service_entry('Service1', '1.0.0', 'd1', modify_index=5)]
+        self.assertFalse(self.change_filter.has_changed(entries))
+
+    def test_new_deployment_is_a_change(self):
+        entries = self.entries[:2] + [service_entry('Service2', '2.0.1', 'd3')]
+        self.assertTrue(self.change_filter.has_changed(entries))
+        self.assertFalse(self.change_filter.has_changed(entries))
+
+    def test_action_change_is_a_change(self):
+        entries = self.entries[:2] + [service_entry('Service2', '2.0.0', 'd2', Action='Ignore')]
+        self.assertTrue(self.change_filter.has_changed(entries))
+
+    def test_priority_or_dependency_change_is_a_change(self):
+        self.assertTrue(self.change_filter.has_changed(self.entries[:1] + [service_entry('Service1', '1.0.0', 'd1', 2, Priority=1)] + self.entries[2:]))
+        self.assertTrue(self.change_filter.has_changed(self.entries[:1] + [service_entry('Service1', '1.0.0', 'd1', 3, Priority=1, DependsOn='Service2')] + self.entries[2:]))
+
+    def test_removed_service_is_a_change(self):
+        self.assertTrue(self.change_filter.has_changed(self.entries[:2]))
+
+    def test_invalid_entry_is_compared_by_content(self):
+        invalid_entry = {'Key': '{0}/Service3/none'.format(services_key), 'Value': base64.b64encode('not json'), 'ModifyIndex': 1}
+        self.assertTrue(self.change_filter.has_changed(self.entries + [invalid_entry]))
+        self.assertFalse(self.change_filter.has_changed(self.entries + [invalid_entry]))
+
+    def test_reset_forces_next_change(self):
+        self.change_filter.reset()
+        self.assertTrue(self.change_filter.has_changed(self.entries))
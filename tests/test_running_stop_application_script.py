@@ -30,6 +30,12 @@ class TestStopApplicationStageIsCalledInEventOfFailure(unittest.TestCase):
         self.assertTrue(self.stop_application.verify())
         self.assertEquals(self.stop_application.executed_count, 1)
 
+    def test_duration_of_each_stage_is_recorded(self):
+        durations = {}
+        self.sut([Works(), self.stop_application], object(), Reporter().method, Logger(), durations)
+
+        self.assertEqual(sorted(durations.keys()), ['StopApplication', 'working'])
+
 
 ###########
 # HELPERS #
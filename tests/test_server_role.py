@@ -55,3 +55,42 @@ class TestServerRole(unittest.TestCase):
         ]
         server_role.quarantine = ['2419483e-6aef-4dd9-a46e-dc00966ba2b2']
         self.assertEqual(server_role.find_action_to_execute([]), None)
+
+    def test_plan_returns_pending_actions_in_order(self):
+        server_role = ServerRole('role')
+        server_role.actions = [
+            InstallAction('d1', MockService('Service1', 'd1')),
+            InstallAction('d2', MockService('Service2', 'd2')),
+            InstallAction('d3', MockService('Service3', 'd3')),
+            InstallAction('d4', MockService('Service4', 'd4'))
+        ]
+        server_role.quarantine_action('d4')
+        registered_services = [MockService('Service1', 'd1'), MockService('Service3', 'd0')]
+        pending_actions = server_role.plan(registered_services)
+        self.assertEqual([(action.deployment_id, action_info['last_deployment_id']) for action, action_info in pending_actions], [('d2', None), ('d3', 'd0')])
+
+    def test_plan_orders_actions_by_priority(self):
+        server_role = ServerRole('role')
+        server_role.actions = [InstallAction('d{0}'.format(i), MockService('Service{0}'.format(i), 'd{0}'.format(i))) for i in range(1, 4)]
+        server_role.actions[1].priority = -1
+        server_role.actions[2].priority = 1
+        pending_actions = server_role.plan([])
+        self.assertEqual([action.deployment_id for action, action_info in pending_actions], ['d2', 'd1', 'd3'])
+
+    def test_plan_orders_actions_shortest_first(self):
+        server_role = ServerRole('role')
+        server_role.actions = [InstallAction('d{0}'.format(i), MockService('Service{0}'.format(i), 'd{0}'.format(i))) for i in range(1, 5)]
+        server_role.actions[3].priority = -1
+        estimates = {'d1': None, 'd2': 5000, 'd3': 1000, 'd4': 9000}
+        pending_actions = server_role.plan([], lambda action: estimates[action.deployment_id])
+        self.assertEqual([(action.deployment_id, action_info['estimated_duration_in_ms']) for action, action_info in pending_actions],
+                         [('d4', 9000), ('d3', 1000), ('d2', 5000), ('d1', None)])
+
+    def test_plan_for_large_server_role(self):
+        server_role = ServerRole('role')
+        server_role.actions = [InstallAction('d{0}'.format(i), MockService('Service{0}'.format(i), 'd{0}'.format(i))) for i in range(5000)]
+        registered_services = [MockService('Service{0}'.format(i), 'd{0}'.format(i) if i % 2 else 'old') for i in range(5000)]
+        pending_actions = server_role.plan(registered_services)
+        self.assertEqual(len(pending_actions), 2500)
+        self.assertEqual(pending_actions[-1][0].deployment_id, 'd4998')
+        self.assertEqual(pending_actions[-1][1]['last_deployment_id'], 'old')
@@ -0,0 +1,37 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import unittest
+from agent.service import Service
+from agent.service_memo import ServiceMemo
+
+def create_service(name):
+    return Service({'ID': name, 'Address': '127.0.0.1', 'Tags': ['version:1.0.0']}, {'InstallationTimeout': 15})
+
+class TestServiceMemo(unittest.TestCase):
+    def test_memoised_services_are_copies(self):
+        memo = ServiceMemo()
+        memo.put(('env', 'Service1', '1.0.0'), (10, 11), create_service('Service1'))
+        service = memo.get(('env', 'Service1', '1.0.0'), (10, 11))
+        service.tag('slice:', 'blue')
+        self.assertEqual(memo.get(('env', 'Service1', '1.0.0'), (10, 11)).tags, ['version:1.0.0'])
+        self.assertEqual((memo.hits, memo.misses), (2, 0))
+
+    def test_changed_modify_index_is_a_miss(self):
+        memo = ServiceMemo()
+        memo.put(('env', 'Service1', '1.0.0'), (10, 11), create_service('Service1'))
+        self.assertIsNone(memo.get(('env', 'Service1', '1.0.0'), (10, 12)))
+        self.assertIsNone(memo.get(('env', 'Service1', '1.0.0'), (10, None)))
+
+    def test_unknown_modify_index_is_not_memoised(self):
+        memo = ServiceMemo()
+        memo.put(('env', 'Service1', '1.0.0'), (10, None), create_service('Service1'))
+        self.assertEqual(len(memo), 0)
+
+    def test_least_recently_used_service_is_evicted(self):
+        memo = ServiceMemo(max_entries=2)
+        memo.put(('env', 'Service1', '1.0.0'), (1, 1), create_service('Service1'))
+        memo.put(('env', 'Service2', '1.0.0'), (2, 2), create_service('Service2'))
+        memo.get(('env', 'Service1', '1.0.0'), (1, 1))
+        memo.put(('env', 'Service3', '1.0.0'), (3, 3), create_service('Service3'))
+        self.assertIsNone(memo.get(('env', 'Service2', '1.0.0'), (2, 2)))
+        self.assertIsNotNone(memo.get(('env', 'Service1', '1.0.0'), (1, 1)))
@@ -0,0 +1,67 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import logging, unittest
+from agent.deployment_stages import RegisterWithConsul
+from agent.service_registry import ServiceRegistry
+from mock import MagicMock, patch
+
+class MockService(object):
+    def __init__(self, id, deployment_id):
+        self.id = id
+        self.deployment_id = deployment_id
+        self.address = '127.0.0.1'
+        self.port = 8080
+        self.tags = ['deployment_id:{0}'.format(deployment_id)]
+
+class MockCatalogue(object):
+    def __init__(self, services):
+        self.services = services
+        self.number_of_loads = 0
+    def __call__(self):
+        self.number_of_loads += 1
+        return list(self.services)
+
+class TestServiceRegistry(unittest.TestCase):
+    def test_services_are_loaded_once(self):
+        catalogue = MockCatalogue([MockService('Service1', 'd1')])
+        registry = ServiceRegistry(catalogue)
+        registry.services()
+        self.assertEqual([s.deployment_id for s in registry.services()], ['d1'])
+        self.assertEqual(catalogue.number_of_loads, 1)
+
+    def test_register_replaces_service_with_same_id(self):
+        catalogue = MockCatalogue([MockService('Service1', 'd1'), MockService('Service2', 'd2')])
+        registry = ServiceRegistry(catalogue)
+        registry.sync()
+        registry.register(MockService('Service1', 'd3'))
+        self.assertEqual([(s.id, s.deployment_id) for s in registry.services()], [('Service2', 'd2'), ('Service1', 'd3')])
+        self.assertEqual(catalogue.number_of_loads, 1)
+
+    def test_sync_replaces_local_view(self):
+        catalogue = MockCatalogue([MockService('Service1', 'd1')])
+        registry = ServiceRegistry(catalogue)
+        registry.register(MockService('Service2', 'd2'))
+        registry.sync()
+        self.assertEqual([s.id for s in registry.services()], ['Service1'])
+
+    @patch('agent.service_registry.time.time')
+    def test_services_are_synchronised_after_interval(self, mock_time):
+        mock_time.return_value = 100.0
+        catalogue = MockCatalogue([])
+        registry = ServiceRegistry(catalogue, sync_interval_in_ms=1000)
+        registry.services()
+        mock_time.return_value = 100.5
+        registry.services()
+        mock_time.return_value = 101.0
+        registry.services()
+        self.assertEqual(catalogue.number_of_loads, 2)
+
+    def test_successful_registration_updates_registry(self):
+        deployment = MagicMock()
+        deployment.logger = logging.getLogger('test')
+        deployment.service = MockService('Service1', 'd1')
+        deployment.service_registry = ServiceRegistry(MockCatalogue([]))
+        for is_success, expected_services in [(False, []), (True, ['Service1'])]:
+            deployment.consul_api.register_service.return_value = is_success
+            RegisterWithConsul()._run(deployment)
+            self.assertEqual([s.id for s in deployment.service_registry.services()], expected_services)
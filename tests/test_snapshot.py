@@ -0,0 +1,59 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import os, shutil, tempfile, unittest
+from agent.kv_cache import KeyValueCache
+from agent.snapshot import Snapshot, is_up_to_date
+
+role_key = 'environments/env/roles/role'
+definition_key = 'environments/env/services/Service1/1.0.0/definition'
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = Snapshot(os.path.join(self.directory, 'snapshot.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_without_snapshot_file(self):
+        self.assertIsNone(self.snapshot.load(role_key))
+
+    def test_save_and_load(self):
+        entries = [[definition_key, 10, {'Service': {'Name': 'Service1'}}]]
+        self.snapshot.save(role_key, 120, 'digest', True, entries)
+        self.snapshot.save(role_key, 130, 'digest', False, entries)
+        state = self.snapshot.load(role_key)
+        self.assertEqual((state['role_index'], state['role_digest'], state['is_success'], state['entries']), (130, 'digest', False, entries))
+        self.assertEqual(os.listdir(self.directory), ['snapshot.json'])
+
+    def test_load_ignores_snapshot_of_another_role(self):
+        self.snapshot.save('environments/env/roles/other', 120, 'digest', True, [])
+        self.assertIsNone(self.snapshot.load(role_key))
+
+    def test_load_ignores_corrupt_snapshot(self):
+        with open(self.snapshot.filepath, 'w') as snapshot_file:
+            snapshot_file.write('{"version": 1, "role_')
+        self.assertIsNone(self.snapshot.load(role_key))
+
+    def test_save_to_unwritable_location_does_not_fail(self):
+        Snapshot(os.path.join(self.directory, 'missing', 'snapshot.json')).save(role_key, 120, 'digest', True, [])
+
+    def test_is_up_to_date(self):
+        state = {'role_index': 120, 'role_digest': 'digest', 'is_success': True}
+        self.assertTrue(is_up_to_date(state, 120, 'other digest'))
+        self.assertTrue(is_up_to_date(state, 130, 'digest'))
+        self.assertFalse(is_up_to_date(state, 130, 'other digest'))
+        self.assertFalse(is_up_to_date(state, 0, None))
+        self.assertFalse(is_up_to_date(dict(state, is_success=False), 120, 'digest'))
+        self.assertFalse(is_up_to_date(None, 120, 'digest'))
+
+    def test_cache_is_warmed_from_saved_entries(self):
+        cache = KeyValueCache()
+        cache.put(definition_key, 10, {'Service': {'Name': 'Service1'}})
+        cache.put('environments/env/roles/role/services/Service1/blue', 11, {'Version': '1.0.0'})
+        self.snapshot.save(role_key, 120, 'digest', True, cache.immutable_entries())
+        warm_cache = KeyValueCache()
+        for key, modify_index, value in self.snapshot.load(role_key)['entries']:
+            warm_cache.put(key, modify_index, value)
+        self.assertEqual(len(warm_cache), 1)
+        self.assertEqual(warm_cache.get(definition_key), (True, {'Service': {'Name': 'Service1'}}))
@@ -0,0 +1,47 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import threading, time, unittest
+from agent.trigger_coalescer import TriggerCoalescer
+
+class TestTriggerCoalescer(unittest.TestCase):
+    def test_notifications_collapse_into_one_trigger(self):
+        coalescer = TriggerCoalescer(quiet_period_in_ms=50)
+        for key in ['role', 'services/Service1/1.0.0/', 'role']:
+            coalescer.notify(key)
+        self.assertEqual(coalescer.wait(), set(['role', 'services/Service1/1.0.0/']))
+        self.assertEqual((coalescer.number_of_notifications, coalescer.number_of_triggers), (3, 1))
+
+    def test_trigger_waits_for_quiet_period(self):
+        coalescer = TriggerCoalescer(quiet_period_in_ms=200, max_delay_in_ms=5000)
+        def notify_in_bursts():
+            for i in range(3):
+                coalescer.notify('key{0}'.format(i))
+                time.sleep(0.1)
+        thread = threading.Thread(target=notify_in_bursts)
+        thread.start()
+        self.assertEqual(coalescer.wait(), set(['key0', 'key1', 'key2']))
+        thread.join()
+
+    def test_trigger_is_not_delayed_beyond_max_delay(self):
+        coalescer = TriggerCoalescer(quiet_period_in_ms=200, max_delay_in_ms=300)
+        is_stopped = threading.Event()
+        def notify_continuously():
+            while not is_stopped.is_set():
+                coalescer.notify('role')
+                time.sleep(0.05)
+        thread = threading.Thread(target=notify_continuously)
+        thread.start()
+        start_time = time.time()
+        coalescer.wait()
+        duration = time.time() - start_time
+        is_stopped.set()
+        thread.join()
+        self.assertLess(duration, 1)
+
+    def test_notifications_received_before_waiting_trigger_without_quiet_period(self):
+        coalescer = TriggerCoalescer(quiet_period_in_ms=10000, max_delay_in_ms=100)
+        coalescer.notify('role')
+        time.sleep(0.15)
+        start_time = time.time()
+        self.assertEqual(coalescer.wait(), set(['role']))
+        self.assertLess(time.time() - start_time, 0.1)
@@ -0,0 +1,85 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import base64, json, os, shutil, tempfile, threading, unittest
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from agent.block_check import BlockCheckService
+from agent.consul_api import ConsulApi
+
+class ConsulStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, status_code, content):
+        content = json.dumps(content)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('X-Consul-Index', '42')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path, None))
+        if self.path == '/v1/agent/self':
+            self._respond(200, {'Config': {}})
+        elif self.path == '/v1/kv/some/key':
+            self._respond(200, [{'Key': 'some/key', 'Value': base64.b64encode(json.dumps({'property': 'value'})), 'ModifyIndex': 42}])
+        else:
+            self._respond(404, None)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.server.requests.append(('PUT', self.path, body))
+        self._respond(200, True)
+
+    def address_string(self):
+        return self.server.server_address
+
+    def log_message(self, format, *args):
+        pass
+
+class ConsulStandIn(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    def __init__(self, socket_path):
+        UnixStreamServer.__init__(self, socket_path, ConsulStandInHandler)
+        self.requests = []
+
+class TestUnixSocketTransport(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'consul.sock')
+        self.server = ConsulStandIn(self.socket_path)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.consul_api = ConsulApi({'scheme': 'unix', 'socket_path': self.socket_path, 'host': None, 'port': None, 'version': 'v1', 'acl_token': None})
+
+    def tearDown(self):
+        self.consul_api.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_requests_go_through_socket(self):
+        self.consul_api.check_connectivity()
+        self.assertEqual(self.consul_api.get_value('some/key'), {'property': 'value'})
+        self.assertEqual(self.consul_api.get_value('unknown/key'), None)
+        self.assertEqual([request[1] for request in self.server.requests], ['/v1/agent/self', '/v1/kv/some/key', '/v1/kv/unknown/key'])
+
+    def test_put_requests_go_through_socket(self):
+        self.assertTrue(self.consul_api.register_service(id='service_id', name='service_name', address='127.0.0.1', port=8080, tags=['tag']))
+        method, path, body = self.server.requests[0]
+        self.assertEqual((method, path), ('PUT', '/v1/agent/service/register'))
+        self.assertEqual(json.loads(body)['ID'], 'service_id')
+
+    def test_connections_are_reused(self):
+        for _ in range(4):
+            self.consul_api.check_connectivity()
+        self.assertEqual(self.consul_api.connection_reuse_rate, 0.75)
+
+    def test_block_check_is_registered_through_socket(self):
+        BlockCheckService(platform='linux', consul_api=self.consul_api).register_block()
+        method, path, body = self.server.requests[0]
+        self.assertEqual(path, '/v1/agent/check/register')
+        self.assertEqual(json.loads(body)['Name'], 'block-check')
+        self.assertEqual(json.loads(body)['Interval'], '3s')
@@ -0,0 +1,97 @@
+# Copyright (c) Trainline Limited, 2016-2017. All rights reserved. See LICENSE.txt in the project root for license information.
+
+import Queue, threading, unittest
+from agent.consul_api import ConsulError
+from agent.watch_manager import WatchManager
+
+class MockRetryPolicy(object):
+    def delay_in_ms(self, operation_class, attempt_number):
+        return 0
+
+class MockCache(object):
+    def __init__(self):
+        self.watched_prefixes = set()
+        self.prefix_indexes = {}
+
+    def prefix_index(self, key_prefix):
+        return self.prefix_indexes.get(key_prefix)
+
+    def watch(self, key_prefix):
+        self.watched_prefixes.add(key_prefix)
+
+    def unwatch(self, key_prefix):
+        self.watched_prefixes.discard(key_prefix)
+
+class MockConsulApi(object):
+    # Blocking queries wait until the test publishes a new index for their key prefix
+    def __init__(self):
+        self.retry_policy = MockRetryPolicy()
+        self.cache = MockCache()
+        self.indexes = {}
+        self.updates = {}
+        self.queries = []
+        self.lock = threading.Lock()
+
+    def publish(self, key_prefix, index):
+        self.updates.setdefault(key_prefix, Queue.Queue()).put(index)
+
+    def watch_key_prefix(self, key_prefix, index=0, wait_in_ms=None):
+        with self.lock:
+            self.queries.append((key_prefix, index))
+            updates = self.updates.setdefault(key_prefix, Queue.Queue())
+        if index:
+            self.indexes[key_prefix] = updates.get()
+        new_index = self.indexes.get(key_prefix, 1)
+        if isinstance(new_index, Exception):
+            self.indexes[key_prefix] = index
+            raise new_index
+        return (new_index, [{'Key': key_prefix, 'ModifyIndex': new_index}])
+
+class TestWatchManager(unittest.TestCase):
+    def setUp(self):
+        self.consul_api = MockConsulApi()
+        self.watch_manager = WatchManager(self.consul_api, debounce_in_ms=100)
+
+    def test_changes_to_several_prefixes_trigger_once(self):
+        self.watch_manager.add('role').prime()
+        self.watch_manager.watch(['role', 'services/Service1/1.0.0/'])
+        self.consul_api.publish('role', 5)
+        self.consul_api.publish('services/Service1/1.0.0/', 7)
+        self.assertEqual(self.watch_manager.wait_for_change(), set(['role', 'services/Service1/1.0.0/']))
+        self.assertEqual(self.consul_api.cache.watched_prefixes, set(['role', 'services/Service1/1.0.0/']))
+        self.assertEqual(self.watch_manager.add('role').entries, [{'Key': 'role', 'ModifyIndex': 5}])
+
+    def test_new_prefixes_are_watched_from_the_cached_index(self):
+        self.consul_api.cache.prefix_indexes['services/Service1/1.0.0/'] = 3
+        self.watch_manager.add('role').prime()
+        self.watch_manager.watch(['role', 'services/Service1/1.0.0/', 'services/Service2/1.0.0/'])
+        self.consul_api.publish('role', 5)
+        self.assertEqual(self.watch_manager.wait_for_change(), set(['role']))
+        self.assertIn(('services/Service1/1.0.0/', 3), self.consul_api.queries)
+        # A prefix the converge found missing is reported once written
+        self.assertIn(('services/Service2/1.0.0/', 1), self.consul_api.queries)
+        self.consul_api.publish('services/Service2/1.0.0/', 7)
+        self.assertEqual(self.watch_manager.wait_for_change(), set(['services/Service2/1.0.0/']))
+
+    def test_unprimed_watcher_reports_first_result(self):
+        self.watch_manager.add('role')
+        self.watch_manager.watch(['role'])
+        self.assertEqual(self.watch_manager.wait_for_change(), set(['role']))
+
+    def test_removed_prefixes_are_no_longer_reported(self):
+        self.watch_manager.add('role').prime()
+        self.watch_manager.watch(['role', 'services/Service1/1.0.0/'])
+        self.watch_manager.watch(['role'])
+        self.assertEqual(self.watch_manager.key_prefixes, ['role'])
+        self.assertNotIn('services/Service1/1.0.0/', self.consul_api.cache.watched_prefixes)
+        self.consul_api.publish('services/Service1/1.0.0/', 7)
+        self.consul_api.publish('role', 5)
+        self.assertEqual(self.watch_manager.wait_for_change(), set(['role']))
+
+    def test_watch_continues_after_errors(self):
+        self.watch_manager.add('role').prime()
+        self.watch_manager.watch(['role'])
+        self.consul_api.publish('role', ConsulError('Some error message'))
+        self.consul_api.publish('role', 5)
+        self.assertEqual(self.watch_manager.wait_for_change(), set(['role']))
+        self.assertEqual(self.watch_manager.add('role').index, 5)